@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # Author: 'JiaChen'
 
-import xmlrpc.client
+from tools.lazy import lazy_import
+
+# xmlrpc在第一次登录时才导入
+xmlrpc_client = lazy_import('xmlrpc.client')
 
 
 class CobblerApi(object):
@@ -24,7 +27,7 @@ class CobblerApi(object):
         :return:
         """
         try:
-            remote = xmlrpc.client.Server(uri=self.url)
+            remote = xmlrpc_client.Server(uri=self.url)
             token = remote.login(self.username, self.password)
             return remote, token
         except Exception as e:
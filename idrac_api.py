@@ -7,9 +7,13 @@
 注意：只提取URL：/redfish/v1/Systems/System.Embedded.1 下的信息
 """
 
-import requests
 import json
 
+from tools.lazy import lazy_import
+
+# requests在第一次连接时才导入
+requests = lazy_import('requests')
+
 
 class idrac_api(object):
     """
@@ -1,11 +1,10 @@
 #!/usr/bin/env python
 # Author: 'JiaChen'
 
-import requests
+from tools.lazy import lazy_import
 
-# 使用requests请求https出现警告，做的设置
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+# requests在第一次请求时才导入
+requests = lazy_import('requests')
 
 
 class SaltStackApi(object):
@@ -23,6 +22,9 @@ class SaltStackApi(object):
         self.headers = {
             'Content-type': 'application/json'
         }
+        # 使用requests请求https出现警告，做的设置
+        requests.packages.urllib3.disable_warnings(
+            requests.packages.urllib3.exceptions.InsecureRequestWarning)
         self.login()
 
     def login(self):
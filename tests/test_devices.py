@@ -0,0 +1,90 @@
+import pytest
+
+from tools import devices
+
+
+def scsi_model(used_units):
+    model = devices.DeviceModel()
+    model.add_controller(1000, 'scsi', 0)
+    for unit in used_units:
+        model.use(1000, unit)
+    return model
+
+
+def test_free_slot_skips_scsi_controller_unit():
+    model = scsi_model(range(7))
+    assert model.free_slot('scsi') == (1000, 8)
+
+
+def test_free_slot_moves_to_next_bus_when_full():
+    model = scsi_model(devices.SCSI_UNITS)
+    model.add_controller(1001, 'scsi', 1)
+    assert model.free_slot('scsi') == (1001, 0)
+
+
+def test_free_slot_without_room():
+    assert scsi_model(devices.SCSI_UNITS).free_slot('scsi') == (None, None)
+    assert devices.DeviceModel().free_slot('sata') == (None, None)
+
+
+def test_free_unit_raises_when_full():
+    with pytest.raises(ValueError):
+        scsi_model(devices.SCSI_UNITS).free_unit(1000)
+
+
+def test_copy_does_not_touch_model():
+    model = devices.DeviceModel.new_vm()
+    plan = model.copy()
+    plan.use(200, 0)
+    plan.add_controller(-1, 'sata', 0)
+    assert model.free_slot('ide') == (200, 0)
+    assert -1 not in model.controllers
+
+
+def full_ide_model():
+    model = devices.DeviceModel.new_vm()
+    for key in devices.DEFAULT_IDE_CONTROLLER_KEYS:
+        for unit in devices.IDE_UNITS:
+            model.use(key, unit)
+    return model
+
+
+def test_cdrom_uses_free_ide_slot():
+    pytest.importorskip('pyVmomi')
+    builder = devices.DeviceChangeBuilder(None,
+                                          model=devices.DeviceModel.new_vm())
+    builder.add_cdrom()
+    cdrom = builder.changes[0].device
+    assert (cdrom.controllerKey, cdrom.unitNumber) == (200, 0)
+
+
+def test_cdrom_falls_back_to_new_sata_controller():
+    pytest.importorskip('pyVmomi')
+    builder = devices.DeviceChangeBuilder(None, model=full_ide_model())
+    builder.add_cdrom().add_cdrom()
+    sata, first, second = [spec.device for spec in builder.changes]
+    assert sata.busNumber == 0
+    assert (first.controllerKey, first.unitNumber) == (sata.key, 0)
+    assert (second.controllerKey, second.unitNumber) == (sata.key, 1)
+    assert builder.has_cdrom
+
+
+def test_disk_adds_scsi_controller_when_needed():
+    pytest.importorskip('pyVmomi')
+    builder = devices.DeviceChangeBuilder(None,
+                                          model=devices.DeviceModel.new_vm())
+    builder.add_disk(10)
+    scsi, disk = [spec.device for spec in builder.changes]
+    assert (disk.controllerKey, disk.unitNumber) == (scsi.key, 0)
+    assert disk.capacityInKB == 10 * 1024 * 1024
+
+
+def test_insert_iso_loads_cdrom_added_in_same_batch():
+    pytest.importorskip('pyVmomi')
+    builder = devices.DeviceChangeBuilder(None,
+                                          model=devices.DeviceModel.new_vm())
+    builder.add_cdrom().insert_iso('[iso] centos.iso')
+    assert len(builder.changes) == 1
+    cdrom = builder.changes[0].device
+    assert cdrom.backing.fileName == '[iso] centos.iso'
+    assert not builder.model.cdroms
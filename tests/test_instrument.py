@@ -0,0 +1,38 @@
+from tools import instrument
+
+
+def test_histogram_cumulative():
+    histogram = instrument.Histogram((1, 5, 10))
+    for value in (0.5, 1, 3, 7, 50):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(1, 2), (5, 3), (10, 4), ('+Inf', 5)]
+    assert histogram.count == 5
+    assert histogram.total == 61.5
+
+
+def test_prometheus_exposition():
+    stats = instrument.SoapStats()
+    stats.record('RetrieveContents', 'PropertyCollector', 0.02,
+                 request_bytes=800, response_bytes=5000)
+    stats.record('RetrieveContents', 'PropertyCollector', 0.3,
+                 fault='NotAuthenticated')
+    text = stats.prometheus(labels={'script': 'nightly'})
+    lines = text.splitlines()
+    base = 'script="nightly",method="RetrieveContents",type="PropertyCollector"'
+    assert '# TYPE vcenter_soap_latency_seconds histogram' in lines
+    assert 'vcenter_soap_latency_seconds_bucket{%s,le="0.025"} 1' % base \
+        in lines
+    assert 'vcenter_soap_latency_seconds_bucket{%s,le="+Inf"} 2' % base \
+        in lines
+    assert 'vcenter_soap_latency_seconds_count{%s} 2' % base in lines
+    assert 'vcenter_soap_request_bytes_sum{%s} 800' % base in lines
+    assert ('vcenter_soap_faults_total{%s,fault="NotAuthenticated"} 1'
+            % base) in lines
+    assert text.endswith('\n')
+
+
+def test_label_values_are_escaped():
+    stats = instrument.SoapStats()
+    stats.record('Login', 'SessionManager', 0.1)
+    text = stats.prometheus(labels={'script': 'a "b"\\c'})
+    assert 'script="a \\"b\\"\\\\c"' in text
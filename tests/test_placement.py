@@ -0,0 +1,119 @@
+import pytest
+
+from tools import placement
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+
+class Ref(object):
+
+    def __init__(self, moid, name=None):
+        self._moId = moid
+        self.name = name or moid
+
+
+def engine(strategy='spread'):
+    """
+    Two hosts on one shared datastore: host-1 idle, host-2 half full.
+    """
+    datastore = Ref('ds-1', 'shared')
+    cluster = Ref('domain-c1')
+    hosts = [
+        {'obj': Ref('host-1', 'esx1'), 'name': 'esx1', 'parent': cluster,
+         'datastore': [datastore], 'vm': [],
+         'runtime.connectionState': 'connected',
+         'runtime.inMaintenanceMode': False,
+         'summary.hardware.memorySize': 64 * GB,
+         'summary.hardware.cpuMhz': 2000,
+         'summary.hardware.numCpuCores': 16,
+         'summary.quickStats.overallMemoryUsage': 0,
+         'summary.quickStats.overallCpuUsage': 0},
+        {'obj': Ref('host-2', 'esx2'), 'name': 'esx2', 'parent': cluster,
+         'datastore': [datastore], 'vm': [Ref('vm-1')],
+         'runtime.connectionState': 'connected',
+         'runtime.inMaintenanceMode': False,
+         'summary.hardware.memorySize': 64 * GB,
+         'summary.hardware.cpuMhz': 2000,
+         'summary.hardware.numCpuCores': 16,
+         'summary.quickStats.overallMemoryUsage': 32 * 1024,
+         'summary.quickStats.overallCpuUsage': 8000},
+        {'obj': Ref('host-3', 'esx3'), 'name': 'esx3', 'parent': cluster,
+         'datastore': [datastore], 'vm': [],
+         'runtime.connectionState': 'connected',
+         'runtime.inMaintenanceMode': True,
+         'summary.hardware.memorySize': 256 * GB,
+         'summary.hardware.cpuMhz': 3000,
+         'summary.hardware.numCpuCores': 64},
+    ]
+    datastores = [{'obj': datastore, 'name': 'shared', 'vm': [],
+                   'summary.accessible': True,
+                   'summary.capacity': 1000 * GB,
+                   'summary.freeSpace': 800 * GB}]
+    computes = [{'obj': cluster, 'resourcePool': Ref('resgroup-1')}]
+    result = placement.PlacementEngine(None, strategy=strategy, max_age=None)
+    result.load(hosts, datastores, computes)
+    return result
+
+
+def spec(name, memory_mb=4096, num_cpus=2, disk_gb=20, **extra):
+    return dict(extra, vm_name=name, memory_mb=memory_mb,
+                num_cpus=num_cpus, disk_gb=disk_gb)
+
+
+def test_load_applies_headroom_and_skips_maintenance():
+    model = dict((host.name, host) for host in engine().hosts())
+    assert sorted(model) == ['esx1', 'esx2']
+    assert model['esx1'].free_memory_mb == 64 * 1024 * 0.9
+    assert model['esx2'].free_cpu_mhz == 32000 * 0.8 - 8000
+    assert model['esx1'].pool._moId == 'resgroup-1'
+    datastore, = engine().datastores()
+    assert datastore.free_gb == 800 - 1000 * 0.1
+
+
+def test_spread_and_pack_pick_opposite_hosts():
+    assert engine('spread').place([spec('a')])[0].host.name == 'esx1'
+    placed, = engine('pack').place([spec('a')])
+    assert (placed.host_name, placed.datastore_name) == ('esx2', 'shared')
+    assert engine('pack').place([spec('a')])[0].host.name == 'esx2'
+
+
+def test_strategy_per_call_leaves_engine_default():
+    shared = engine('spread')
+    assert shared.place([spec('a')], strategy='pack')[0].host.name == 'esx2'
+    assert shared.strategy == 'spread'
+    with pytest.raises(ValueError):
+        shared.place([spec('b')], strategy='random')
+
+
+def test_place_reserves_capacity_for_later_specs():
+    shared = engine()
+    first, second = shared.place([spec('a', memory_mb=20 * 1024),
+                                  spec('b', memory_mb=20 * 1024)])
+    host = dict((host.name, host) for host in shared.hosts())['esx1']
+    assert first.host.name == second.host.name == 'esx1'
+    assert host.free_memory_mb == 64 * 1024 * 0.9 - 40 * 1024
+    # esx1 has no room for a third one, it goes to esx2.
+    third, = shared.place([spec('c', memory_mb=20 * 1024)])
+    assert third.host.name == 'esx2'
+    shared.release(first)
+    assert host.free_memory_mb == 64 * 1024 * 0.9 - 20 * 1024
+
+
+def test_place_honours_host_and_fails_atomically():
+    shared = engine()
+    placed, = shared.place([spec('a', host='esx2')])
+    assert placed.host.name == 'esx2'
+    before = dict((host.name, host.free_memory_mb)
+                  for host in shared.hosts())
+    with pytest.raises(ValueError):
+        shared.place([spec('small'), spec('huge', memory_mb=512 * 1024)])
+    assert before == dict((host.name, host.free_memory_mb)
+                          for host in shared.hosts())
+
+
+def test_vm_requirements_counts_swap():
+    memory_mb, cpu_mhz, space_gb = placement.vm_requirements(
+        {'memory_mb': 2048, 'num_cpus': 2, 'disks': [(10, 'thin')],
+         'disk_gb': 20})
+    assert (memory_mb, cpu_mhz, space_gb) == (2048, 1000, 32.0)
@@ -0,0 +1,78 @@
+import collections
+
+from tools import scheduler
+from tools import tasks
+
+
+class Task(object):
+
+    def __init__(self, moid, state='success', result=None, error=None):
+        self._moId = moid
+        self.state = state
+        self.result = result
+        self.error = error
+
+
+class FakeCollector(object):
+    """
+    Reports every added task as finished on the next wait.
+    """
+
+    def __init__(self, service_instance):
+        self._added = []
+
+    def add(self, task):
+        self._added.append(task)
+
+    def wait(self, timeout):
+        added, self._added = self._added, []
+        return [tasks.TaskUpdate(task, task.state, 100, task.result,
+                                 task.error) for task in added]
+
+    def close(self):
+        pass
+
+
+class FakeVim(object):
+    TaskInfo = collections.namedtuple('TaskInfo', ['State'])(
+        collections.namedtuple('State', ['error'])('error'))
+
+
+def run(monkeypatch, jobs, **kwargs):
+    monkeypatch.setattr(tasks, 'TaskCollector', FakeCollector)
+    monkeypatch.setattr(scheduler, 'vim', FakeVim)
+    return scheduler.TaskScheduler(None, **kwargs).run(jobs)
+
+
+def test_two_step_job_keeps_created_entity(monkeypatch):
+    seen = []
+
+    def power_on(vm):
+        seen.append(vm)
+        return Task('task-2')
+
+    job = scheduler.Job('vm-01', [lambda _: Task('task-1', result='vm-1'),
+                                  power_on])
+    run(monkeypatch, [job])
+    assert seen == ['vm-1']
+    assert job.ok
+    assert job.as_dict()['result'] == 'vm-1'
+    assert len(job.step_times) == 2
+
+
+def test_failed_step_stops_the_job(monkeypatch):
+    second = []
+    job = scheduler.Job('vm-01', [
+        lambda _: Task('task-1', state='error', error='NoDiskSpace'),
+        lambda _: second.append(1)])
+    run(monkeypatch, [job])
+    assert not job.ok
+    assert job.error == 'NoDiskSpace'
+    assert second == []
+
+
+def test_zero_limit_fails_instead_of_hanging(monkeypatch):
+    job = scheduler.Job('vm-01', [lambda _: Task('task-1')],
+                        keys={'host': 'esx-01'})
+    run(monkeypatch, [job], limits={'host': 0})
+    assert isinstance(job.error, ValueError)
@@ -0,0 +1,47 @@
+from tools import snapshot
+
+
+class Node(object):
+
+    def __init__(self, name, children=()):
+        self.name = name
+        self.snapshot = 'snapshot-' + name
+        self.childSnapshotList = list(children)
+
+
+class Info(object):
+
+    def __init__(self, roots, current=None):
+        self.rootSnapshotList = roots
+        self.currentSnapshot = current
+
+
+class Ref(object):
+
+    def __init__(self, moid):
+        self._moId = moid
+
+
+def test_find_in_tree_searches_children():
+    info = Info([Node('base', [Node('pre-patch', [Node('post-patch')])]),
+                 Node('other')])
+    assert snapshot.find_in_tree(info, 'post-patch') == 'snapshot-post-patch'
+    assert snapshot.find_in_tree(info, 'other') == 'snapshot-other'
+    assert snapshot.find_in_tree(info, 'missing') is None
+
+
+def test_find_in_tree_current_and_empty():
+    assert snapshot.find_in_tree(Info([], 'snapshot-1')) == 'snapshot-1'
+    assert snapshot.find_in_tree(None, 'base') is None
+
+
+def test_job_keys_from_config_path():
+    row = {'runtime.host': Ref('host-12'),
+           'config.files.vmPathName': '[san-01] vm-01/vm-01.vmx'}
+    assert snapshot.job_keys(row) == {'host': 'host-12',
+                                      'datastore': 'san-01'}
+
+
+def test_job_keys_without_host_or_path():
+    assert snapshot.job_keys({}) == {}
+    assert snapshot.job_keys({'config.files.vmPathName': 'vm.vmx'}) == {}
@@ -0,0 +1,42 @@
+from tools import tasks
+
+
+class Stub(object):
+    pass
+
+
+class ServiceInstance(object):
+    """
+    Like pyVmomi's: every ServiceInstance has moId 'ServiceInstance', so
+    they compare equal whatever connection they belong to.
+    """
+
+    def __init__(self):
+        self._stub = Stub()
+
+    def __eq__(self, other):
+        return isinstance(other, ServiceInstance)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash('ServiceInstance')
+
+
+def test_one_watcher_per_connection():
+    first, second = ServiceInstance(), ServiceInstance()
+    assert first == second
+    watcher = tasks.get_watcher(first)
+    assert tasks.get_watcher(first) is watcher
+    assert tasks.get_watcher(second) is not watcher
+    assert tasks.get_watcher(second).service_instance is second
+
+
+def test_close_watcher_drops_it():
+    si = ServiceInstance()
+    watcher = tasks.get_watcher(si)
+    tasks.close_watcher(si)
+    assert watcher._closed
+    assert tasks.get_watcher(si) is not watcher
+    tasks.close_watcher(ServiceInstance())
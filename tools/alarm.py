@@ -5,15 +5,53 @@ Website: https://michaelrice.github.io/
 Blog: http://www.errr-online.com/
 This code has been released under the terms of the Apache 2.0 licenses
 http://www.apache.org/licenses/LICENSE-2.0.html
+
+Bulk usage, e.g. after an outage:
+    alarms = alarm.collect_triggered_alarms(SI)
+    for result in alarm.reset_alarms(SI, alarms, max_workers=16):
+        if not result.ok:
+            print(result.alarm.alarm_moref, result.error)
 """
 from __future__ import print_function
 
+import collections
+import concurrent.futures
 import logging
-from xml.etree.ElementTree import Element
-from xml.etree.ElementTree import SubElement
-from xml.etree.ElementTree import tostring
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+from tools import pchelper
+from tools.lazy import lazy_import
+
+requests = lazy_import('requests')
+vim = lazy_import('pyVmomi', 'vim')
+
+# SetAlarmStatus envelope, rendered with % and escaped values. Built once
+# instead of an ElementTree per alarm.
+ENVELOPE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<soap:Envelope xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soap:Body>'
+    '<SetAlarmStatus xmlns="urn:vim25">'
+    '<_this xsi:type="ManagedObjectReference" type="AlarmManager">'
+    'AlarmManager</_this>'
+    '<alarm type="Alarm">%(alarm)s</alarm>'
+    '<entity xsi:type="ManagedObjectReference" type=%(entity_type)s>'
+    '%(entity)s</entity>'
+    '<status>%(status)s</status>'
+    '</SetAlarmStatus>'
+    '</soap:Body>'
+    '</soap:Envelope>'
+)
+
+TriggeredAlarm = collections.namedtuple(
+    'TriggeredAlarm', ['entity', 'entity_moref', 'entity_type',
+                       'alarm_moref', 'status', 'acknowledged', 'time'])
 
-import requests
+ResetResult = collections.namedtuple(
+    'ResetResult', ['alarm', 'ok', 'status_code', 'error'])
 
 
 def reset_alarm(**kwargs):
@@ -67,61 +105,129 @@ def _build_payload(**kwargs):
     if not entity_moref or not entity_type or not alarm_moref:
         raise ValueError("entity_moref, entity_type, and alarm_moref "
                          "must be set")
-
-    attribs = {
-        'xmlns:xsd': 'http://www.w3.org/2001/XMLSchema',
-        'xmlns:xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-        'xmlns:soap': 'http://schemas.xmlsoap.org/soap/envelope/'
+    return ENVELOPE % {
+        'alarm': escape(alarm_moref),
+        'entity_type': quoteattr(entity_type),
+        'entity': escape(entity_moref),
+        'status': escape(kwargs.get("status", "green")),
     }
-    root = Element('soap:Envelope', attribs)
-    body = SubElement(root, 'soap:Body')
-    alarm_status = SubElement(body, 'SetAlarmStatus', {'xmlns': 'urn:vim25'})
-    this = SubElement(alarm_status, '_this', {
-        'xsi:type': 'ManagedObjectReference',
-        'type': 'AlarmManager'
-    })
-    this.text = 'AlarmManager'
-    alarm = SubElement(alarm_status, 'alarm', {'type': 'Alarm'})
-    alarm.text = alarm_moref
-    entity = SubElement(alarm_status, 'entity', {
-        'xsi:type': 'ManagedObjectReference',
-        'type': entity_type
-    })
-    entity.text = entity_moref
-    status = SubElement(alarm_status, 'status')
-    status.text = 'green'
-    # I hate hard coding this but I have no idea how to do it any other way
-    # pull requests welcome :)
-    return '<?xml version="1.0" encoding="UTF-8"?>{0}'.format(tostring(root))
-
-
-def _send_request(payload=None, session=None):
+
+
+def _send_request(payload=None, session=None, http=None):
     """
     Using requests we send a SOAP envelope directly to the
     vCenter API to reset an alarm to the green state.
 
     :param payload:
     :param session:
+    :param http: requests.Session to reuse, a one-off request when None
     :return:
     """
+    res = _post(payload, session, http)
+    if res.status_code != 200:
+        logging.debug("Failed to reset alarm. HTTP Status: {0}".format(
+            res.status_code))
+        return False
+    return True
+
+
+def _post(payload, session, http=None):
     stub = session
     host_port = stub.host
     # Ive seen some code in pyvmomi where it seems like we check for http vs
     # https but since the default is https do people really run it on http?
     url = 'https://{0}/sdk'.format(host_port)
-    logging.debug("Sending {0} to {1}".format(payload, url))
+    logging.debug("Sending %s to %s", payload, url)
     # I opted to ignore invalid ssl here because that happens in pyvmomi.
     # Once pyvmomi validates ssl it wont take much to make it happen here.
-    res = requests.post(url=url, data=payload, headers={
+    return (http or requests).post(url=url, data=payload, headers={
         'Cookie': stub.cookie,
         'SOAPAction': 'urn:vim25',
         'Content-Type': 'application/xml'
     }, verify=False)
-    if res.status_code != 200:
-        logging.debug("Failed to reset alarm. HTTP Status: {0}".format(
-            res.status_code))
-        return False
-    return True
+
+
+def collect_triggered_alarms(service_instance, container=None):
+    """
+    Returns a TriggeredAlarm for every triggered alarm on every managed
+    entity below `container` (the root folder by default), read with one
+    property collector call instead of one round trip per entity.
+
+    :param service_instance:
+    :param container:
+    :return list:
+    """
+    rows = pchelper.collect_all(service_instance, vim.ManagedEntity,
+                                path_set=['triggeredAlarmState'],
+                                container=container)
+    alarms = []
+    for row in rows:
+        entity = row['obj']
+        for state in row.get('triggeredAlarmState') or []:
+            alarms.append(TriggeredAlarm(
+                entity=entity,
+                entity_moref=entity._moId,
+                entity_type=entity._wsdlName,
+                alarm_moref=state.alarm._moId,
+                status=state.overallStatus,
+                acknowledged=state.acknowledged,
+                time=state.time))
+    return alarms
+
+
+def reset_alarms(service_instance, alarms, max_workers=8, status='green'):
+    """
+    Sets every alarm in `alarms` (TriggeredAlarm, e.g. from
+    collect_triggered_alarms) to `status`. The requests share one
+    keep-alive session of at most `max_workers` connections and run
+    `max_workers` at a time.
+
+    :param service_instance:
+    :param alarms:
+    :param max_workers:
+    :param status:
+    :return list: one ResetResult per alarm, in the order given
+    """
+    alarms = list(alarms)
+    if not alarms:
+        return []
+    stub = service_instance._stub
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_workers)
+    http.mount('https://', adapter)
+
+    def reset(triggered):
+        payload = _build_payload(entity_moref=triggered.entity_moref,
+                                 entity_type=triggered.entity_type,
+                                 alarm_moref=triggered.alarm_moref,
+                                 status=status)
+        try:
+            res = _post(payload, stub, http)
+        except requests.RequestException as e:
+            return ResetResult(triggered, False, None, str(e))
+        if res.status_code != 200:
+            return ResetResult(triggered, False, res.status_code,
+                               _fault_string(res.text))
+        return ResetResult(triggered, True, res.status_code, None)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            return list(pool.map(reset, alarms))
+    finally:
+        http.close()
+
+
+def _fault_string(body):
+    """
+    Extracts <faultstring> from a SOAP fault, or returns the start of the
+    body.
+    """
+    start = body.find('<faultstring>')
+    end = body.find('</faultstring>')
+    if start != -1 and end > start:
+        return body[start + len('<faultstring>'):end]
+    return body[:200]
 
 
 def print_triggered_alarms(entity=None):
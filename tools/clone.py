@@ -0,0 +1,210 @@
+"""
+Template based provisioning.
+
+Builds the specs for three ways of copying a VM:
+
+    'full'     CloneVM_Task, every disk is copied.
+    'linked'   CloneVM_Task from a snapshot of the source with
+               diskMoveType createNewChildDiskBacking: the clone only gets
+               delta disks, so it is created in seconds and writes next to
+               nothing to the datastore.
+    'instant'  InstantClone_Task (vSphere 6.7+) forks a running source VM,
+               memory included. Guest customization is not run, the
+               identity is handed to the guest as guestinfo.* keys instead.
+
+'auto' picks 'instant' for a powered on source on a vCenter that supports
+it, 'linked' for a source with a snapshot and 'full' otherwise.
+
+Usage:
+    custom = customization_spec(si, 'web-01', ip='10.0.0.11',
+                                netmask='255.255.255.0', gateway='10.0.0.1',
+                                dns=['10.0.0.2'], domain='example.com')
+    task = clone(si, template, 'web-01', folder, mode='linked',
+                 pool=pool, customization=custom, power_on=True)
+"""
+from tools import snapshot as snapshots
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+MODES = ('auto', 'full', 'linked', 'instant')
+INSTANT_CLONE_API = (6, 7)
+
+
+def find_snapshot(vm, name=None):
+    """
+    Returns the snapshot named `name` (the current snapshot when None) of
+    `vm`, or None if the VM has no such snapshot.
+    """
+    return snapshots.find_in_tree(vm.snapshot, name)
+
+
+def supports_instant_clone(service_instance):
+    version = service_instance.content.about.apiVersion
+    try:
+        parts = tuple(int(part) for part in version.split('.')[:2])
+    except ValueError:
+        return False
+    return parts >= INSTANT_CLONE_API
+
+
+def choose_mode(service_instance, source, mode='auto'):
+    """
+    Resolves 'auto' to the fastest mode `source` allows.
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown clone mode %r, expected one of %s"
+                         % (mode, ', '.join(MODES)))
+    if mode != 'auto':
+        return mode
+    if (source.runtime.powerState == vim.VirtualMachinePowerState.poweredOn
+            and not source.config.template
+            and supports_instant_clone(service_instance)):
+        return 'instant'
+    if find_snapshot(source) is None:
+        return 'full'
+    return 'linked'
+
+
+def customization_spec(service_instance, hostname, ip=None, netmask=None,
+                       gateway=None, dns=None, domain='', spec_name=None,
+                       time_zone=None):
+    """
+    Returns a vim.vm.customization.Specification setting the hostname and
+    the address of the first NIC (DHCP when `ip` is None).
+
+    With `spec_name` the stored spec of that name is loaded from the
+    CustomizationSpecManager (e.g. a Sysprep spec for Windows guests) and
+    only the hostname and first NIC address are overridden. Otherwise a
+    LinuxPrep spec is built.
+    """
+    if spec_name is not None:
+        manager = service_instance.content.customizationSpecManager
+        spec = manager.GetCustomizationSpec(name=spec_name).spec
+    else:
+        identity = vim.vm.customization.LinuxPrep()
+        identity.domain = domain
+        identity.hwClockUTC = True
+        if time_zone is not None:
+            identity.timeZone = time_zone
+        spec = vim.vm.customization.Specification()
+        spec.identity = identity
+        spec.globalIPSettings = vim.vm.customization.GlobalIPSettings()
+        spec.nicSettingMap = []
+
+    name = vim.vm.customization.FixedName(name=hostname)
+    if isinstance(spec.identity, vim.vm.customization.Sysprep):
+        spec.identity.userData.computerName = name
+    else:
+        spec.identity.hostName = name
+    if dns is not None:
+        spec.globalIPSettings.dnsServerList = list(dns)
+    if domain:
+        spec.globalIPSettings.dnsSuffixList = [domain]
+
+    settings = vim.vm.customization.IPSettings()
+    if ip is None:
+        settings.ip = vim.vm.customization.DhcpIpGenerator()
+    else:
+        settings.ip = vim.vm.customization.FixedIp(ipAddress=ip)
+        settings.subnetMask = netmask
+        if gateway is not None:
+            settings.gateway = [gateway]
+    adapters = list(spec.nicSettingMap or [])
+    if adapters:
+        adapters[0].adapter = settings
+    else:
+        adapters.append(vim.vm.customization.AdapterMapping(adapter=settings))
+    spec.nicSettingMap = adapters
+    return spec
+
+
+def relocate_spec(pool=None, datastore=None, host=None, folder=None,
+                  linked=False):
+    relocate = vim.vm.RelocateSpec()
+    relocate.pool = pool
+    relocate.datastore = datastore
+    relocate.host = host
+    if folder is not None:
+        relocate.folder = folder
+    if linked:
+        relocate.diskMoveType = 'createNewChildDiskBacking'
+    return relocate
+
+
+def clone_spec(source, mode='linked', snapshot=None, pool=None,
+               datastore=None, host=None, customization=None, config=None,
+               power_on=False):
+    """
+    Returns the vim.vm.CloneSpec for a 'full' or 'linked' clone of
+    `source`. A linked clone needs a snapshot: `snapshot` (object or name)
+    or the current snapshot of `source`.
+    """
+    linked = mode == 'linked'
+    spec = vim.vm.CloneSpec()
+    spec.location = relocate_spec(pool=pool, datastore=datastore, host=host,
+                                  linked=linked)
+    spec.powerOn = power_on
+    spec.template = False
+    spec.customization = customization
+    spec.config = config
+    if linked or snapshot is not None:
+        if snapshot is None or isinstance(snapshot, str):
+            name = snapshot
+            snapshot = find_snapshot(source, name)
+            if snapshot is None:
+                raise ValueError("%s has no snapshot %s to clone from"
+                                 % (source.name, name or '(current)'))
+        spec.snapshot = snapshot
+    return spec
+
+
+def instant_clone_spec(vm_name, folder=None, pool=None, datastore=None,
+                       host=None, guestinfo=None):
+    """
+    Returns the vim.vm.InstantCloneSpec for a fork of a running VM.
+    `guestinfo` entries are set as guestinfo.<key> in the clone's
+    extraConfig, for an in-guest script to pick up.
+    """
+    spec = vim.vm.InstantCloneSpec()
+    spec.name = vm_name
+    spec.location = relocate_spec(pool=pool, datastore=datastore, host=host,
+                                  folder=folder)
+    spec.config = [vim.option.OptionValue(key='guestinfo.%s' % key,
+                                          value=value)
+                   for key, value in sorted((guestinfo or {}).items())
+                   if value is not None]
+    return spec
+
+
+def identity_guestinfo(hostname, ip=None, netmask=None, gateway=None,
+                       dns=None, domain=''):
+    """
+    The customization_spec arguments as guestinfo keys, for instant clones.
+    """
+    return {'hostname': hostname, 'ip': ip, 'netmask': netmask,
+            'gateway': gateway, 'dns': ','.join(dns) if dns else None,
+            'domain': domain or None}
+
+
+def clone(service_instance, source, vm_name, folder, mode='auto',
+          snapshot=None, pool=None, datastore=None, host=None,
+          customization=None, guestinfo=None, config=None, power_on=False):
+    """
+    Starts the clone of `source` and returns the task; its result is the
+    new VM. `customization` is ignored for instant clones, pass
+    `guestinfo` instead. An instant clone is running as soon as the task
+    completes, `config` and `power_on` only apply to the other modes.
+    """
+    mode = choose_mode(service_instance, source, mode)
+    if mode == 'instant':
+        spec = instant_clone_spec(vm_name, folder=folder, pool=pool,
+                                  datastore=datastore, host=host,
+                                  guestinfo=guestinfo)
+        return source.InstantClone_Task(spec=spec)
+    spec = clone_spec(source, mode=mode, snapshot=snapshot, pool=pool,
+                      datastore=datastore, host=host,
+                      customization=customization, config=config,
+                      power_on=power_on)
+    return source.CloneVM_Task(folder=folder, name=vm_name, spec=spec)
@@ -15,7 +15,9 @@ Host.Inventory.CreateCluster
 Since
 VI API 2.5
 """
-from pyVmomi import vim
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
 
 
 def create_cluster(**kwargs):
@@ -11,7 +11,9 @@ useful to import into another project where you need to create a datacenter
 then use that object to further configure things like create a cluster or
 adding resources like HostSystems.
 """
-from pyVmomi import vim
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
 
 
 def create_datacenter(dcname=None, service_instance=None, folder=None):
@@ -0,0 +1,279 @@
+"""
+Datastore file transfer over the vCenter /folder HTTP endpoint.
+
+Files are addressed as https://<vcenter>/folder/<path>?dcPath=<datacenter
+path>&dsName=<datastore> and authenticated with the session cookie of the
+service instance, so no second login is needed.
+
+Uploads stream from disk in `chunk_size` reads (the file is never held in
+memory) and hash what they send on the way. Downloads are split into byte
+ranges fetched by a thread pool and written straight to their offset in
+the local file; a server that ignores Range gets one streamed GET instead.
+Both return the hex digest of the data, and compare it with `checksum`
+when one is given. An upload can also be verified end to end by reading it
+back (`verify=True`), which costs one sequential GET of the whole file,
+hashed as it streams. A failed download removes its partial local file.
+
+Usage:
+    transfer = DatastoreTransfer(si)
+    digest = transfer.upload('/isos/centos.iso', 'DC1', 'datastore1',
+                             'iso/centos.iso')
+    transfer.download(datacenter_path(dc), 'datastore1',
+                      'vm-01/vm-01-flat.vmdk', '/backup/vm-01-flat.vmdk',
+                      checksum=expected)
+    iso = datastore_path('datastore1', 'iso/centos.iso')
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+
+from tools.lazy import lazy_import
+
+requests = lazy_import('requests')
+urllib_parse = lazy_import('urllib.parse')
+
+
+CHUNK_SIZE = 1024 * 1024
+PART_SIZE = 64 * 1024 * 1024
+
+
+class ChecksumError(Exception):
+    """
+    Raised when transferred data does not match the expected digest.
+    """
+
+
+def datastore_path(datastore_name, path):
+    """
+    Returns the "[datastore] path" form used by backings such as
+    VirtualCdrom.IsoBackingInfo.fileName.
+    """
+    return '[%s] %s' % (datastore_name, path.lstrip('/'))
+
+
+def find_datacenter(entity):
+    """
+    Returns the datacenter `entity` (a datastore, host, folder...) lives in,
+    or None.
+    """
+    while entity is not None:
+        if entity._wsdlName == 'Datacenter':
+            return entity
+        entity = entity.parent
+    return None
+
+
+def datacenter_path(datacenter):
+    """
+    Returns the inventory path of a datacenter as dcPath expects it, e.g.
+    'Europe/DC1' for a datacenter in folder Europe. The root folder is not
+    part of the path.
+    """
+    names = []
+    entity = datacenter
+    while entity is not None and entity.parent is not None:
+        names.append(entity.name)
+        entity = entity.parent
+    return '/'.join(reversed(names))
+
+
+def file_url(host, datacenter_name, datastore_name, path):
+    """
+    Returns the /folder URL of `path` on a datastore.
+    """
+    query = urllib_parse.urlencode([('dcPath', datacenter_name),
+                                    ('dsName', datastore_name)])
+    return 'https://%s/folder/%s?%s' % (
+        host, urllib_parse.quote(path.lstrip('/')), query)
+
+
+def file_digest(local_path, algorithm='sha256', chunk_size=CHUNK_SIZE):
+    """
+    Returns the hex digest of a local file, read in chunks.
+    """
+    digest = hashlib.new(algorithm)
+    with open(local_path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class _HashingReader(object):
+    """
+    File wrapper handed to requests as the upload body: reads on demand,
+    hashes every chunk and reports its length, so the PUT carries a
+    Content-Length instead of being sent chunked.
+    """
+
+    def __init__(self, local_file, size, digest, chunk_size=CHUNK_SIZE):
+        self._file = local_file
+        self._size = size
+        self._digest = digest
+        self._chunk_size = chunk_size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._chunk_size
+        chunk = self._file.read(size)
+        self._digest.update(chunk)
+        return chunk
+
+
+class DatastoreTransfer(object):
+    """
+    Uploads and downloads datastore files with the session of
+    `service_instance`.
+    """
+
+    def __init__(self, service_instance, max_workers=4, part_size=PART_SIZE,
+                 chunk_size=CHUNK_SIZE, algorithm='sha256', verify_ssl=False,
+                 timeout=300):
+        """
+        - `max_workers` (int) concurrent ranged GETs per download.
+        - `part_size` (int) bytes per range.
+        - `chunk_size` (int) bytes per read/write on either side.
+        - `algorithm` (str) hashlib digest used for checksums.
+        - `timeout` (float) seconds to wait for the server between chunks.
+        """
+        self.service_instance = service_instance
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        self.verify_ssl = verify_ssl
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def http(self):
+        # requests.Session is not thread safe, one per worker thread. The
+        # cookie is read on every call as the session may have been renewed.
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = requests.Session()
+            http.verify = self.verify_ssl
+        http.headers['Cookie'] = self.service_instance._stub.cookie
+        return http
+
+    def url(self, datacenter_name, datastore_name, path):
+        return file_url(self.service_instance._stub.host, datacenter_name,
+                        datastore_name, path)
+
+    def upload(self, local_path, datacenter_name, datastore_name, path,
+               checksum=None, verify=False):
+        """
+        Streams `local_path` to `path` on the datastore, overwriting it.
+        Returns the hex digest of the data sent.
+
+        - `checksum` (str) expected digest of the local file, checked
+          before the upload is reported successful.
+        - `verify` (bool) download the file again and compare digests.
+        """
+        url = self.url(datacenter_name, datastore_name, path)
+        size = os.path.getsize(local_path)
+        digest = hashlib.new(self.algorithm)
+        with open(local_path, 'rb') as local_file:
+            body = _HashingReader(local_file, size, digest, self.chunk_size)
+            response = self.http.put(url, data=body, timeout=self.timeout,
+                                     headers={'Content-Type':
+                                              'application/octet-stream'})
+        response.raise_for_status()
+        sent = digest.hexdigest()
+        logging.debug("Uploaded %s to %s (%d bytes, %s %s)", local_path,
+                      url, size, self.algorithm, sent)
+        _check(local_path, checksum, sent)
+        if verify:
+            stored = self.remote_digest(datacenter_name, datastore_name,
+                                        path)
+            _check(url, sent, stored)
+        return sent
+
+    def download(self, datacenter_name, datastore_name, path, local_path,
+                 checksum=None):
+        """
+        Fetches `path` from the datastore into `local_path` with parallel
+        ranged GETs. Returns the hex digest of the local file. On any
+        error, a checksum mismatch included, `local_path` is removed.
+        """
+        url = self.url(datacenter_name, datastore_name, path)
+        size, ranges = self._probe(url)
+        try:
+            with open(local_path, 'wb') as local_file:
+                if size:
+                    local_file.truncate(size)
+            if ranges and size > self.part_size:
+                parts = [(start, min(start + self.part_size, size) - 1)
+                         for start in range(0, size, self.part_size)]
+                with concurrent.futures.ThreadPoolExecutor(
+                        self.max_workers) as pool:
+                    list(pool.map(lambda part: self._fetch(url, local_path,
+                                                           part),
+                                  parts))
+            else:
+                self._fetch(url, local_path, None)
+            received = file_digest(local_path, self.algorithm,
+                                   self.chunk_size)
+            logging.debug("Downloaded %s to %s (%d bytes, %s %s)", url,
+                          local_path, size, self.algorithm, received)
+            _check(url, checksum, received)
+        except Exception:
+            try:
+                os.remove(local_path)
+            except OSError:
+                pass
+            raise
+        return received
+
+    def remote_digest(self, datacenter_name, datastore_name, path):
+        """
+        Returns the digest of a datastore file, streamed through the hash
+        without touching the local disk. Ranges are hashed in order, so
+        this reads sequentially.
+        """
+        url = self.url(datacenter_name, datastore_name, path)
+        digest = hashlib.new(self.algorithm)
+        response = self.http.get(url, stream=True, timeout=self.timeout)
+        with response:
+            response.raise_for_status()
+            for chunk in response.iter_content(self.chunk_size):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def delete(self, datacenter_name, datastore_name, path):
+        url = self.url(datacenter_name, datastore_name, path)
+        self.http.delete(url, timeout=self.timeout).raise_for_status()
+
+    def _probe(self, url):
+        # (size, whether byte ranges are served) from a HEAD request.
+        response = self.http.head(url, timeout=self.timeout)
+        response.raise_for_status()
+        size = int(response.headers.get('Content-Length') or 0)
+        ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return size, ranges
+
+    def _fetch(self, url, local_path, part):
+        headers = {}
+        if part is not None:
+            headers['Range'] = 'bytes=%d-%d' % part
+        response = self.http.get(url, headers=headers, stream=True,
+                                 timeout=self.timeout)
+        with response:
+            response.raise_for_status()
+            if part is not None and response.status_code != 206:
+                raise IOError("%s ignored the range request %s"
+                              % (url, headers['Range']))
+            with open(local_path, 'r+b') as local_file:
+                local_file.seek(part[0] if part is not None else 0)
+                for chunk in response.iter_content(self.chunk_size):
+                    local_file.write(chunk)
+
+
+def _check(name, expected, actual):
+    if expected is not None and expected.lower() != actual.lower():
+        raise ChecksumError("%s: checksum %s, expected %s"
+                            % (name, actual, expected))
@@ -0,0 +1,432 @@
+"""
+Batched virtual device changes.
+
+Collects NIC, SCSI controller, disk, CD-ROM and floppy specs and submits them
+as one ReconfigVM_Task, or hands them to CreateVM_Task as part of the new
+VM's ConfigSpec. New devices get temporary negative keys so devices added in
+the same batch can reference each other (e.g. a disk on a new controller).
+
+Placement is planned locally against a `DeviceModel`: the VM's device list
+read with one property retrieval and indexed by key, with controllers, used
+and free SCSI/IDE/SATA units, disks and NICs. The model is only read again
+after a reconfigure committed.
+
+Usage:
+    builder = DeviceChangeBuilder(si, vm=vm)
+    builder.add_scsi().add_disk(20, 'thin').add_nic(network).add_cdrom()
+    builder.commit()
+
+    model = DeviceModel.fetch(si, vm)     # reuse for several builders
+    DeviceChangeBuilder(si, vm=vm, model=model).add_disk(10).commit()
+"""
+
+from tools import pchelper
+from tools import tasks
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+# Device keys vCenter assigns to the controllers every new VM gets.
+DEFAULT_PCI_CONTROLLER_KEY = 100
+DEFAULT_IDE_CONTROLLER_KEYS = (200, 201)
+DEFAULT_SIO_CONTROLLER_KEY = 400
+
+SCSI_UNITS = [unit for unit in range(16) if unit != 7]  # 7: controller
+IDE_UNITS = [0, 1]
+SATA_UNITS = list(range(30))
+MAX_SCSI_BUSES = 4
+MAX_SATA_BUSES = 4
+
+UNITS = {'scsi': SCSI_UNITS, 'ide': IDE_UNITS, 'sata': SATA_UNITS}
+
+
+class DeviceModel(object):
+    """
+    Local, indexed copy of a VM's virtual hardware.
+    """
+
+    def __init__(self, devices=(), service_instance=None, vm=None):
+        """
+        - `devices` (list) vm.config.hardware.device, as retrieved.
+        - `service_instance`, `vm` needed by `refresh` only.
+        """
+        self.service_instance = service_instance
+        self.vm = vm
+        self.load(devices)
+
+    @classmethod
+    def fetch(cls, service_instance, vm):
+        """
+        Reads the device list of `vm` with a single property retrieval.
+        """
+        model = cls(service_instance=service_instance, vm=vm)
+        model.refresh()
+        return model
+
+    @classmethod
+    def new_vm(cls):
+        """
+        Model of the controllers vCenter gives every new VM.
+        """
+        model = cls()
+        for bus, key in enumerate(DEFAULT_IDE_CONTROLLER_KEYS):
+            model.add_controller(key, 'ide', bus)
+        model.add_controller(DEFAULT_SIO_CONTROLLER_KEY, 'sio', 0)
+        return model
+
+    def refresh(self):
+        rows = pchelper.collect_objects(self.service_instance, [self.vm],
+                                        vim.VirtualMachine,
+                                        ['config.hardware.device'])
+        self.load(rows[0].get('config.hardware.device') or []
+                  if rows else [])
+
+    def load(self, devices):
+        self.devices = dict((dev.key, dev) for dev in devices)
+        # controller key -> {'kind': 'scsi'|'ide'|'sata'|'sio', 'bus': n}
+        self.controllers = {}
+        # controller key -> set of used unit numbers
+        self.units = {}
+        self.disks = {}
+        self.nics = {}
+        self.cdroms = {}
+        for dev in devices:
+            if isinstance(dev, vim.vm.device.VirtualSCSIController):
+                self.add_controller(dev.key, 'scsi', dev.busNumber)
+            elif isinstance(dev, vim.vm.device.VirtualIDEController):
+                self.add_controller(dev.key, 'ide', dev.busNumber)
+            elif isinstance(dev, vim.vm.device.VirtualAHCIController):
+                self.add_controller(dev.key, 'sata', dev.busNumber)
+            elif isinstance(dev, vim.vm.device.VirtualSIOController):
+                self.add_controller(dev.key, 'sio', dev.busNumber)
+            elif isinstance(dev, vim.vm.device.VirtualDisk):
+                self.disks[dev.key] = dev
+            elif isinstance(dev, vim.vm.device.VirtualEthernetCard):
+                self.nics[dev.key] = dev
+            elif isinstance(dev, vim.vm.device.VirtualCdrom):
+                self.cdroms[dev.key] = dev
+            if dev.controllerKey is not None and dev.unitNumber is not None:
+                self.use(dev.controllerKey, dev.unitNumber)
+
+    def copy(self):
+        """
+        Planning copy: controllers, units and CD-ROMs can be added to it
+        without touching this model. The other device maps are shared.
+        """
+        other = DeviceModel.__new__(DeviceModel)
+        other.__dict__.update(self.__dict__)
+        other.controllers = dict(self.controllers)
+        other.cdroms = dict(self.cdroms)
+        other.units = dict((key, set(used))
+                           for key, used in self.units.items())
+        return other
+
+    @property
+    def has_cdrom(self):
+        return bool(self.cdroms)
+
+    def add_controller(self, key, kind, bus):
+        self.controllers[key] = {'kind': kind, 'bus': bus}
+        self.units.setdefault(key, set())
+
+    def use(self, controller_key, unit_number):
+        self.units.setdefault(controller_key, set()).add(unit_number)
+
+    def controller_keys(self, kind):
+        """
+        Controllers of `kind`, by bus number.
+        """
+        return sorted((key for key, info in self.controllers.items()
+                       if info['kind'] == kind),
+                      key=lambda key: self.controllers[key]['bus'])
+
+    def first_controller(self, kind):
+        keys = self.controller_keys(kind)
+        if not keys:
+            raise ValueError("VM has no %s controller" % kind.upper())
+        return keys[0]
+
+    def free_bus(self, kind, max_buses):
+        buses = set(self.controllers[key]['bus']
+                    for key in self.controller_keys(kind))
+        for bus in range(max_buses):
+            if bus not in buses:
+                return bus
+        return None
+
+    def free_unit(self, controller_key, units=None):
+        if units is None:
+            units = UNITS[self.controllers[controller_key]['kind']]
+        used = self.units.setdefault(controller_key, set())
+        for unit in units:
+            if unit not in used:
+                return unit
+        raise ValueError("Controller %s has no free unit" % controller_key)
+
+    def free_slot(self, kind):
+        """
+        First free (controller key, unit number), or (None, None).
+        """
+        for key in self.controller_keys(kind):
+            used = self.units[key]
+            for unit in UNITS[kind]:
+                if unit not in used:
+                    return key, unit
+        return None, None
+
+
+class DeviceChangeBuilder(object):
+    """
+    Fluent builder for a list of VirtualDeviceSpec "add" operations (and
+    the "edit" that loads an ISO into an existing CD-ROM).
+    """
+
+    def __init__(self, service_instance, vm=None, devices=None,
+                 network_lookup=None, model=None):
+        """
+        - `vm` (vim.VirtualMachine) VM to reconfigure, None when the specs
+          are meant for CreateVM_Task.
+        - `devices` (list) current vm.config.hardware.device, used when no
+          `model` is given.
+        - `model` (DeviceModel) device model of `vm`, shared between
+          builders; read once from `vm` when neither `model` nor `devices`
+          is given. A new VM starts with the default PCI, IDE and SIO
+          controllers. It is refreshed after `commit`.
+        - `network_lookup` (callable) name -> vim.Network, used when
+          `add_nic` receives a network name.
+        """
+        self.service_instance = service_instance
+        self.vm = vm
+        self.network_lookup = network_lookup
+        self.changes = []
+        self._next_key = -1
+        if model is None:
+            if devices is not None:
+                model = DeviceModel(devices, service_instance, vm)
+            elif vm is not None:
+                model = DeviceModel.fetch(service_instance, vm)
+            else:
+                model = DeviceModel.new_vm()
+        self.model = model
+        # Planning state, the model itself only changes on refresh.
+        self._plan = model.copy()
+        self._has_cdrom = model.has_cdrom
+
+    def add_nic(self, network, network_name=None):
+        """
+        Adds a vmxnet3 NIC. `network` is a vim.Network or its name.
+        """
+        if not isinstance(network, vim.Network):
+            network_name = network
+            network = self.network_lookup(network_name)
+        nic = vim.vm.device.VirtualVmxnet3()
+        nic.key = self._new_key()
+        nic.deviceInfo = vim.Description()
+        nic.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+        nic.backing.useAutoDetect = False
+        nic.backing.network = network
+        nic.backing.deviceName = network_name or network.name
+        nic.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+        nic.connectable.startConnected = True
+        nic.connectable.allowGuestControl = True
+        nic.connectable.connected = True
+        nic.connectable.status = 'untried'
+        nic.wakeOnLanEnabled = True
+        nic.addressType = 'generated'
+        return self._add(nic)
+
+    def add_scsi(self):
+        """
+        Adds an LSI Logic controller on the next free SCSI bus.
+        """
+        bus = self._plan.free_bus('scsi', MAX_SCSI_BUSES)
+        if bus is None:
+            raise ValueError("All %d SCSI buses are in use" % MAX_SCSI_BUSES)
+        scsi = vim.vm.device.VirtualLsiLogicController()
+        scsi.key = self._new_key()
+        scsi.deviceInfo = vim.Description()
+        scsi.controllerKey = DEFAULT_PCI_CONTROLLER_KEY
+        scsi.busNumber = bus
+        scsi.hotAddRemove = True
+        scsi.sharedBus = 'noSharing'
+        scsi.scsiCtlrUnitNumber = 7
+        self._plan.add_controller(scsi.key, 'scsi', bus)
+        return self._add(scsi)
+
+    def add_sata(self):
+        """
+        Adds an AHCI (SATA) controller on the next free SATA bus.
+        """
+        bus = self._plan.free_bus('sata', MAX_SATA_BUSES)
+        if bus is None:
+            raise ValueError("All %d SATA buses are in use" % MAX_SATA_BUSES)
+        sata = vim.vm.device.VirtualAHCIController()
+        sata.key = self._new_key()
+        sata.deviceInfo = vim.Description()
+        sata.controllerKey = DEFAULT_PCI_CONTROLLER_KEY
+        sata.busNumber = bus
+        self._plan.add_controller(sata.key, 'sata', bus)
+        return self._add(sata)
+
+    def add_disk(self, disk_size, disk_type='thin', controller_key=None):
+        """
+        Adds a new disk of `disk_size` GB ('thin' or 'thick') on the first
+        SCSI controller with a free unit, adding a controller if needed.
+        """
+        if controller_key is None:
+            controller_key, unit_number = self._plan.free_slot('scsi')
+            if controller_key is None:
+                self.add_scsi()
+                controller_key, unit_number = self._plan.free_slot('scsi')
+        else:
+            unit_number = self._plan.free_unit(controller_key)
+        disk = vim.vm.device.VirtualDisk()
+        disk.key = self._new_key()
+        disk.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
+        if disk_type == 'thin':
+            disk.backing.thinProvisioned = True
+        disk.backing.diskMode = 'persistent'
+        disk.capacityInKB = int(disk_size) * 1024 * 1024
+        disk.controllerKey = controller_key
+        disk.unitNumber = unit_number
+        self._plan.use(controller_key, unit_number)
+        return self._add(disk, file_operation='create')
+
+    def add_cdrom(self, iso_path=None):
+        """
+        Adds a client passthrough CD-ROM on the first free IDE slot, or on
+        a SATA controller when both IDE channels are taken.
+
+        - `iso_path` (str) "[datastore] path" of an ISO image to back the
+          drive with instead, see tools.datastore.datastore_path.
+        """
+        controller_key, unit_number = self._plan.free_slot('ide')
+        if controller_key is None:
+            controller_key, unit_number = self._plan.free_slot('sata')
+        if controller_key is None:
+            self.add_sata()
+            controller_key, unit_number = self._plan.free_slot('sata')
+        cdrom = vim.vm.device.VirtualCdrom()
+        cdrom.key = self._new_key()
+        cdrom.deviceInfo = vim.Description()
+        cdrom.backing = _cdrom_backing(iso_path)
+        cdrom.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+        cdrom.connectable.allowGuestControl = True
+        cdrom.connectable.startConnected = True
+        cdrom.controllerKey = controller_key
+        cdrom.unitNumber = unit_number
+        self._plan.use(controller_key, unit_number)
+        self._plan.cdroms[cdrom.key] = cdrom
+        self._has_cdrom = True
+        return self._add(cdrom)
+
+    def insert_iso(self, iso_path):
+        """
+        Backs the VM's first CD-ROM with the ISO at `iso_path` ("[datastore]
+        path") and connects it. A CD-ROM added earlier in this batch is
+        used when the VM has none, one is added when there is neither.
+        """
+        if not self._plan.cdroms:
+            return self.add_cdrom(iso_path)
+        # Existing drives first, then pending ones (negative keys) in the
+        # order they were added.
+        current = self._plan.cdroms[min(self._plan.cdroms,
+                                        key=lambda key: (key < 0, abs(key)))]
+        if current.key < 0:
+            # Not created yet: change the pending "add" instead of editing.
+            current.backing = _cdrom_backing(iso_path)
+            return self
+        # A fresh device with the same key, the model's copy stays as read.
+        cdrom = vim.vm.device.VirtualCdrom()
+        cdrom.key = current.key
+        cdrom.controllerKey = current.controllerKey
+        cdrom.unitNumber = current.unitNumber
+        cdrom.backing = _cdrom_backing(iso_path)
+        cdrom.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+        cdrom.connectable.allowGuestControl = True
+        cdrom.connectable.startConnected = True
+        cdrom.connectable.connected = self.vm is not None
+        return self._add(cdrom,
+                         operation=vim.vm.device.VirtualDeviceSpec.Operation.edit)
+
+    def add_floppy(self):
+        """
+        Adds a client device floppy drive on the SIO controller.
+        """
+        controller_key = self._plan.first_controller('sio')
+        floppy = vim.vm.device.VirtualFloppy()
+        floppy.key = self._new_key()
+        floppy.deviceInfo = vim.Description()
+        floppy.backing = vim.vm.device.VirtualFloppy.RemoteDeviceBackingInfo()
+        floppy.backing.deviceName = ''
+        floppy.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
+        floppy.connectable.allowGuestControl = True
+        floppy.connectable.startConnected = False
+        floppy.controllerKey = controller_key
+        return self._add(floppy)
+
+    @property
+    def has_cdrom(self):
+        return self._has_cdrom
+
+    def config_spec(self, config=None):
+        """
+        Returns `config` (a new ConfigSpec by default) with the collected
+        changes appended to its deviceChange list.
+        """
+        if config is None:
+            config = vim.vm.ConfigSpec()
+        config.deviceChange = list(config.deviceChange or []) + self.changes
+        return config
+
+    def submit(self):
+        """
+        Starts one ReconfigVM_Task with every collected change and returns
+        the task without waiting.
+        """
+        if self.vm is None:
+            raise ValueError("No vm to reconfigure, pass the builder to "
+                             "create_vm instead")
+        return self.vm.ReconfigVM_Task(spec=self.config_spec())
+
+    def commit(self):
+        """
+        Submits the changes, waits for the reconfigure task and refreshes
+        the device model, so the builder can be reused.
+        """
+        if not self.changes:
+            return
+        task = self.submit()
+        tasks.wait_for_tasks(self.service_instance, [task])
+        self.changes = []
+        self._next_key = -1
+        self.model.service_instance = self.service_instance
+        self.model.vm = self.vm
+        self.model.refresh()
+        self._plan = self.model.copy()
+        self._has_cdrom = self.model.has_cdrom
+
+    def _add(self, device, file_operation=None, operation=None):
+        spec = vim.vm.device.VirtualDeviceSpec()
+        spec.operation = (operation or
+                          vim.vm.device.VirtualDeviceSpec.Operation.add)
+        if file_operation:
+            spec.fileOperation = file_operation
+        spec.device = device
+        self.changes.append(spec)
+        return self
+
+    def _new_key(self):
+        key = self._next_key
+        self._next_key -= 1
+        return key
+
+
+def _cdrom_backing(iso_path=None):
+    if iso_path is not None:
+        return vim.vm.device.VirtualCdrom.IsoBackingInfo(fileName=iso_path)
+    backing = vim.vm.device.VirtualCdrom.RemotePassthroughBackingInfo()
+    backing.deviceName = ''
+    backing.exclusive = False
+    return backing
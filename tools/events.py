@@ -0,0 +1,304 @@
+"""
+vCenter event stream.
+
+Events are read through an EventHistoryCollector
+(EventManager.CreateCollectorForEvents) one page at a time with
+ReadNextEvents and yielded as compact `EventRecord`s, oldest first.
+Filters narrow the stream down by entity, event type and time window. A
+`Checkpoint` remembers the last event key on disk, so the next run
+resumes where the previous one stopped (delivery is at-least-once, a
+consumer killed mid-page may see a few events again).
+
+`EventFeed` follows the stream in a background thread and turns VM, host
+and datastore lifecycle events into update()/remove() calls on local
+caches such as `tools.objindex.InventoryIndex`.
+
+Usage:
+    for record in iter_events(si, types=['VmCreatedEvent'],
+                              begin=datetime.datetime(2020, 1, 1),
+                              checkpoint=Checkpoint('/var/tmp/vc.ckpt')):
+        print(record.key, record.type, record.entity_name)
+
+    feed = EventFeed(si, caches=[index]).start()
+    ...
+    feed.stop()
+"""
+import calendar
+import collections
+import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+EventRecord = collections.namedtuple(
+    'EventRecord', ['key', 'chain_id', 'type', 'created', 'user', 'message',
+                    'entity', 'entity_name', 'new_name'])
+
+# (event attribute, EntityEventArgument attribute), most specific first:
+# a VM event also names its host, datacenter, ...
+ENTITY_ARGUMENTS = (('vm', 'vm'), ('host', 'host'), ('ds', 'datastore'),
+                    ('net', 'network'), ('dvs', 'dvs'),
+                    ('computeResource', 'computeResource'),
+                    ('datacenter', 'datacenter'))
+
+# Host events about a datastore: their subject is the datastore, not the
+# host they also name.
+DATASTORE_HOST_EVENTS = ('DatastoreDiscoveredEvent',
+                         'DatastoreRemovedOnHostEvent')
+
+CREATE_EVENTS = ('VmCreatedEvent', 'VmClonedEvent', 'VmDeployedEvent',
+                 'VmRegisteredEvent', 'VmInstanceClonedEvent',
+                 'HostAddedEvent', 'DatastoreDiscoveredEvent')
+RENAME_EVENTS = ('VmRenamedEvent', 'DatastoreRenamedEvent',
+                 'DvsRenamedEvent')
+# DatastoreRemovedOnHostEvent is an unmount from one host, the datastore
+# itself lives on.
+REMOVE_EVENTS = ('VmRemovedEvent', 'HostRemovedEvent',
+                 'DatastoreDestroyedEvent')
+
+UTC = datetime.timezone.utc
+
+
+def event_filter(entity=None, recursion='all', types=None, begin=None,
+                 end=None):
+    """
+    Returns a vim.event.EventFilterSpec.
+
+    - `entity` (vim.ManagedEntity) only events about this entity and,
+      depending on `recursion` ('self', 'children' or 'all'), its
+      descendants.
+    - `types` (list) event type ids, e.g. ['VmPoweredOnEvent'].
+    - `begin`, `end` (datetime) time window, both optional.
+    """
+    spec = vim.event.EventFilterSpec()
+    if entity is not None:
+        spec.entity = vim.event.EventFilterSpec.ByEntity(entity=entity,
+                                                          recursion=recursion)
+    if types:
+        spec.eventTypeId = list(types)
+    if begin is not None or end is not None:
+        spec.time = vim.event.EventFilterSpec.ByTime(beginTime=begin,
+                                                      endTime=end)
+    return spec
+
+
+def to_record(event):
+    """
+    Compacts a vim.event.Event into an EventRecord.
+    """
+    if isinstance(event, vim.event.EventEx):
+        event_type = event.eventTypeId
+    else:
+        event_type = event._wsdlName
+    arguments = ENTITY_ARGUMENTS
+    if event_type in DATASTORE_HOST_EVENTS:
+        arguments = (('datastore', 'datastore'),)
+    entity = None
+    entity_name = None
+    for name, entity_attribute in arguments:
+        argument = getattr(event, name, None)
+        if argument is not None:
+            entity = getattr(argument, entity_attribute, None)
+            entity_name = argument.name
+            break
+    return EventRecord(key=event.key,
+                       chain_id=event.chainId,
+                       type=event_type,
+                       created=event.createdTime,
+                       user=event.userName,
+                       message=event.fullFormattedMessage,
+                       entity=entity,
+                       entity_name=entity_name,
+                       new_name=getattr(event, 'newName', None))
+
+
+class Checkpoint(object):
+    """
+    Last processed event key and time, kept in a small JSON file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Returns (key, created) of the last saved event, or (None, None).
+        """
+        try:
+            with open(self.path) as checkpoint_file:
+                data = json.load(checkpoint_file)
+        except (IOError, OSError, ValueError):
+            return None, None
+        created = datetime.datetime.fromtimestamp(data['time'], UTC)
+        return data['key'], created
+
+    def save(self, record):
+        timestamp = _timestamp(record.created)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.checkpoint')
+        try:
+            with os.fdopen(fd, 'w') as checkpoint_file:
+                json.dump({'key': record.key, 'time': timestamp},
+                          checkpoint_file)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def iter_events(service_instance, entity=None, recursion='all', types=None,
+                begin=None, end=None, checkpoint=None, page_size=100,
+                follow=False, poll_seconds=10, stop=None):
+    """
+    Yields EventRecords matching the filter, oldest first.
+
+    - `checkpoint` (Checkpoint) resume after the saved event; saved after
+      every page and when the generator is closed. A record counts as
+      processed once the consumer asks for the next one, so the record
+      being handled when the consumer raises or breaks out of the loop is
+      delivered again on the next run.
+    - `page_size` (int) events per ReadNextEvents call (max 1000).
+    - `follow` (bool) keep polling for new events every `poll_seconds`
+      instead of returning at the end of the history, until `stop`
+      (threading.Event) is set.
+    """
+    last_key = None
+    if checkpoint is not None:
+        last_key, last_time = checkpoint.load()
+        if last_time is not None and (
+                begin is None or _timestamp(last_time) > _timestamp(begin)):
+            # Same-second events before the checkpoint are skipped by key.
+            begin = last_time
+    spec = event_filter(entity=entity, recursion=recursion, types=types,
+                        begin=begin, end=end)
+    manager = service_instance.content.eventManager
+    collector = manager.CreateCollectorForEvents(filter=spec)
+    stop = stop or threading.Event()
+    # Last record the consumer came back from: only records it has moved
+    # past are checkpointed, the one it is handling when it fails is not.
+    done = None
+    try:
+        collector.RewindCollector()
+        while not stop.is_set():
+            page = collector.ReadNextEvents(maxCount=page_size)
+            if not page:
+                if not follow or stop.wait(poll_seconds):
+                    break
+                continue
+            for event in page:
+                if last_key is not None and event.key <= last_key:
+                    continue
+                record = to_record(event)
+                yield record
+                done = record
+            if checkpoint is not None and done is not None:
+                checkpoint.save(done)
+    finally:
+        if checkpoint is not None and done is not None:
+            checkpoint.save(done)
+        try:
+            collector.DestroyCollector()
+        except Exception:
+            logging.debug("DestroyCollector failed", exc_info=True)
+
+
+def apply_record(record, cache):
+    """
+    Applies one lifecycle event to `cache`, anything with update(obj,
+    properties) and remove(obj) like tools.objindex.InventoryIndex.
+    Returns True when the event changed the cache.
+    """
+    if record.entity is None:
+        return False
+    if record.type in CREATE_EVENTS:
+        cache.update(record.entity, {'name': record.entity_name})
+    elif record.type in RENAME_EVENTS:
+        cache.update(record.entity, {'name': record.new_name})
+    elif record.type in REMOVE_EVENTS:
+        cache.remove(record.entity)
+    else:
+        return False
+    return True
+
+
+class EventFeed(object):
+    """
+    Follows the event stream in a background thread and feeds caches and
+    callbacks.
+    """
+
+    def __init__(self, service_instance, caches=None, callbacks=None,
+                 checkpoint=None, poll_seconds=10, **filters):
+        """
+        - `caches` (list) objects updated through `apply_record`.
+        - `callbacks` (list) called with every EventRecord.
+        - `filters` entity, recursion, types, begin: see `iter_events`.
+          Without `begin` and `checkpoint` the feed starts now.
+        """
+        self.service_instance = service_instance
+        self.caches = list(caches or [])
+        self.callbacks = list(callbacks or [])
+        self.checkpoint = checkpoint
+        self.poll_seconds = poll_seconds
+        self.filters = filters
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return self
+        if 'begin' not in self.filters and self.checkpoint is None:
+            self.filters['begin'] = self.service_instance.CurrentTime()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='vcenter-events')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                for record in iter_events(self.service_instance,
+                                          checkpoint=self.checkpoint,
+                                          follow=True,
+                                          poll_seconds=self.poll_seconds,
+                                          stop=self._stop, **self.filters):
+                    self._dispatch(record)
+                    # Resume from here if the collector has to be rebuilt.
+                    self.filters['begin'] = record.created
+            except Exception:
+                logging.warning("Event feed failed, restarting",
+                                exc_info=True)
+                self._stop.wait(self.poll_seconds)
+
+    def _dispatch(self, record):
+        for cache in self.caches:
+            try:
+                apply_record(record, cache)
+            except Exception:
+                logging.warning("Applying event %s failed", record.key,
+                                exc_info=True)
+        for callback in self.callbacks:
+            try:
+                callback(record)
+            except Exception:
+                logging.warning("Event callback failed", exc_info=True)
+
+
+def _timestamp(value):
+    # Seconds since the epoch; naive datetimes are taken as UTC.
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
@@ -0,0 +1,248 @@
+"""
+Streaming inventory export for the CMDB.
+
+Hosts, VMs, disks and NICs are streamed page by page from the property
+collector and written out immediately as newline-delimited JSON or CSV, so
+memory stays bounded whatever the inventory size. With --split every object
+type goes to its own file and hosts and VMs are collected in parallel.
+
+Usage:
+    python -m tools.export -s vcenter -u user --format jsonl -O inventory.jsonl
+    python -m tools.export -s vcenter -u user --format csv --split /tmp/cmdb
+"""
+import csv
+import json
+import os
+import sys
+import threading
+
+from tools import cli
+from tools import pchelper
+from tools import session
+from tools.lazy import lazy_import
+
+Disconnect = lazy_import('pyVim.connect', 'Disconnect')
+vim = lazy_import('pyVmomi', 'vim')
+
+
+HOST_PROPERTIES = [
+    'name',
+    'summary.hardware',
+    'summary.quickStats.overallCpuUsage',
+    'summary.quickStats.overallMemoryUsage',
+    'summary.config.product.fullName',
+]
+
+VM_PROPERTIES = [
+    'name',
+    'runtime.host',
+    'runtime.powerState',
+    'config.hardware.numCPU',
+    'config.hardware.memoryMB',
+    'config.hardware.device',
+    'config.guestFullName',
+    'guest.ipAddress',
+]
+
+FIELDS = {
+    'host': ['moref', 'name', 'vendor', 'model', 'serial', 'cpu_pkgs',
+             'cpu_cores', 'cpu_threads', 'cpu_mhz', 'cpu_model',
+             'cpu_usage_mhz', 'memory_mb', 'memory_usage_mb', 'product'],
+    'vm': ['moref', 'name', 'host', 'power_state', 'num_cpu', 'memory_mb',
+           'guest', 'ip'],
+    'disk': ['vm', 'vm_name', 'key', 'label', 'capacity_gb', 'file_name',
+             'thin'],
+    'nic': ['vm', 'vm_name', 'key', 'label', 'mac', 'network'],
+}
+
+
+def iter_hosts(service_instance, page_size=500):
+    """
+    Yields ('host', record) for every ESXi host.
+    """
+    view_ref = pchelper.get_container_view(service_instance,
+                                           obj_type=[vim.HostSystem])
+    try:
+        for row in pchelper.iter_properties(service_instance, view_ref,
+                                            vim.HostSystem, HOST_PROPERTIES,
+                                            include_mors=True,
+                                            page_size=page_size):
+            yield 'host', host_record(row)
+    finally:
+        view_ref.Destroy()
+
+
+def iter_vms(service_instance, page_size=500):
+    """
+    Yields ('vm', record) for every VM, each followed by its ('disk', ...)
+    and ('nic', ...) records.
+    """
+    view_ref = pchelper.get_container_view(service_instance,
+                                           obj_type=[vim.VirtualMachine])
+    try:
+        for row in pchelper.iter_properties(service_instance, view_ref,
+                                            vim.VirtualMachine, VM_PROPERTIES,
+                                            include_mors=True,
+                                            page_size=page_size):
+            for record in vm_records(row):
+                yield record
+    finally:
+        view_ref.Destroy()
+
+
+def host_record(row):
+    hardware = row.get('summary.hardware')
+    record = {'moref': row['obj']._moId, 'name': row.get('name'),
+              'cpu_usage_mhz': row.get('summary.quickStats.overallCpuUsage'),
+              'memory_usage_mb': row.get(
+                  'summary.quickStats.overallMemoryUsage'),
+              'product': row.get('summary.config.product.fullName')}
+    if hardware is not None:
+        record.update(vendor=hardware.vendor, model=hardware.model,
+                      cpu_pkgs=hardware.numCpuPkgs,
+                      cpu_cores=hardware.numCpuCores,
+                      cpu_threads=hardware.numCpuThreads,
+                      cpu_mhz=hardware.cpuMhz, cpu_model=hardware.cpuModel,
+                      memory_mb=hardware.memorySize // 1024 // 1024)
+        for info in hardware.otherIdentifyingInfo or []:
+            if isinstance(info, vim.host.SystemIdentificationInfo):
+                record['serial'] = info.identifierValue
+    return record
+
+
+def vm_records(row):
+    moref = row['obj']._moId
+    name = row.get('name')
+    host = row.get('runtime.host')
+    yield 'vm', {'moref': moref, 'name': name,
+                 'host': host._moId if host is not None else None,
+                 'power_state': row.get('runtime.powerState'),
+                 'num_cpu': row.get('config.hardware.numCPU'),
+                 'memory_mb': row.get('config.hardware.memoryMB'),
+                 'guest': row.get('config.guestFullName'),
+                 'ip': row.get('guest.ipAddress')}
+    for dev in row.get('config.hardware.device') or []:
+        if isinstance(dev, vim.vm.device.VirtualDisk):
+            yield 'disk', {'vm': moref, 'vm_name': name, 'key': dev.key,
+                           'label': dev.deviceInfo.label,
+                           'capacity_gb': dev.capacityInKB / 1024.0 / 1024,
+                           'file_name': getattr(dev.backing, 'fileName',
+                                                None),
+                           'thin': getattr(dev.backing, 'thinProvisioned',
+                                           None)}
+        elif isinstance(dev, vim.vm.device.VirtualEthernetCard):
+            yield 'nic', {'vm': moref, 'vm_name': name, 'key': dev.key,
+                          'label': dev.deviceInfo.label,
+                          'mac': dev.macAddress,
+                          'network': getattr(dev.backing, 'deviceName',
+                                             None)}
+
+
+class JsonlWriter(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, kind, record):
+        data = dict(record, type=kind)
+        self.stream.write(json.dumps(data, default=str, sort_keys=True))
+        self.stream.write('\n')
+
+
+class CsvWriter(object):
+
+    def __init__(self, stream, kinds):
+        fields = ['type']
+        for kind in kinds:
+            fields.extend(field for field in FIELDS[kind]
+                          if field not in fields)
+        self.writer = csv.DictWriter(stream, fieldnames=fields,
+                                     extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, kind, record):
+        self.writer.writerow(dict(record, type=kind))
+
+
+def make_writer(fmt, stream, kinds):
+    if fmt == 'csv':
+        return CsvWriter(stream, kinds)
+    return JsonlWriter(stream)
+
+
+def export(service_instance, stream, fmt='jsonl', page_size=500):
+    """
+    Writes hosts, VMs, disks and NICs to one stream.
+    """
+    writer = make_writer(fmt, stream, sorted(FIELDS))
+    for source in (iter_hosts, iter_vms):
+        for kind, record in source(service_instance, page_size=page_size):
+            writer.write(kind, record)
+
+
+def export_split(service_instance, directory, fmt='jsonl', page_size=500):
+    """
+    Writes one file per object type into `directory`; hosts and VMs are
+    collected in parallel threads. Returns the paths written.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = dict((kind, os.path.join(directory, '%s.%s' % (kind, fmt)))
+                 for kind in FIELDS)
+    errors = []
+
+    def run(source, kinds):
+        streams = dict((kind, open(paths[kind], 'w', newline=''))
+                       for kind in kinds)
+        try:
+            writers = dict((kind, make_writer(fmt, streams[kind], [kind]))
+                           for kind in kinds)
+            for kind, record in source(service_instance,
+                                       page_size=page_size):
+                writers[kind].write(kind, record)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            for stream in streams.values():
+                stream.close()
+
+    threads = [threading.Thread(target=run, args=(iter_hosts, ['host'])),
+               threading.Thread(target=run,
+                                args=(iter_vms, ['vm', 'disk', 'nic']))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return paths
+
+
+def main():
+    parser = cli.build_arg_parser()
+    parser.add_argument('--format', choices=['jsonl', 'csv'],
+                        default='jsonl', help='Output format')
+    parser.add_argument('-O', '--output', default='-',
+                        help='Output file, - for stdout')
+    parser.add_argument('--split', metavar='DIR',
+                        help='Write one file per object type into DIR')
+    parser.add_argument('--page-size', type=int, default=500,
+                        help='Objects per property collector round trip')
+    args = cli.prompt_for_password(parser.parse_args())
+    si = session.connect(host=args.host, user=args.user, pwd=args.password,
+                         port=args.port)
+    try:
+        if args.split:
+            export_split(si, args.split, fmt=args.format,
+                         page_size=args.page_size)
+        elif args.output == '-':
+            export(si, sys.stdout, fmt=args.format, page_size=args.page_size)
+        else:
+            with open(args.output, 'w', newline='') as stream:
+                export(si, stream, fmt=args.format, page_size=args.page_size)
+    finally:
+        Disconnect(si)
+
+
+if __name__ == '__main__':
+    main()
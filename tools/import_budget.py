@@ -0,0 +1,101 @@
+"""
+Import-time budget check for the API clients.
+
+Each client module is imported in a fresh interpreter, best of `--runs`, and
+the time spent in the import is compared to its budget. The import must also
+leave the heavy dependencies (pyVmomi, requests, xmlrpc, numpy) unloaded;
+they are imported on first use. Exits non-zero when a module is over budget
+or pulls in a heavy dependency, so it can run as a CI step.
+
+Usage:
+    python -m tools.import_budget
+    python -m tools.import_budget --runs 10 --scale 2
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Milliseconds, measured inside the child, interpreter startup excluded.
+BUDGETS = {
+    'cobbler_api': 30,
+    'saltstack_api': 30,
+    'idrac_api': 30,
+    'vcenter_api': 60,
+}
+
+HEAVY_MODULES = ['pyVmomi', 'pyVim', 'requests', 'urllib3', 'xmlrpc.client',
+                 'numpy']
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = (time.perf_counter() - start) * 1000
+print(json.dumps({'ms': elapsed,
+                  'loaded': [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module, runs=5):
+    """
+    Returns (best import time in ms, heavy modules loaded by the import).
+    """
+    best = None
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', PROBE, module] + HEAVY_MODULES,
+            cwd=ROOT)
+        result = json.loads(output.decode('utf-8'))
+        loaded.update(result['loaded'])
+        if best is None or result['ms'] < best:
+            best = result['ms']
+    return best, sorted(loaded)
+
+
+def check(budgets=None, runs=5, scale=1.0):
+    """
+    Measures every module in `budgets` and returns a list of
+    (module, ms, budget_ms, loaded, ok).
+    """
+    results = []
+    for module, budget in sorted((budgets or BUDGETS).items()):
+        budget = budget * scale
+        ms, loaded = measure(module, runs=runs)
+        results.append((module, ms, budget, loaded,
+                        ms <= budget and not loaded))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Fresh interpreters per module, best run counts')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiply every budget, e.g. on slow CI hosts')
+    parser.add_argument('modules', nargs='*',
+                        help='Modules to check, default all in BUDGETS')
+    args = parser.parse_args()
+    budgets = BUDGETS
+    if args.modules:
+        budgets = dict((module, BUDGETS.get(module, BUDGETS['vcenter_api']))
+                       for module in args.modules)
+    failed = False
+    for module, ms, budget, loaded, ok in check(budgets, runs=args.runs,
+                                                scale=args.scale):
+        failed = failed or not ok
+        print('%-16s %7.1f ms  budget %6.1f ms  %s%s' % (
+            module, ms, budget, 'ok' if ok else 'FAIL',
+            '  loaded: ' + ', '.join(loaded) if loaded else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,391 @@
+"""
+SOAP call instrumentation.
+
+`instrument(si)` wraps the InvokeMethod of the connection's stub, so every
+SOAP call made through it is recorded: method, managed object type,
+latency, request and response bytes and, for failed calls, the fault
+type. Bytes are counted on the HTTP connection the stub borrows from its
+pool, so they are the sizes on the wire (compressed, when the server
+compresses). Nothing changes for connections that are not instrumented.
+
+Calls are aggregated in process into Prometheus style histograms and can be
+read as Prometheus text exposition (`SoapStats.prometheus`) or as a
+human readable per-run summary (`SoapStats.summary`). With
+`track_callers=True` every call is also charged to the first frame outside
+pyVmomi and this package's plumbing, which is what exposes hot paths such
+as a lookup or a property read inside a loop.
+
+Property reads on managed objects (vm.name) show up as
+PropertyCollector.RetrieveContents calls.
+
+Usage:
+    stats = instrument(si, track_callers=True)
+    ...
+    print(stats.summary())
+    open('/var/lib/node_exporter/vcenter.prom', 'w').write(
+        stats.prometheus())
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+SIZE_BUCKETS = tuple(2 ** exponent for exponent in range(10, 27, 2))
+
+# Frames from these directories are skipped when charging a call to a
+# caller.
+_PLUMBING = ('pyVmomi', 'pyVim', os.path.join('tools', 'instrument.py'),
+             os.path.join('tools', 'pchelper.py'),
+             os.path.join('tools', 'lazy.py'))
+
+
+class Histogram(object):
+    """
+    Cumulative-bucket histogram, as exposed by Prometheus.
+    """
+
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        """
+        Returns [(upper bound, observations <= bound)], '+Inf' last.
+        """
+        result = []
+        running = 0
+        for bound, count in zip(self.bounds, self.counts):
+            running += count
+            result.append((bound, running))
+        result.append(('+Inf', self.count))
+        return result
+
+
+class CallStats(object):
+    """
+    Aggregates of one (method, managed object type) pair.
+    """
+
+    __slots__ = ('latency', 'request_bytes', 'response_bytes', 'faults',
+                 'max_latency')
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.request_bytes = Histogram(SIZE_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.faults = collections.Counter()
+        self.max_latency = 0.0
+
+
+class SoapStats(object):
+    """
+    Thread-safe, in-process aggregation of SOAP calls.
+    """
+
+    def __init__(self, track_callers=False):
+        self.track_callers = track_callers
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._calls = {}
+        # (method, type, "file:line function") -> [calls, seconds]
+        self._callers = collections.defaultdict(lambda: [0, 0.0])
+
+    def record(self, method, obj_type, seconds, request_bytes=0,
+               response_bytes=0, fault=None, caller=None):
+        with self._lock:
+            key = (method, obj_type)
+            stats = self._calls.get(key)
+            if stats is None:
+                stats = self._calls[key] = CallStats()
+            stats.latency.observe(seconds)
+            stats.request_bytes.observe(request_bytes)
+            stats.response_bytes.observe(response_bytes)
+            stats.max_latency = max(stats.max_latency, seconds)
+            if fault is not None:
+                stats.faults[fault] += 1
+            if caller is not None:
+                entry = self._callers[(method, obj_type, caller)]
+                entry[0] += 1
+                entry[1] += seconds
+
+    def reset(self):
+        with self._lock:
+            self._calls.clear()
+            self._callers.clear()
+            self.started = time.monotonic()
+
+    def calls(self):
+        """
+        Returns {(method, type): CallStats}, a snapshot.
+        """
+        with self._lock:
+            return dict(self._calls)
+
+    def prometheus(self, prefix='vcenter_soap', labels=None):
+        """
+        Returns the aggregates in Prometheus text exposition format.
+
+        - `labels` (dict) extra labels on every sample, e.g.
+          {'script': 'nightly_export', 'vcenter': 'vc01'}.
+        """
+        extra = sorted((labels or {}).items())
+        lines = []
+        with self._lock:
+            calls = sorted(self._calls.items())
+            histograms = (
+                ('latency_seconds', 'SOAP call latency.',
+                 lambda stats: stats.latency),
+                ('request_bytes', 'SOAP request size.',
+                 lambda stats: stats.request_bytes),
+                ('response_bytes', 'SOAP response size.',
+                 lambda stats: stats.response_bytes),
+            )
+            for suffix, help_text, select in histograms:
+                name = '%s_%s' % (prefix, suffix)
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s histogram' % name)
+                for (method, obj_type), stats in calls:
+                    base = extra + [('method', method), ('type', obj_type)]
+                    histogram = select(stats)
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket%s %d' % (
+                            name, _labels(base + [('le', _number(bound))]),
+                            count))
+                    lines.append('%s_sum%s %s' % (name, _labels(base),
+                                                  _number(histogram.total)))
+                    lines.append('%s_count%s %d' % (name, _labels(base),
+                                                    histogram.count))
+            name = '%s_faults_total' % prefix
+            lines.append('# HELP %s SOAP calls that raised a fault.' % name)
+            lines.append('# TYPE %s counter' % name)
+            for (method, obj_type), stats in calls:
+                for fault, count in sorted(stats.faults.items()):
+                    lines.append('%s%s %d' % (name, _labels(
+                        extra + [('method', method), ('type', obj_type),
+                                 ('fault', fault)]), count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, top=10):
+        """
+        Returns a plain text report: totals for the run, the `top` calls by
+        total time and, when callers are tracked, the busiest call sites.
+        """
+        with self._lock:
+            calls = list(self._calls.items())
+            callers = list(self._callers.items())
+        elapsed = time.monotonic() - self.started
+        count = sum(stats.latency.count for _, stats in calls)
+        seconds = sum(stats.latency.total for _, stats in calls)
+        sent = sum(stats.request_bytes.total for _, stats in calls)
+        received = sum(stats.response_bytes.total for _, stats in calls)
+        faults = sum(sum(stats.faults.values()) for _, stats in calls)
+        lines = ['%d SOAP calls in %.1fs of %.1fs run time, %s sent, '
+                 '%s received, %d faults'
+                 % (count, seconds, elapsed, _size(sent), _size(received),
+                    faults)]
+        if calls:
+            lines.append('')
+            lines.append('%-45s %7s %9s %9s %9s %9s' % (
+                'method', 'calls', 'total s', 'avg ms', 'max ms', 'recv'))
+            calls.sort(key=lambda item: item[1].latency.total, reverse=True)
+            for (method, obj_type), stats in calls[:top]:
+                latency = stats.latency
+                lines.append('%-45s %7d %9.2f %9.1f %9.1f %9s' % (
+                    '%s.%s' % (obj_type, method), latency.count,
+                    latency.total, latency.total * 1000 / latency.count,
+                    stats.max_latency * 1000,
+                    _size(stats.response_bytes.total)))
+        if callers:
+            lines.append('')
+            lines.append('%-45s %7s %9s  %s' % ('method', 'calls', 'total s',
+                                                'caller'))
+            callers.sort(key=lambda item: item[1][0], reverse=True)
+            for (method, obj_type, caller), (hits, total) in callers[:top]:
+                lines.append('%-45s %7d %9.2f  %s' % (
+                    '%s.%s' % (obj_type, method), hits, total, caller))
+        return '\n'.join(lines)
+
+
+class _CountingResponse(object):
+    """
+    Proxy of an HTTPResponse counting the bytes read from it.
+    """
+
+    def __init__(self, response, counter):
+        self._response = response
+        self._counter = counter
+
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._counter['response'] += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class _CountingConnection(object):
+    """
+    Proxy of a pooled HTTP connection charging request and response sizes
+    to the call running on the current thread.
+    """
+
+    def __init__(self, connection, local):
+        self._connection = connection
+        self._local = local
+
+    def request(self, method, url, body=None, headers=None, *args,
+                **kwargs):
+        counter = getattr(self._local, 'counter', None)
+        if counter is not None and body is not None:
+            counter['request'] += len(body)
+        return self._connection.request(method, url, body, headers or {},
+                                        *args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = self._connection.getresponse(*args, **kwargs)
+        counter = getattr(self._local, 'counter', None)
+        if counter is None:
+            return response
+        return _CountingResponse(response, counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def instrument(service_instance, stats=None, track_callers=False):
+    """
+    Starts recording the SOAP calls of `service_instance` and returns the
+    SoapStats they go to. Calling it again returns the stats already in
+    use.
+
+    - `stats` (SoapStats) share one aggregate between several connections.
+    - `track_callers` (bool) charge calls to their call site too; walks the
+      stack on every call, so it is meant for investigations.
+    """
+    stub = service_instance._stub
+    current = getattr(stub, '_soap_stats', None)
+    if current is not None:
+        return current
+    stats = stats or SoapStats(track_callers=track_callers)
+    local = threading.local()
+    invoke = stub.InvokeMethod
+    # A wrapper already on the instance (SessionPool re-login) is put back
+    # by uninstrument.
+    stub._soap_previous = stub.__dict__.get('InvokeMethod')
+
+    def invoke_method(mo, info, args, *rest, **kwargs):
+        outer = getattr(local, 'counter', None)
+        if outer is not None:
+            # Nested call, e.g. a session stub logging in again before
+            # retrying: charged to the outermost call.
+            return invoke(mo, info, args, *rest, **kwargs)
+        counter = local.counter = {'request': 0, 'response': 0}
+        caller = _caller() if stats.track_callers else None
+        fault = None
+        started = time.monotonic()
+        try:
+            return invoke(mo, info, args, *rest, **kwargs)
+        except Exception as error:
+            fault = getattr(error, '_wsdlName', type(error).__name__)
+            raise
+        finally:
+            local.counter = None
+            stats.record(getattr(info, 'wsdlName', None) or info.name,
+                         getattr(mo, '_wsdlName', type(mo).__name__),
+                         time.monotonic() - started,
+                         request_bytes=counter['request'],
+                         response_bytes=counter['response'],
+                         fault=fault, caller=caller)
+
+    stub.InvokeMethod = invoke_method
+    soap_stub = getattr(stub, 'soapStub', stub)
+    if hasattr(soap_stub, 'GetConnection'):
+        _count_bytes(soap_stub, local)
+    stub._soap_stats = stats
+    return stats
+
+
+def uninstrument(service_instance):
+    """
+    Stops recording; returns the SoapStats that were in use, or None.
+    """
+    stub = service_instance._stub
+    stats = getattr(stub, '_soap_stats', None)
+    if stats is None:
+        return None
+    soap_stub = getattr(stub, 'soapStub', stub)
+    previous = stub.__dict__.pop('_soap_previous', None)
+    for name in ('InvokeMethod', '_soap_stats'):
+        stub.__dict__.pop(name, None)
+    if previous is not None:
+        stub.InvokeMethod = previous
+    for name in ('GetConnection', 'ReturnConnection'):
+        soap_stub.__dict__.pop(name, None)
+    return stats
+
+
+def _count_bytes(soap_stub, local):
+    # Connections go back to the stub's pool unwrapped, so a connection is
+    # never proxied twice and stays usable after uninstrument.
+    get_connection = soap_stub.GetConnection
+    return_connection = soap_stub.ReturnConnection
+
+    def get(*args, **kwargs):
+        return _CountingConnection(get_connection(*args, **kwargs), local)
+
+    def put(connection, *args, **kwargs):
+        if isinstance(connection, _CountingConnection):
+            connection = connection._connection
+        return return_connection(connection, *args, **kwargs)
+
+    soap_stub.GetConnection = get
+    soap_stub.ReturnConnection = put
+
+
+def _caller():
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not any(part in filename for part in _PLUMBING):
+            return '%s:%d %s' % (os.path.basename(filename), frame.f_lineno,
+                                 frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def _labels(pairs):
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _size(count):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if count < 1024 or unit == 'GB':
+            return ('%d %s' % (count, unit) if unit == 'B'
+                    else '%.1f %s' % (count, unit))
+        count /= 1024.0
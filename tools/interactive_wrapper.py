@@ -1,15 +1,44 @@
 import atexit
 from getpass import getpass
 
-from pyVim import connect
+from tools import pchelper
+from tools import serviceutil
+from tools.lazy import lazy_import
+
+connect = lazy_import('pyVim.connect')
+vim = lazy_import('pyVmomi', 'vim')
 
 """
 This module overlays the pyVmomi library to make its use in a
 python shell or short program more enjoyable.
 Starting point is instantiating a vCenter Host (VVC) in order
 to get all VMs.
+
+VMs are listed with one paged property retrieval over the full inventory
+traversal; the properties to prefetch are declared by the caller:
+
+    vvc = VVC('vcenter')
+    vvc.connect('user')
+    for vm in vvc.get_all_vms(['name', 'runtime.powerState']):
+        print(vm.name, vm.power_state)
+
+ESX and VM wrappers are hashed and compared by moref and only go to
+vCenter for properties that were not prefetched.
 """
 
+# Properties shown by VVC.print_vms, as in VCenterApi.print_vm_info.
+LISTING_PROPERTIES = [
+    'summary.config.name',
+    'summary.config.template',
+    'summary.config.vmPathName',
+    'summary.config.guestFullName',
+    'summary.config.instanceUuid',
+    'summary.config.uuid',
+    'summary.runtime.powerState',
+    'summary.guest.ipAddress',
+    'summary.guest.toolsStatus',
+]
+
 
 class VVC(object):
     """
@@ -47,38 +76,167 @@ class VVC(object):
             if hasattr(child, "vmFolder"):
                 yield child.vmFolder
 
-    def get_all_vms(self):
+    def get_all_vms(self, path_set=None, page_size=1000):
         """
         Returns a generator over all VMs known to this vCenter host.
+
+        - `path_set` (list) properties prefetched for every VM, default
+          VM.PROPERTIES. They are read with one RetrievePropertiesEx (plus
+          one ContinueRetrievePropertiesEx per `page_size` VMs) over
+          serviceutil.build_full_traversal. When 'runtime.host' is among
+          them the hosts are fetched in bulk too (ESX.PROPERTIES) and
+          shared between their VMs.
+        """
+        path_set = VM.PROPERTIES if path_set is None else path_set
+        hosts = {}
+        if 'runtime.host' in path_set:
+            hosts = dict((esx.moref, esx) for esx in self.get_all_hosts())
+        for row in self.get_vm_properties(path_set, page_size=page_size):
+            raw_host = row.get('runtime.host')
+            if raw_host is not None:
+                row['runtime.host'] = hosts.get(raw_host._moId) or \
+                    ESX(raw_host)
+            yield VM(row.pop('obj'), row)
+
+    def get_all_hosts(self, path_set=None, page_size=1000):
+        """
+        Returns a generator over all ESX hosts, with `path_set` (default
+        ESX.PROPERTIES) prefetched.
+        """
+        path_set = ESX.PROPERTIES if path_set is None else path_set
+        for row in self.get_properties(vim.HostSystem, path_set,
+                                       page_size=page_size):
+            yield ESX(row.pop('obj'), row)
+
+    def get_vm_properties(self, path_set=None, page_size=1000):
+        """
+        Returns a generator of property dicts, one per VM, with the managed
+        object under 'obj'.
         """
-        for folder in self.get_first_level_of_vm_folders():
-            for vm in get_all_vms_in_folder(folder):
-                yield vm
+        path_set = VM.PROPERTIES if path_set is None else path_set
+        return self.get_properties(vim.VirtualMachine, path_set,
+                                   page_size=page_size)
+
+    def get_properties(self, obj_type, path_set, page_size=1000):
+        content = self.service_instance.RetrieveContent()
+        filter_spec = serviceutil.build_full_traversal_filter_spec(
+            content.rootFolder, obj_type, path_set)
+        return pchelper.iter_filter_spec(self.service_instance, filter_spec,
+                                         include_mors=True,
+                                         page_size=page_size)
+
+    def print_vms(self, path_set=None):
+        """
+        Prints every VM with the properties in `path_set` (default
+        LISTING_PROPERTIES), fetched in bulk.
+        """
+        path_set = path_set or LISTING_PROPERTIES
+        width = max(len(path) for path in path_set)
+        for row in self.get_vm_properties(path_set):
+            print("-" * 40)
+            for path in path_set:
+                print("{0:{1}} : {2}".format(path, width, row.get(path)))
 
 
-class ESX(object):
+class ManagedObject(object):
     """
-    An ESX instance.
+    Compact wrapper around a pyVmomi managed object.
+
+    Equality and hashing use the moref, which is local, so wrappers are
+    cheap set members and dict keys. Properties are served from the dict
+    prefetched in bulk; anything else is read from vCenter when asked for
+    and cached.
     """
 
-    def __init__(self, raw_esx):
-        self.raw_esx = raw_esx
-        self.name = raw_esx.name
+    __slots__ = ('raw', 'properties')
+
+    # Property paths fetched in bulk by VVC, overridden per type.
+    PROPERTIES = ['name']
+
+    def __init__(self, raw, properties=None):
+        self.raw = raw
+        self.properties = properties if properties is not None else {}
+
+    @property
+    def moref(self):
+        return self.raw._moId
+
+    @property
+    def name(self):
+        return self.get('name')
+
+    def get(self, path):
+        """
+        Returns the property at dotted `path`: prefetched, or read once
+        from vCenter and cached.
+        """
+        try:
+            return self.properties[path]
+        except KeyError:
+            pass
+        value = self.raw
+        for part in path.split('.'):
+            if value is None:
+                break
+            value = getattr(value, part)
+        self.properties[path] = value
+        return value
 
     def __eq__(self, other):
-        return self.name == other.name
+        if not isinstance(other, ManagedObject):
+            return NotImplemented
+        return (type(self) is type(other) and
+                self.raw._moId == other.raw._moId)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
     def __hash__(self):
-        return int("".join((str(ord(c)) for c in self.name)))
+        return hash(self.raw._moId)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.raw._moId)
 
     def __getattr__(self, attribute):
-        return getattr(self.raw_esx, attribute)
+        # Only reached for names that are not slots or properties: fall
+        # back to the prefetched values, then to the remote object.
+        properties = object.__getattribute__(self, 'properties')
+        if attribute in properties:
+            return properties[attribute]
+        return getattr(object.__getattribute__(self, 'raw'), attribute)
+
+
+class ESX(ManagedObject):
+    """
+    An ESX instance.
+    """
+
+    __slots__ = ()
+
+    PROPERTIES = ['name', 'summary.hardware.numCpuCores']
+
+    @property
+    def raw_esx(self):
+        return self.raw
+
+    @property
+    def cores(self):
+        """
+        Number of physical CPU cores.
+        """
+        cores = self.get('summary.hardware.numCpuCores')
+        return int(cores) if cores is not None else None
 
     def get_number_of_cores(self):
         """
         Returns the number of CPU cores (type long) on this ESX.
         """
-        resources_on_esx = self.raw_esx.licensableResource.resource
+        if self.cores is not None:
+            return self.cores
+        resources_on_esx = self.raw.licensableResource.resource
         for resource in resources_on_esx:
             if resource.key == "numCpuCores":
                 return resource.value
@@ -86,17 +244,36 @@ class ESX(object):
         raise RuntimeError(message.format(self.name, resources_on_esx))
 
 
-class VM(object):
+class VM(ManagedObject):
     """
     A virtual machine.
     """
 
-    def __init__(self, raw_vm):
-        self.raw_vm = raw_vm
-        self.name = raw_vm.name
+    __slots__ = ()
 
-    def __getattr__(self, attribute):
-        return getattr(self.raw_vm, attribute)
+    PROPERTIES = ['name', 'runtime.powerState', 'runtime.host']
+
+    @property
+    def raw_vm(self):
+        return self.raw
+
+    @property
+    def power_state(self):
+        """
+        'poweredOn', 'poweredOff' or 'suspended'.
+        """
+        state = self.get('runtime.powerState')
+        return str(state) if state is not None else None
+
+    @property
+    def host(self):
+        """
+        The ESX the VM is registered on.
+        """
+        host = self.get('runtime.host')
+        if host is not None and not isinstance(host, ESX):
+            host = self.properties['runtime.host'] = ESX(host)
+        return host
 
     def get_first_network_interface_matching(self, predicate):
         """
@@ -106,13 +283,13 @@ class VM(object):
         - `predicate` (callable) is a function that takes a network and returns
           True (return this network) or False (skip this network).
         """
-        for network in self.raw_vm.network:
+        for network in self.get('network') or []:
             if predicate(network):
                 return network
         return None
 
     def get_esx_host(self):
-        return ESX(self.raw_vm.runtime.host)
+        return self.host
 
 
 def get_all_vms_in_folder(folder):
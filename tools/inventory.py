@@ -0,0 +1,159 @@
+"""
+Bulk host inventory report.
+
+Fetches hosts, datastores, networks and virtual machines with one property
+retrieval per type, restricted to the property paths listed in
+`INVENTORY_PROPERTIES` (keyed by vim type name), and joins them locally into the nested ``esxi_host``
+structure::
+
+    {host_name: {'esxi_info': {...}, 'datastore': {...},
+                 'network': {...}, 'vm': {...}}}
+"""
+
+from tools import pchelper
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+INVENTORY_PROPERTIES = {
+    'HostSystem': [
+        'name',
+        'summary.hardware',
+        'summary.quickStats.overallCpuUsage',
+        'summary.quickStats.overallMemoryUsage',
+        'summary.config.product.fullName',
+        'datastore',
+        'network',
+        'vm',
+    ],
+    'Datastore': [
+        'name',
+        'summary.capacity',
+        'summary.freeSpace',
+        'summary.type',
+    ],
+    'Network': [
+        'name',
+    ],
+    'VirtualMachine': [
+        'name',
+        'runtime.powerState',
+        'config.hardware.numCPU',
+        'config.hardware.memoryMB',
+        'config.hardware.device',
+        'config.guestFullName',
+        'guest.ipAddress',
+    ],
+}
+
+
+def inventory_properties():
+    """
+    INVENTORY_PROPERTIES keyed by the vim types themselves.
+    """
+    return dict((getattr(vim, name), list(path_set))
+                for name, path_set in INVENTORY_PROPERTIES.items())
+
+
+def collect_rows(service_instance, obj_type, path_set=None):
+    """
+    Retrieves `path_set` (defaults to the INVENTORY_PROPERTIES entry of
+    `obj_type`) for
+    every object of `obj_type`, including the managed object refs.
+    """
+    if path_set is None:
+        path_set = INVENTORY_PROPERTIES[obj_type._wsdlName]
+    return pchelper.collect_all(service_instance, obj_type, path_set=path_set)
+
+
+def collect_inventory(service_instance):
+    """
+    Collects the inventory report with one retrieval per object type.
+    """
+    rows = dict((obj_type, collect_rows(service_instance, obj_type))
+                for obj_type in inventory_properties())
+    return build_report(hosts=rows[vim.HostSystem],
+                        datastores=rows[vim.Datastore],
+                        networks=rows[vim.Network],
+                        vms=rows[vim.VirtualMachine])
+
+
+def build_report(hosts, datastores, networks, vms):
+    """
+    Joins property rows (as returned by `collect_rows`) into the nested
+    report. Host references to datastores, networks and VMs are resolved
+    by moref against the other row lists, no remote calls are made.
+    """
+    datastore_rows = _by_moref(datastores)
+    network_rows = _by_moref(networks)
+    vm_rows = _by_moref(vms)
+
+    report = {}
+    for host in hosts:
+        entry = {'esxi_info': host_info(host), 'datastore': {},
+                 'network': {}, 'vm': {}}
+        for ds in host.get('datastore') or []:
+            row = datastore_rows.get(ds._moId)
+            if row is not None:
+                entry['datastore'][row['name']] = datastore_info(row)
+        for nt in host.get('network') or []:
+            row = network_rows.get(nt._moId)
+            if row is not None:
+                entry['network'][row['name']] = {'标签ID': row['name']}
+        for vm in host.get('vm') or []:
+            row = vm_rows.get(vm._moId)
+            if row is not None:
+                entry['vm'][row['name']] = vm_info(row)
+        report[host['name']] = entry
+    return report
+
+
+def host_info(row):
+    hardware = row['summary.hardware']
+    cpu_usage = row.get('summary.quickStats.overallCpuUsage') or 0
+    memory_usage = row.get('summary.quickStats.overallMemoryUsage') or 0
+    memory_mb = hardware.memorySize / 1024 / 1024
+    info = {
+        '厂商': hardware.vendor,
+        '型号': hardware.model,
+        '处理器': '数量：%s 核数：%s 线程数：%s 频率：%s(%s) ' % (
+            hardware.numCpuPkgs, hardware.numCpuCores,
+            hardware.numCpuThreads, hardware.cpuMhz, hardware.cpuModel),
+        '处理器使用率': '%.1f%%' % (cpu_usage / (
+            hardware.numCpuPkgs * hardware.numCpuCores * hardware.cpuMhz) * 100),
+        '内存(MB)': memory_mb,
+        '可用内存(MB)': '%.1f MB' % (memory_mb - memory_usage),
+        '内存使用率': '%.1f%%' % ((memory_usage / memory_mb) * 100),
+        '系统': row.get('summary.config.product.fullName'),
+    }
+    for i in hardware.otherIdentifyingInfo or []:
+        if isinstance(i, vim.host.SystemIdentificationInfo):
+            info['SN'] = i.identifierValue
+    return info
+
+
+def datastore_info(row):
+    return {
+        '总容量(G)': int(row['summary.capacity'] / 1024 / 1024 / 1024),
+        '空闲容量(G)': int(row['summary.freeSpace'] / 1024 / 1024 / 1024),
+        '类型': row['summary.type'],
+    }
+
+
+def vm_info(row):
+    info = {
+        '电源状态': row.get('runtime.powerState'),
+        'CPU(内核总数)': row.get('config.hardware.numCPU'),
+        '内存(总数MB)': row.get('config.hardware.memoryMB'),
+        '系统信息': row.get('config.guestFullName'),
+        'IP': row.get('guest.ipAddress') or '服务器需要开机后才可以获取',
+    }
+    for d in row.get('config.hardware.device') or []:
+        if isinstance(d, vim.vm.device.VirtualDisk):
+            info[d.deviceInfo.label] = str(d.capacityInKB / 1024 / 1024) + ' GB'
+    return info
+
+
+def _by_moref(rows):
+    return dict((row['obj']._moId, row) for row in rows)
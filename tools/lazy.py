@@ -0,0 +1,63 @@
+"""
+Deferred imports.
+
+pyVmomi loads its whole type registry on import, requests pulls in urllib3
+and friends; clients that never talk to vCenter (or never make an HTTP call)
+should not pay for that. `lazy_import` returns a stand-in that performs the
+real import on first attribute access or call.
+
+Usage:
+    vim = lazy_import('pyVmomi', 'vim')       # from pyVmomi import vim
+    requests = lazy_import('requests')         # import requests
+    Disconnect = lazy_import('pyVim.connect', 'Disconnect')
+"""
+import importlib
+import threading
+
+
+class LazyImport(object):
+    """
+    Proxy for a module, or an attribute of a module, imported on first use.
+    """
+
+    __slots__ = ('_module_name', '_attribute', '_target', '_lock')
+
+    def __init__(self, module_name, attribute=None):
+        object.__setattr__(self, '_module_name', module_name)
+        object.__setattr__(self, '_attribute', attribute)
+        object.__setattr__(self, '_target', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _resolve(self):
+        target = object.__getattribute__(self, '_target')
+        if target is None:
+            with object.__getattribute__(self, '_lock'):
+                target = object.__getattribute__(self, '_target')
+                if target is None:
+                    target = importlib.import_module(
+                        object.__getattribute__(self, '_module_name'))
+                    attribute = object.__getattribute__(self, '_attribute')
+                    if attribute is not None:
+                        target = getattr(target, attribute)
+                    object.__setattr__(self, '_target', target)
+        return target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        name = object.__getattribute__(self, '_module_name')
+        attribute = object.__getattribute__(self, '_attribute')
+        if attribute is not None:
+            name = '%s.%s' % (name, attribute)
+        return '<lazy import %s>' % name
+
+
+def lazy_import(module_name, attribute=None):
+    return LazyImport(module_name, attribute)
@@ -0,0 +1,263 @@
+"""
+Live in-memory inventory mirror.
+
+Uses the same CreateFilter / WaitForUpdates pattern as
+`tools.tasks.wait_for_tasks`, but on a dedicated PropertyCollector and for
+the whole inventory: the first wait returns the full state (the seed), every
+following wait returns only what changed. Readers query the local model and
+never go to vCenter.
+
+Usage:
+    mirror = InventoryMirror(service_instance)
+    mirror.start()
+    mirror.wait_ready()
+    hosts = mirror.rows(vim.HostSystem)
+    ...
+    mirror.stop()
+"""
+import logging
+import threading
+
+from tools import inventory
+from tools import objindex
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+vmodl = lazy_import('pyVmomi', 'vmodl')
+
+
+def default_properties():
+    """
+    Property paths mirrored per type: everything the inventory report
+    needs plus the fields used by the lookup index.
+    """
+    properties = inventory.inventory_properties()
+    for name, path_set in objindex.UUID_PROPERTIES.items():
+        obj_type = getattr(vim, name)
+        for path in path_set:
+            if path not in properties.setdefault(obj_type, ['name']):
+                properties[obj_type].append(path)
+    return properties
+
+
+class InventoryMirror(object):
+    """
+    Background copy of selected inventory properties, kept current through
+    WaitForUpdatesEx.
+    """
+
+    def __init__(self, service_instance, properties=None, index=None,
+                 max_wait=30):
+        """
+        - `properties` (dict) vim type -> list of property paths. Defaults
+          to `default_properties()`.
+        - `index` (tools.objindex.InventoryIndex) optional lookup index that
+          is seeded from the mirror and kept current by it.
+        - `max_wait` (int) seconds per WaitForUpdatesEx call, bounds how
+          long `stop` takes.
+        """
+        self.service_instance = service_instance
+        self.properties = properties or default_properties()
+        self.index = index
+        self.max_wait = max_wait
+        self.version = None
+        self._objects = {}
+        self._lock = threading.RLock()
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._collector = None
+        self._view = None
+
+    def start(self, version=None):
+        """
+        Starts the update thread. Passing the `version` of a previous run
+        resumes from that point when the collector still knows it,
+        otherwise the mirror is seeded again from scratch.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if version is not None:
+            self.version = version
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='inventory-mirror')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the update thread. The collector and the local model are
+        kept, so `start(mirror.version)` picks up where it left off.
+        """
+        self._stopping.set()
+        if self._collector is not None:
+            try:
+                self._collector.CancelWaitForUpdates()
+            except Exception:
+                logging.debug("CancelWaitForUpdates failed", exc_info=True)
+        if self._thread is not None:
+            self._thread.join()
+        self._ready.clear()
+        if self.index is not None:
+            self.index.set_live(self.properties, False)
+
+    def close(self):
+        """
+        Stops the mirror and destroys its collector and container view.
+        """
+        self.stop()
+        self._destroy()
+
+    def wait_ready(self, timeout=None):
+        """
+        Blocks until the initial seed has been applied, or a resumed mirror
+        has caught up. `ready` is cleared again when the mirror stops.
+        """
+        return self._ready.wait(timeout)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def rows(self, obj_type):
+        """
+        Returns copies of the mirrored property dicts for `obj_type`
+        (including subtypes), in the same shape as
+        `tools.pchelper.collect_all`.
+        """
+        with self._lock:
+            return [dict(record) for record in self._objects.values()
+                    if isinstance(record['obj'], obj_type)]
+
+    def objects(self, vimtype):
+        with self._lock:
+            return [record['obj'] for record in self._objects.values()
+                    if isinstance(record['obj'], tuple(vimtype))]
+
+    def get(self, vimtype, name):
+        with self._lock:
+            for record in self._objects.values():
+                if (isinstance(record['obj'], tuple(vimtype)) and
+                        record.get('name') == name):
+                    return record['obj']
+        return None
+
+    def covers(self, vimtype):
+        """
+        True if every type of `vimtype` is mirrored.
+        """
+        return all(obj_type in self.properties for obj_type in vimtype)
+
+    def _run(self):
+        try:
+            if self._collector is None:
+                self._create_filter()
+            self._loop()
+        except Exception:
+            logging.exception("Inventory mirror stopped")
+        finally:
+            # A stopped mirror is frozen: readers go back to vCenter until
+            # it is started again and has caught up.
+            self._ready.clear()
+            if self.index is not None:
+                self.index.set_live(self.properties, False)
+
+    def _create_filter(self):
+        content = self.service_instance.content
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._view = content.viewManager.CreateContainerView(
+            container=content.rootFolder,
+            type=list(self.properties),
+            recursive=True)
+
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+            name='traverseEntities', path='view', skip=False,
+            type=vim.view.ContainerView)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(
+            obj=self._view, skip=True, selectSet=[traversal_spec])
+        prop_specs = [
+            vmodl.query.PropertyCollector.PropertySpec(type=obj_type,
+                                                       pathSet=path_set)
+            for obj_type, path_set in self.properties.items()
+        ]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[obj_spec], propSet=prop_specs)
+        # partialUpdates=False: changes are reported on the requested
+        # paths, never on nested sub-paths.
+        self._collector.CreateFilter(filter_spec, False)
+
+    def _loop(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=self.max_wait)
+        while not self._stopping.is_set():
+            try:
+                update = self._collector.WaitForUpdatesEx(self.version or '',
+                                                          options)
+            except vmodl.fault.RequestCanceled:
+                break
+            except vmodl.query.InvalidCollectorVersion:
+                # Unknown version token: start over with a fresh seed.
+                logging.info("Mirror version %s rejected, reseeding",
+                             self.version)
+                with self._lock:
+                    self._objects.clear()
+                self.version = None
+                self._ready.clear()
+                # The index falls back to refresh-on-miss until reseeded.
+                if self.index is not None:
+                    self.index.set_live(self.properties, False)
+                continue
+            if update is not None:
+                self._apply(update)
+                self.version = update.version
+                if update.truncated:
+                    continue
+            # Caught up: after the seed, or on a resumed version after the
+            # first wait, even one that reported no change.
+            if self.version and not self._ready.is_set():
+                self._seed_index()
+                self._ready.set()
+
+    def _apply(self, update):
+        with self._lock:
+            for filter_set in update.filterSet:
+                for obj_set in filter_set.objectSet:
+                    self._apply_object(obj_set)
+
+    def _apply_object(self, obj_set):
+        obj = obj_set.obj
+        moref = obj._moId
+        if obj_set.kind == 'leave':
+            self._objects.pop(moref, None)
+            if self.index is not None and self.ready:
+                self.index.remove(obj)
+            return
+        record = self._objects.setdefault(moref, {'obj': obj})
+        changed = {}
+        for change in obj_set.changeSet:
+            if change.op in ('remove', 'indirectRemove'):
+                record.pop(change.name, None)
+                changed[change.name] = None
+            else:
+                record[change.name] = change.val
+                changed[change.name] = change.val
+        if self.index is not None and self.ready:
+            self.index.update(obj, changed)
+
+    def _seed_index(self):
+        if self.index is None:
+            return
+        for obj_type in self.properties:
+            self.index.load(obj_type, self.rows(obj_type))
+        self.index.set_live(self.properties)
+
+    def _destroy(self):
+        for ref in (self._collector, self._view):
+            if ref is not None:
+                try:
+                    ref.Destroy()
+                except Exception:
+                    logging.debug("Destroy failed", exc_info=True)
+        self._collector = None
+        self._view = None
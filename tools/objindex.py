@@ -0,0 +1,297 @@
+"""
+Name / moref / UUID lookup index for vCenter managed objects.
+
+Every lookup against a ContainerView walks the whole inventory and fetches
+the ``name`` of each object with its own round trip. This module builds one
+table per managed object type from a single PropertyCollector retrieval and
+answers lookups locally afterwards.
+
+Usage:
+    index = InventoryIndex(service_instance)
+    network = index.get([vim.Network], 'VM Network')
+    vm = index.find_by_uuid('500d8ca6-ee47-95b6-fe3e-2407cd88362f')
+"""
+import threading
+import time
+
+from tools import pchelper
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+# Extra properties indexed per type, on top of ``name``.
+UUID_PROPERTIES = {
+    'VirtualMachine': ['config.uuid', 'config.instanceUuid'],
+}
+
+
+def uuid_properties(obj_type):
+    """
+    UUID_PROPERTIES entry of a vim type, [] for types without UUIDs.
+    """
+    return UUID_PROPERTIES.get(obj_type._wsdlName, [])
+
+
+class ObjectIndex(object):
+    """
+    Lookup tables for all managed objects of a single vim type.
+    """
+
+    def __init__(self, service_instance, obj_type, max_age=None):
+        """
+        - `service_instance` (ServiceInstance) vCenter connection
+        - `obj_type` (pyVmomi.vim.*) managed object type to index
+        - `max_age` (float) seconds after which the table is rebuilt from
+          scratch on next access. None keeps it until `invalidate`.
+        """
+        self.service_instance = service_instance
+        self.obj_type = obj_type
+        self.max_age = max_age
+        self.loaded_at = None
+        self._lock = threading.RLock()
+        self._by_name = {}
+        self._by_moref = {}
+        self._by_uuid = {}
+        self._names = {}
+
+    @property
+    def path_set(self):
+        return ['name'] + uuid_properties(self.obj_type)
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        if self.max_age is None:
+            return False
+        return time.time() - self.loaded_at > self.max_age
+
+    def refresh(self):
+        """
+        Rebuilds the tables from a paged property retrieval
+        (RetrievePropertiesEx, one round trip per 1000 objects). The
+        container view used for the traversal is destroyed before
+        returning.
+        """
+        rows = pchelper.collect_all(self.service_instance, self.obj_type,
+                                    path_set=self.path_set)
+        self.load(rows)
+
+    def load(self, rows):
+        """
+        Replaces the tables with already retrieved property rows, each a
+        dict holding 'obj' and the properties of `path_set`.
+        """
+        with self._lock:
+            self._by_name.clear()
+            self._by_moref.clear()
+            self._by_uuid.clear()
+            self._names.clear()
+            for row in rows:
+                self._add(row['obj'], row)
+            self.loaded_at = time.time()
+
+    def ensure_loaded(self):
+        if self.is_stale():
+            self.refresh()
+
+    def update(self, obj, properties):
+        """
+        Applies an incremental change for one object. Only the keys present
+        in `properties` are changed, e.g. {'name': 'new-name'}.
+        """
+        with self._lock:
+            moref = obj._moId
+            known = moref in self._by_moref
+            if known and not any(path in properties
+                                 for path in self.path_set):
+                return
+            if known:
+                current = self._forget(moref)
+                current.update(properties)
+                properties = current
+            self._add(obj, properties)
+
+    def remove(self, obj):
+        """
+        Drops an object, e.g. after it was destroyed.
+        """
+        with self._lock:
+            if obj._moId in self._by_moref:
+                self._forget(obj._moId)
+
+    def by_name(self, name):
+        with self._lock:
+            return self._by_name.get(name)
+
+    def by_moref(self, moref):
+        with self._lock:
+            return self._by_moref.get(moref)
+
+    def by_uuid(self, uuid):
+        with self._lock:
+            return self._by_uuid.get(uuid)
+
+    def objects(self):
+        with self._lock:
+            return list(self._by_moref.values())
+
+    def _add(self, obj, properties):
+        moref = obj._moId
+        record = {'name': properties.get('name')}
+        for path in uuid_properties(self.obj_type):
+            record[path] = properties.get(path)
+        self._by_moref[moref] = obj
+        self._names[moref] = record
+        # Keep the first object seen for duplicate names, like the
+        # original linear scan did.
+        if record['name'] is not None:
+            self._by_name.setdefault(record['name'], obj)
+        for path in uuid_properties(self.obj_type):
+            if record[path]:
+                self._by_uuid[record[path]] = obj
+
+    def _forget(self, moref):
+        obj = self._by_moref.pop(moref)
+        record = self._names.pop(moref)
+        if self._by_name.get(record['name']) is obj:
+            del self._by_name[record['name']]
+            # Promote another object carrying the same name, if any.
+            for other_moref, other in self._names.items():
+                if other['name'] == record['name']:
+                    self._by_name[record['name']] = self._by_moref[other_moref]
+                    break
+        for path in uuid_properties(self.obj_type):
+            if record[path] and self._by_uuid.get(record[path]) is obj:
+                del self._by_uuid[record[path]]
+        return record
+
+
+class InventoryIndex(object):
+    """
+    One `ObjectIndex` per managed object type, created on first use.
+    """
+
+    def __init__(self, service_instance, max_age=None,
+                 miss_refresh_seconds=10):
+        """
+        - `max_age` (float) see `ObjectIndex`.
+        - `miss_refresh_seconds` (float) a lookup miss rebuilds a table only
+          if it was loaded at least this long ago, so a burst of lookups
+          for missing names costs one rebuild, not one each.
+        """
+        self.service_instance = service_instance
+        self.max_age = max_age
+        self.miss_refresh_seconds = miss_refresh_seconds
+        # Types whose tables an update feed (e.g. tools.mirror) keeps
+        # current, so misses on them are answered without a rebuild.
+        self._live = set()
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    def index_for(self, obj_type):
+        """
+        Returns the (loaded) `ObjectIndex` for `obj_type`.
+        """
+        index = self._get_or_create(obj_type)
+        index.ensure_loaded()
+        return index
+
+    def load(self, obj_type, rows):
+        """
+        Seeds the table for `obj_type` from rows retrieved elsewhere,
+        without a remote call.
+        """
+        index = self._get_or_create(obj_type)
+        index.load(rows)
+
+    def set_live(self, obj_types, live=True):
+        """
+        Marks the tables of `obj_types` as kept current by an update feed
+        (or no longer, with live=False).
+        """
+        with self._lock:
+            if live:
+                self._live.update(obj_types)
+            else:
+                self._live.difference_update(obj_types)
+
+    def is_live(self, obj_type):
+        with self._lock:
+            return obj_type in self._live
+
+    def is_loaded(self, obj_type):
+        with self._lock:
+            index = self._indexes.get(obj_type)
+        return index is not None and index.loaded_at is not None
+
+    def get(self, vimtype, name):
+        """
+        Finds an object by name among the types listed in `vimtype`.
+
+        A miss triggers one rebuild of the tables that were loaded before
+        this call so objects created since then are still found, at most
+        once per `miss_refresh_seconds` per table. Tables kept current by
+        a live feed (see `set_live`) are trusted as is.
+        """
+        now = time.time()
+        loaded = [obj_type for obj_type in vimtype
+                  if self.is_loaded(obj_type) and
+                  not self.is_live(obj_type)]
+        obj = self._lookup(vimtype, 'by_name', name)
+        if obj is None and loaded:
+            for obj_type in loaded:
+                index = self.index_for(obj_type)
+                if now - index.loaded_at >= self.miss_refresh_seconds:
+                    index.refresh()
+            obj = self._lookup(vimtype, 'by_name', name)
+        return obj
+
+    def find_by_moref(self, vimtype, moref):
+        return self._lookup(vimtype, 'by_moref', moref)
+
+    def find_by_uuid(self, uuid):
+        """
+        Finds a VirtualMachine by BIOS UUID or instance UUID.
+        """
+        return self._lookup([vim.VirtualMachine], 'by_uuid', uuid)
+
+    def update(self, obj, properties):
+        """
+        Forwards an incremental change to every loaded table that holds
+        objects of the given type.
+        """
+        for index in self._loaded_for(obj):
+            index.update(obj, properties)
+
+    def remove(self, obj):
+        for index in self._loaded_for(obj):
+            index.remove(obj)
+
+    def invalidate(self, obj_type=None):
+        with self._lock:
+            if obj_type is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(obj_type, None)
+
+    def _get_or_create(self, obj_type):
+        with self._lock:
+            index = self._indexes.get(obj_type)
+            if index is None:
+                index = ObjectIndex(self.service_instance, obj_type,
+                                    max_age=self.max_age)
+                self._indexes[obj_type] = index
+            return index
+
+    def _lookup(self, vimtype, method, key):
+        for obj_type in vimtype:
+            obj = getattr(self.index_for(obj_type), method)(key)
+            if obj is not None:
+                return obj
+        return None
+
+    def _loaded_for(self, obj):
+        with self._lock:
+            return [index for obj_type, index in self._indexes.items()
+                    if isinstance(obj, obj_type)]
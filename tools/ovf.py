@@ -0,0 +1,300 @@
+"""
+OVF/OVA deployment through an HttpNfcLease.
+
+The descriptor is turned into an import spec by the OvfManager
+(CreateImportSpec), ResourcePool.ImportVApp creates the VM shell and hands
+out a lease with one upload URL per disk, and the disks are then streamed
+to those URLs concurrently. Disks of an OVA are read straight out of the
+tar archive: each upload seeks to its member's data and reads just that
+many bytes, nothing is extracted to disk. A keep-alive thread reports
+progress on the lease while the disks are in flight (an idle lease times
+out after a few minutes), and every disk's throughput is reported.
+
+Usage:
+    result = deploy(si, '/images/appliance.ova', 'appliance-01', folder,
+                    pool, datastore, network_map={'VM Network': network})
+    for disk in result.disks:
+        print(disk.path, '%.1f MB/s' % disk.mb_per_second)
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import tarfile
+import threading
+import time
+
+from tools.lazy import lazy_import
+
+requests = lazy_import('requests')
+vim = lazy_import('pyVmomi', 'vim')
+vmodl = lazy_import('pyVmomi', 'vmodl')
+
+
+CHUNK_SIZE = 1024 * 1024
+
+DiskTransfer = collections.namedtuple(
+    'DiskTransfer', ['path', 'bytes', 'seconds', 'mb_per_second'])
+
+DeployResult = collections.namedtuple('DeployResult', ['vm', 'disks'])
+
+
+class OvfSource(object):
+    """
+    An .ova archive or an .ovf descriptor with its files next to it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_ova = tarfile.is_tarfile(path)
+        # file name -> (path on disk, offset, size)
+        self._files = {}
+        if self.is_ova:
+            with tarfile.open(path) as archive:
+                for member in archive.getmembers():
+                    if member.isfile():
+                        self._files[member.name] = (path, member.offset_data,
+                                                    member.size)
+            names = [name for name in self._files if name.endswith('.ovf')]
+            if not names:
+                raise ValueError("%s contains no .ovf descriptor" % path)
+            self.descriptor_name = names[0]
+        else:
+            self.descriptor_name = os.path.basename(path)
+            self._directory = os.path.dirname(os.path.abspath(path))
+
+    def descriptor(self):
+        with self.open(self.descriptor_name) as descriptor_file:
+            return descriptor_file.read().decode('utf-8')
+
+    def size(self, name):
+        if self.is_ova:
+            return self._member(name)[2]
+        return os.path.getsize(os.path.join(self._directory, name))
+
+    def open(self, name):
+        """
+        Returns a binary reader over file `name` of the package.
+        """
+        if not self.is_ova:
+            return open(os.path.join(self._directory, name), 'rb')
+        path, offset, size = self._member(name)
+        return _SliceReader(path, offset, size)
+
+    def _member(self, name):
+        try:
+            return self._files[name]
+        except KeyError:
+            raise ValueError("%s has no file %s" % (self.path, name))
+
+
+class _SliceReader(object):
+    """
+    Reads `size` bytes at `offset` of a file: one OVA member, with its own
+    file handle so disks can be read in parallel.
+    """
+
+    def __init__(self, path, offset, size):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._left = size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._left:
+            size = self._left
+        chunk = self._file.read(size)
+        self._left -= len(chunk)
+        return chunk
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _CountingReader(object):
+    """
+    Upload body: reads `source` in chunks and adds what was read to the
+    shared progress counter.
+    """
+
+    def __init__(self, source, size, progress, chunk_size=CHUNK_SIZE):
+        self._source = source
+        self._size = size
+        self._progress = progress
+        self._chunk_size = chunk_size
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._chunk_size
+        chunk = self._source.read(size)
+        self._progress.add(len(chunk))
+        return chunk
+
+
+class _Progress(object):
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+
+    def percent(self):
+        if not self.total:
+            return 0
+        return min(99, int(self.done * 100 / self.total))
+
+
+def import_spec(service_instance, source, vm_name, pool, datastore,
+                network_map=None, disk_provisioning='thin'):
+    """
+    Returns the OvfManager.CreateImportSpecResult for deploying `source`
+    as `vm_name`. Raises ValueError on descriptor errors.
+
+    - `network_map` (dict) OVF network name -> vim.Network.
+    """
+    params = vim.OvfManager.CreateImportSpecParams()
+    params.entityName = vm_name
+    params.diskProvisioning = disk_provisioning
+    params.networkMapping = [
+        vim.OvfManager.NetworkMapping(name=name, network=network)
+        for name, network in sorted((network_map or {}).items())]
+    manager = service_instance.content.ovfManager
+    result = manager.CreateImportSpec(ovfDescriptor=source.descriptor(),
+                                      resourcePool=pool, datastore=datastore,
+                                      cisp=params)
+    for warning in result.warning or []:
+        logging.warning("%s: %s", source.path, warning.msg)
+    if result.error:
+        raise ValueError("%s: %s" % (source.path, '; '.join(
+            error.msg for error in result.error)))
+    return result
+
+
+def wait_for_lease(lease, timeout=300, poll_seconds=1):
+    """
+    Waits until the lease leaves the initializing state and returns it.
+    """
+    deadline = time.time() + timeout
+    while lease.state == vim.HttpNfcLease.State.initializing:
+        if time.time() > deadline:
+            raise RuntimeError("Lease still initializing after %ss"
+                               % timeout)
+        time.sleep(poll_seconds)
+    if lease.state == vim.HttpNfcLease.State.error:
+        raise RuntimeError("Lease failed: %s" % lease.error.msg)
+    return lease
+
+
+def deploy(service_instance, path, vm_name, folder, pool, datastore,
+           host=None, network_map=None, disk_provisioning='thin',
+           max_workers=4, keepalive_seconds=20, verify_ssl=False):
+    """
+    Deploys the OVA/OVF at `path` and returns a DeployResult with the new
+    VM and one DiskTransfer per uploaded disk. The lease is aborted, and
+    the half created VM with it, when anything fails after ImportVApp.
+
+    - `folder`, `pool`, `datastore`, `host` where the VM goes, as for
+      CreateVM_Task.
+    - `max_workers` (int) disks uploaded concurrently.
+    - `keepalive_seconds` (float) interval of the lease progress updates.
+    """
+    source = OvfSource(path)
+    spec = import_spec(service_instance, source, vm_name, pool, datastore,
+                       network_map=network_map,
+                       disk_provisioning=disk_provisioning)
+    lease = pool.ImportVApp(spec=spec.importSpec, folder=folder, host=host)
+    # From here on any failure aborts the lease, which removes the VM shell.
+    stop = threading.Event()
+    keepalive = None
+    try:
+        wait_for_lease(lease)
+        uploads = _uploads(service_instance, lease, spec.fileItem or [])
+        progress = _Progress(sum(source.size(item.path)
+                                 for item, _ in uploads))
+        keepalive = threading.Thread(target=_keep_alive,
+                                     args=(lease, progress, stop,
+                                           keepalive_seconds),
+                                     name='ovf-lease-keepalive')
+        keepalive.daemon = True
+        keepalive.start()
+        # requests.Session is not thread safe, one per upload thread.
+        local = threading.local()
+
+        def upload(item_url):
+            http = getattr(local, 'http', None)
+            if http is None:
+                http = local.http = requests.Session()
+                http.verify = verify_ssl
+                http.headers['Cookie'] = service_instance._stub.cookie
+            return _upload(http, source, item_url[0], item_url[1], progress)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            disks = list(executor.map(upload, uploads))
+        stop.set()
+        keepalive.join()
+        lease.HttpNfcLeaseProgress(100)
+        lease.HttpNfcLeaseComplete()
+    except Exception as error:
+        try:
+            lease.HttpNfcLeaseAbort(vmodl.fault.SystemError(reason=str(error)))
+        except Exception:
+            logging.debug("HttpNfcLeaseAbort failed", exc_info=True)
+        raise
+    finally:
+        stop.set()
+        if keepalive is not None:
+            keepalive.join()
+    return DeployResult(lease.info.entity, disks)
+
+
+def _uploads(service_instance, lease, file_items):
+    # (file item, url) pairs, matched on the device key; '*' in the URLs
+    # stands for the host the client used to reach vCenter.
+    urls = dict((device.importKey, device.url)
+                for device in lease.info.deviceUrl)
+    host = service_instance._stub.host.split(':')[0]
+    uploads = []
+    for item in file_items:
+        url = urls.get(item.deviceId)
+        if url is None:
+            raise ValueError("Lease has no upload URL for %s" % item.path)
+        uploads.append((item, url.replace('*', host)))
+    return uploads
+
+
+def _upload(http, source, item, url, progress):
+    size = source.size(item.path)
+    started = time.time()
+    with source.open(item.path) as disk:
+        body = _CountingReader(disk, size, progress)
+        method = http.put if item.create else http.post
+        response = method(url, data=body, headers={
+            'Content-Type': 'application/x-vnd.vmware-streamVmdk',
+            'Content-Length': str(size)})
+    response.raise_for_status()
+    seconds = max(time.time() - started, 1e-6)
+    transfer = DiskTransfer(item.path, size, seconds,
+                            size / seconds / 1024.0 ** 2)
+    logging.info("Uploaded %s: %d MB in %.1fs, %.1f MB/s", item.path,
+                 size // 1024 ** 2, seconds, transfer.mb_per_second)
+    return transfer
+
+
+def _keep_alive(lease, progress, stop, interval):
+    while not stop.wait(interval):
+        try:
+            lease.HttpNfcLeaseProgress(progress.percent())
+        except Exception:
+            logging.warning("Lease progress update failed", exc_info=True)
@@ -2,7 +2,9 @@
 Property Collector helper module.
 """
 
-import pyVmomi
+from tools.lazy import lazy_import
+
+pyVmomi = lazy_import('pyVmomi')
 
 
 # Shamelessly borrowed from:
@@ -29,8 +31,15 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
         A list of properties for the managed objects
 
     """
-    collector = service_instance.content.propertyCollector
+    return list(iter_properties(service_instance, view_ref, obj_type,
+                                path_set=path_set, include_mors=include_mors))
 
+
+def build_filter_spec(view_ref, obj_type, path_set=None):
+    """
+    Build a filter spec collecting 'path_set' of every 'obj_type' object
+    inside the view 'view_ref'.
+    """
     # Create object specification to define the starting point of
     # inventory navigation
     obj_spec = pyVmomi.vmodl.query.PropertyCollector.ObjectSpec()
@@ -59,21 +68,106 @@ def collect_properties(service_instance, view_ref, obj_type, path_set=None,
     filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
     filter_spec.objectSet = [obj_spec]
     filter_spec.propSet = [property_spec]
+    return filter_spec
 
-    # Retrieve properties
-    props = collector.RetrieveContents([filter_spec])
 
-    data = []
-    for obj in props:
-        properties = {}
-        for prop in obj.propSet:
-            properties[prop.name] = prop.val
+def iter_properties(service_instance, view_ref, obj_type, path_set=None,
+                    include_mors=False, page_size=1000, pages=False,
+                    record_type=None):
+    """
+    Generator variant of collect_properties built on RetrievePropertiesEx.
 
-        if include_mors:
-            properties['obj'] = obj.obj
+    Objects are fetched 'page_size' at a time with
+    ContinueRetrievePropertiesEx, and yielded as they arrive. If the caller
+    stops early the server side retrieval is cancelled.
 
-        data.append(properties)
-    return data
+    Args:
+        page_size               (int): maxObjects per round trip
+        pages                  (bool): If True yield lists (one per round
+                                       trip) instead of single rows
+        record_type            (type): Class from make_record_type, rows
+                                       are built as such records instead of
+                                       dicts
+
+    Yields:
+        Properties of one managed object (dict or record), or lists of them
+
+    """
+    return iter_filter_spec(service_instance,
+                            build_filter_spec(view_ref, obj_type, path_set),
+                            include_mors=include_mors, page_size=page_size,
+                            pages=pages, record_type=record_type)
+
+
+def iter_filter_spec(service_instance, filter_spec, include_mors=False,
+                     page_size=1000, pages=False, record_type=None):
+    """
+    Page through the results of any filter spec, see iter_properties.
+    """
+    collector = service_instance.content.propertyCollector
+    options = pyVmomi.vmodl.query.PropertyCollector.RetrieveOptions(
+        maxObjects=page_size)
+    result = collector.RetrievePropertiesEx([filter_spec], options)
+    token = None
+    try:
+        while result is not None:
+            token = result.token
+            page = [_to_row(obj, include_mors, record_type)
+                    for obj in result.objects]
+            if pages:
+                yield page
+            else:
+                for row in page:
+                    yield row
+            if token is None:
+                break
+            result = collector.ContinueRetrievePropertiesEx(token)
+            token = None
+    finally:
+        if token is not None:
+            collector.CancelRetrievePropertiesEx(token)
+
+
+def make_record_type(path_set, name='PropertyRecord'):
+    """
+    Build a compact class with __slots__ for the given property paths.
+
+    Dots in property paths become underscores ('summary.capacity' ->
+    'summary_capacity'); the managed object ref is stored as 'obj'.
+    Properties vCenter did not return are None.
+    """
+    fields = dict((path, path.replace('.', '_')) for path in path_set)
+
+    def __init__(self):
+        for slot in self.__slots__:
+            setattr(self, slot, None)
+
+    def __repr__(self):
+        return '%s(%s)' % (name, ', '.join(
+            '%s=%r' % (slot, getattr(self, slot)) for slot in self.__slots__))
+
+    return type(name, (object,), {
+        '__slots__': tuple(['obj'] + sorted(fields.values())),
+        '_fields': fields,
+        '__init__': __init__,
+        '__repr__': __repr__,
+    })
+
+
+def _to_row(obj, include_mors, record_type):
+    if record_type is not None:
+        row = record_type()
+        for prop in obj.propSet:
+            setattr(row, record_type._fields[prop.name], prop.val)
+        row.obj = obj.obj
+        return row
+    properties = {}
+    for prop in obj.propSet:
+        properties[prop.name] = prop.val
+
+    if include_mors:
+        properties['obj'] = obj.obj
+    return properties
 
 
 def get_container_view(service_instance, obj_type, container=None):
@@ -99,3 +193,63 @@ def get_container_view(service_instance, obj_type, container=None):
         recursive=True
     )
     return view_ref
+
+
+def collect_all(service_instance, obj_type, path_set=None, container=None):
+    """
+    Collect properties for every object of 'obj_type' below 'container'
+    (the root folder by default) using a temporary container view.
+
+    The view is destroyed before returning.
+
+    Args:
+        obj_type      (pyVmomi.vim.*): Type of managed object
+        path_set               (list): List of properties to retrieve
+        container (pyVmomi.vim.*): Folder, datacenter, ... to start from
+
+    Returns:
+        A list of properties for the managed objects, including the
+        managed object refs under the 'obj' key
+
+    """
+    view_ref = get_container_view(service_instance, obj_type=[obj_type],
+                                  container=container)
+    try:
+        return collect_properties(service_instance, view_ref=view_ref,
+                                  obj_type=obj_type, path_set=path_set,
+                                  include_mors=True)
+    finally:
+        view_ref.Destroy()
+
+
+def collect_objects(service_instance, objs, obj_type, path_set):
+    """
+    Collect properties for an explicit list of managed objects in a single
+    call, without traversing the inventory.
+
+    Args:
+        objs                   (list): Managed object refs
+        obj_type      (pyVmomi.vim.*): Type of the managed objects
+        path_set               (list): List of properties to retrieve
+
+    Returns:
+        A list of properties for the managed objects, including the
+        managed object refs under the 'obj' key
+
+    """
+    if not objs:
+        return []
+    collector = service_instance.content.propertyCollector
+    filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [
+        pyVmomi.vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+        for obj in objs
+    ]
+    filter_spec.propSet = [pyVmomi.vmodl.query.PropertyCollector.PropertySpec(
+        type=obj_type, pathSet=path_set)]
+    data = []
+    for obj in collector.RetrieveContents([filter_spec]):
+        properties = dict((prop.name, prop.val) for prop in obj.propSet)
+        properties['obj'] = obj.obj
+        data.append(properties)
+    return data
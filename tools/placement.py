@@ -0,0 +1,351 @@
+"""
+Capacity-aware VM placement.
+
+One bulk snapshot of hosts, datastores and compute resources (one property
+retrieval per type) is turned into a small capacity model: free memory,
+CPU headroom, free space and VM counts. A batch of VM specs is then placed
+with a bin-packing heuristic, largest VMs first:
+
+    'spread'   worst fit, the target left with the most room wins. Spreads
+               load evenly, the default.
+    'pack'     best fit, the fullest target that still fits wins. Keeps
+               hosts free for large VMs or for power savings.
+
+Each placement is reserved in the model straight away, so later specs in
+the batch (and concurrent callers sharing the engine) see the capacity it
+takes. Reservations are kept across `refresh` until they are committed
+(the VM exists and shows up in the next snapshot) or released.
+
+Usage:
+    engine = PlacementEngine(si)
+    for spec, placement in zip(specs, engine.place(specs)):
+        ...create the VM on placement.host / placement.pool /
+           placement.datastore...
+        engine.commit(placement)          # or engine.release(placement)
+"""
+import collections
+import threading
+import time
+
+from tools import pchelper
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+STRATEGIES = ('spread', 'pack')
+
+HOST_PROPERTIES = [
+    'name',
+    'parent',
+    'datastore',
+    'vm',
+    'runtime.connectionState',
+    'runtime.inMaintenanceMode',
+    'summary.hardware.memorySize',
+    'summary.hardware.cpuMhz',
+    'summary.hardware.numCpuCores',
+    'summary.quickStats.overallMemoryUsage',
+    'summary.quickStats.overallCpuUsage',
+]
+
+DATASTORE_PROPERTIES = [
+    'name',
+    'vm',
+    'summary.accessible',
+    'summary.capacity',
+    'summary.freeSpace',
+]
+
+COMPUTE_PROPERTIES = [
+    'resourcePool',
+]
+
+
+class Placement(collections.namedtuple('Placement',
+                                       ['name', 'host', 'pool', 'datastore',
+                                        'memory_mb', 'cpu_mhz',
+                                        'space_gb', 'host_name',
+                                        'datastore_name'])):
+    """
+    - `host`, `pool`, `datastore` chosen managed objects
+    - `memory_mb`, `cpu_mhz`, `space_gb` capacity reserved for the VM
+    - `host_name`, `datastore_name` names from the capacity snapshot, so
+      callers need not read them from the managed objects
+    """
+    __slots__ = ()
+
+
+class HostCapacity(object):
+
+    __slots__ = ('obj', 'name', 'pool', 'datastores', 'memory_mb',
+                 'free_memory_mb', 'cpu_mhz', 'free_cpu_mhz', 'vm_count')
+
+    def __init__(self, obj, name, pool, datastores, memory_mb,
+                 free_memory_mb, cpu_mhz, free_cpu_mhz, vm_count):
+        self.obj = obj
+        self.name = name
+        self.pool = pool
+        self.datastores = datastores
+        self.memory_mb = memory_mb
+        self.free_memory_mb = free_memory_mb
+        self.cpu_mhz = cpu_mhz
+        self.free_cpu_mhz = free_cpu_mhz
+        self.vm_count = vm_count
+
+
+class DatastoreCapacity(object):
+
+    __slots__ = ('obj', 'name', 'capacity_gb', 'free_gb', 'vm_count')
+
+    def __init__(self, obj, name, capacity_gb, free_gb, vm_count):
+        self.obj = obj
+        self.name = name
+        self.capacity_gb = capacity_gb
+        self.free_gb = free_gb
+        self.vm_count = vm_count
+
+
+def _check_strategy(strategy):
+    if strategy not in STRATEGIES:
+        raise ValueError("Unknown strategy %r, expected one of %s"
+                         % (strategy, ', '.join(STRATEGIES)))
+
+
+def vm_requirements(spec, mhz_per_vcpu=500):
+    """
+    Returns (memory_mb, cpu_mhz, space_gb) a provisioning spec (see
+    VCenterApi.provision_vms) needs. Space counts the disks plus the
+    swap file, which is as large as the VM memory.
+    """
+    memory_mb = spec.get('memory_mb', 1024)
+    cpu_mhz = spec.get('num_cpus', 4) * mhz_per_vcpu
+    space_gb = sum(size for size, _ in spec.get('disks', []))
+    space_gb += spec.get('disk_gb', 0) + memory_mb / 1024.0
+    return memory_mb, cpu_mhz, space_gb
+
+
+class PlacementEngine(object):
+    """
+    Chooses host, resource pool and datastore for new VMs.
+    """
+
+    def __init__(self, service_instance, strategy='spread', max_age=300,
+                 memory_headroom=0.1, cpu_headroom=0.2, space_headroom=0.1,
+                 mhz_per_vcpu=500):
+        """
+        - `max_age` (float) seconds before the snapshot is retaken on the
+          next `place`, None keeps it until `refresh`.
+        - `memory_headroom`, `cpu_headroom`, `space_headroom` (float)
+          fraction of each host's memory and CPU and of each datastore's
+          capacity that placements never use.
+        - `mhz_per_vcpu` (int) CPU demand assumed per vCPU.
+        """
+        _check_strategy(strategy)
+        self.service_instance = service_instance
+        self.strategy = strategy
+        self.max_age = max_age
+        self.memory_headroom = memory_headroom
+        self.cpu_headroom = cpu_headroom
+        self.space_headroom = space_headroom
+        self.mhz_per_vcpu = mhz_per_vcpu
+        self.loaded_at = None
+        self._lock = threading.RLock()
+        self._hosts = {}
+        self._datastores = {}
+        self._pending = []
+
+    def refresh(self):
+        """
+        Retakes the capacity snapshot, keeping uncommitted reservations.
+        """
+        si = self.service_instance
+        hosts = pchelper.collect_all(si, vim.HostSystem, HOST_PROPERTIES)
+        datastores = pchelper.collect_all(si, vim.Datastore,
+                                          DATASTORE_PROPERTIES)
+        computes = pchelper.collect_all(si, vim.ComputeResource,
+                                        COMPUTE_PROPERTIES)
+        with self._lock:
+            self.load(hosts, datastores, computes)
+            for placement in self._pending:
+                self._reserve(placement, 1)
+
+    def load(self, hosts, datastores, computes):
+        """
+        Builds the model from property rows (as returned by
+        pchelper.collect_all with the *_PROPERTIES path sets).
+        """
+        pools = dict((row['obj']._moId, row.get('resourcePool'))
+                     for row in computes)
+        with self._lock:
+            self._datastores = {}
+            for row in datastores:
+                if not row.get('summary.accessible', True):
+                    continue
+                capacity = (row.get('summary.capacity') or 0) / 1024.0 ** 3
+                free = (row.get('summary.freeSpace') or 0) / 1024.0 ** 3
+                self._datastores[row['obj']._moId] = DatastoreCapacity(
+                    row['obj'], row.get('name'), capacity,
+                    free - capacity * self.space_headroom,
+                    len(row.get('vm') or []))
+            self._hosts = {}
+            for row in hosts:
+                if (row.get('runtime.connectionState') != 'connected' or
+                        row.get('runtime.inMaintenanceMode')):
+                    continue
+                parent = row.get('parent')
+                memory = (row.get('summary.hardware.memorySize') or 0) \
+                    / 1024.0 ** 2
+                cpu = ((row.get('summary.hardware.cpuMhz') or 0) *
+                       (row.get('summary.hardware.numCpuCores') or 0))
+                self._hosts[row['obj']._moId] = HostCapacity(
+                    row['obj'], row.get('name'),
+                    pools.get(parent._moId) if parent is not None else None,
+                    [ds._moId for ds in row.get('datastore') or []
+                     if ds._moId in self._datastores],
+                    memory,
+                    memory * (1 - self.memory_headroom) -
+                    (row.get('summary.quickStats.overallMemoryUsage') or 0),
+                    cpu,
+                    cpu * (1 - self.cpu_headroom) -
+                    (row.get('summary.quickStats.overallCpuUsage') or 0),
+                    len(row.get('vm') or []))
+            self.loaded_at = time.time()
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        if self.max_age is None:
+            return False
+        return time.time() - self.loaded_at > self.max_age
+
+    def place(self, specs, strategy=None):
+        """
+        Places a batch of provisioning specs and returns one Placement per
+        spec, in the order given. Honours 'host' and 'datastore_name' when
+        a spec already names them. Raises ValueError, reserving nothing,
+        when a spec fits nowhere.
+
+        - `strategy` (str) 'spread' or 'pack' for this batch only, the
+          engine's strategy when None.
+        """
+        if strategy is None:
+            strategy = self.strategy
+        _check_strategy(strategy)
+        specs = list(specs)
+        with self._lock:
+            if self.is_stale():
+                self.refresh()
+            order = sorted(range(len(specs)),
+                           key=lambda i: vm_requirements(
+                               specs[i], self.mhz_per_vcpu),
+                           reverse=True)
+            placements = [None] * len(specs)
+            try:
+                for i in order:
+                    placement = self._place_one(specs[i], strategy)
+                    self._reserve(placement, 1)
+                    self._pending.append(placement)
+                    placements[i] = placement
+            except ValueError:
+                for placement in placements:
+                    if placement is not None:
+                        self.release(placement)
+                raise
+            return placements
+
+    def commit(self, placement):
+        """
+        The VM was created; its capacity stays reserved until the next
+        snapshot, which accounts for it.
+        """
+        with self._lock:
+            self._forget(placement)
+
+    def release(self, placement):
+        """
+        The VM was not created; gives the reserved capacity back.
+        """
+        with self._lock:
+            if self._forget(placement):
+                self._reserve(placement, -1)
+
+    def hosts(self):
+        with self._lock:
+            return list(self._hosts.values())
+
+    def datastores(self):
+        with self._lock:
+            return list(self._datastores.values())
+
+    def _place_one(self, spec, strategy):
+        memory_mb, cpu_mhz, space_gb = vm_requirements(spec,
+                                                       self.mhz_per_vcpu)
+        host_name = spec.get('host')
+        if host_name is not None and not isinstance(host_name, str):
+            host_name = host_name.name
+        datastore_name = spec.get('datastore_name')
+        best = None
+        for host in self._hosts.values():
+            if host_name is not None and host.name != host_name:
+                continue
+            if (host.free_memory_mb < memory_mb or
+                    host.free_cpu_mhz < cpu_mhz):
+                continue
+            for moref in host.datastores:
+                datastore = self._datastores[moref]
+                if (datastore_name is not None and
+                        datastore.name != datastore_name):
+                    continue
+                if datastore.free_gb < space_gb:
+                    continue
+                score = self._score(host, datastore, memory_mb, cpu_mhz,
+                                    space_gb, strategy)
+                if best is None or score > best[0]:
+                    best = (score, host, datastore)
+        if best is None:
+            raise ValueError("No host/datastore has room for %s "
+                             "(%d MB, %d MHz, %.1f GB)"
+                             % (spec.get('vm_name'), memory_mb, cpu_mhz,
+                                space_gb))
+        _, host, datastore = best
+        return Placement(spec.get('vm_name'), host.obj,
+                         spec.get('resource_pool') or host.pool,
+                         datastore.obj, memory_mb, cpu_mhz, space_gb,
+                         host.name, datastore.name)
+
+    def _score(self, host, datastore, memory_mb, cpu_mhz, space_gb,
+               strategy):
+        # Fraction of each resource left after the placement; the host's
+        # tightest resource counts double so one exhausted dimension is
+        # not hidden by plenty of the other.
+        memory_left = (host.free_memory_mb - memory_mb) / max(host.memory_mb,
+                                                              1)
+        cpu_left = (host.free_cpu_mhz - cpu_mhz) / max(host.cpu_mhz, 1)
+        space_left = ((datastore.free_gb - space_gb) /
+                      max(datastore.capacity_gb, 1))
+        score = (memory_left + cpu_left + min(memory_left, cpu_left) +
+                 space_left)
+        # Fewer VMs is a tie-breaker, it also spreads boot storms.
+        score -= 0.001 * (host.vm_count + datastore.vm_count)
+        if strategy == 'pack':
+            return -score
+        return score
+
+    def _reserve(self, placement, sign):
+        host = self._hosts.get(placement.host._moId)
+        if host is not None:
+            host.free_memory_mb -= sign * placement.memory_mb
+            host.free_cpu_mhz -= sign * placement.cpu_mhz
+            host.vm_count += sign
+        datastore = self._datastores.get(placement.datastore._moId)
+        if datastore is not None:
+            datastore.free_gb -= sign * placement.space_gb
+            datastore.vm_count += sign
+
+    def _forget(self, placement):
+        for i, pending in enumerate(self._pending):
+            if pending is placement:
+                del self._pending[i]
+                return True
+        return False
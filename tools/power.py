@@ -0,0 +1,209 @@
+"""
+Fleet power operations.
+
+Power-on is grouped per datacenter into Datacenter.PowerOnMultiVM_Task
+calls; power-off and suspend are fanned out through
+`tools.scheduler.TaskScheduler` under a concurrency cap. Questions raised
+while powering on (e.g. "moved or copied?") are answered from a policy
+instead of stdin, so bulk runs never block.
+
+Policies:
+    'default'          pick the question's default choice (or the first)
+    {'copied': '2'}    text fragment -> choice key or label, falls back to
+                       the default choice
+    callable           called with the vim.vm.Question, returns a key
+"""
+import logging
+import queue
+
+from tools import pchelper
+from tools import scheduler
+from tools import tasks
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+def choose_answer(question, policy='default'):
+    """
+    Returns the choice key to answer `question` with under `policy`.
+    """
+    choices = question.choice.choiceInfo
+    if callable(policy):
+        return policy(question)
+    if isinstance(policy, dict):
+        for fragment, wanted in policy.items():
+            if fragment in (question.text or ''):
+                for option in choices:
+                    if wanted in (option.key, option.label):
+                        return option.key
+    index = question.choice.defaultIndex
+    if index is None:
+        index = 0
+    return choices[index].key
+
+
+def group_by_datacenter(service_instance, vms):
+    """
+    Maps each datacenter to the subset of `vms` it contains. VMs in no
+    datacenter are left out.
+
+    Only the selected VMs are read: their parent chains are walked one
+    level per property retrieval, each shared folder or pool once, so the
+    cost follows the folder depth, not the size of the inventory.
+    """
+    parents = {}
+    rows = pchelper.collect_objects(service_instance, list(vms),
+                                    vim.VirtualMachine,
+                                    ['parent', 'parentVApp'])
+    for row in rows:
+        # VMs inside a vApp have no parent folder.
+        parents[row['obj']._moId] = row.get('parent') or row.get('parentVApp')
+    level = [parent for parent in parents.values() if parent is not None]
+    while level:
+        pending = dict((obj._moId, obj) for obj in level
+                       if obj._moId not in parents and
+                       not isinstance(obj, vim.Datacenter))
+        if not pending:
+            break
+        for moref in pending:
+            parents[moref] = None
+        for row in pchelper.collect_objects(service_instance,
+                                            list(pending.values()),
+                                            vim.ManagedEntity, ['parent']):
+            parents[row['obj']._moId] = row.get('parent')
+        level = [parents[moref] for moref in pending
+                 if parents[moref] is not None]
+
+    groups = {}
+    datacenters = {}
+    for vm in vms:
+        node = parents.get(vm._moId)
+        while node is not None and not isinstance(node, vim.Datacenter):
+            node = parents.get(node._moId)
+        if node is None:
+            logging.debug("VM outside any datacenter: %s", vm._moId)
+            continue
+        datacenter = datacenters.setdefault(node._moId, node)
+        groups.setdefault(datacenter, []).append(vm)
+    return groups
+
+
+def power_on_vms(service_instance, vms, policy='default', timeout=None):
+    """
+    Powers on `vms` with one PowerOnMultiVM_Task per datacenter.
+
+    Questions are answered from the calling thread: the watcher thread
+    only queues them, it never waits on AnswerVM or on `policy`.
+
+    Returns {vm moref: {'ok': bool, 'error': fault or None}}.
+    """
+    watcher = tasks.get_watcher(service_instance)
+    results = dict((vm._moId, {'ok': False, 'error': None}) for vm in vms)
+    events = queue.Queue()
+    pending = {}
+    answered = set()
+
+    def on_question(vm, changes):
+        question = changes.get('runtime.question')
+        if question is not None:
+            events.put(('question', vm, question))
+
+    def track(future, members):
+        pending[future] = members
+        future.add_done_callback(lambda done: events.put(('done', done,
+                                                          None)))
+
+    for vm in vms:
+        watcher.observe(vm, ['runtime.question'], on_question)
+    try:
+        groups = group_by_datacenter(service_instance, vms)
+        grouped = set(vm._moId for members in groups.values()
+                      for vm in members)
+        for vm in vms:
+            if vm._moId not in grouped:
+                results[vm._moId]['error'] = ValueError(
+                    "%s is not in any datacenter" % vm._moId)
+        for datacenter, members in groups.items():
+            task = datacenter.PowerOnMultiVM_Task(vm=members)
+            track(watcher.watch(task, timeout=timeout), ('multi', members))
+        while pending:
+            kind, subject, question = events.get()
+            if kind == 'question':
+                if question.id in answered:
+                    continue
+                answered.add(question.id)
+                key = choose_answer(question, policy)
+                logging.info("Answering %s question %s with %s",
+                             subject._moId, question.id, key)
+                try:
+                    subject.AnswerVM(question.id, key)
+                except Exception:
+                    logging.warning("Answering %s failed", subject._moId,
+                                    exc_info=True)
+                continue
+            kind, target = pending.pop(subject)
+            if kind == 'vm':
+                entry = results[target._moId]
+                try:
+                    subject.result()
+                    entry['ok'] = True
+                except Exception as e:
+                    entry['error'] = e
+                continue
+            try:
+                result = subject.result()
+            except Exception as e:
+                for vm in target:
+                    results[vm._moId]['error'] = e
+                continue
+            for attempt in result.attempted or []:
+                if attempt.task is not None:
+                    track(watcher.watch(attempt.task, timeout=timeout),
+                          ('vm', attempt.vm))
+                else:
+                    # DRS recommendation applied without a separate task
+                    results[attempt.vm._moId]['ok'] = True
+            for failure in result.notAttempted or []:
+                results[failure.vm._moId]['error'] = failure.fault
+    finally:
+        for vm in vms:
+            watcher.unobserve(vm, on_question)
+    return results
+
+
+def power_off_vms(service_instance, vms, max_concurrency=16):
+    """
+    Powers off `vms`, at most `max_concurrency` tasks at a time.
+    """
+    return _fan_out(service_instance, vms, 'PowerOffVM_Task',
+                    max_concurrency)
+
+
+def suspend_vms(service_instance, vms, max_concurrency=16):
+    """
+    Suspends the powered-on VMs among `vms`, at most `max_concurrency`
+    tasks at a time. Other VMs are reported as skipped.
+    """
+    rows = pchelper.collect_objects(service_instance, vms, vim.VirtualMachine,
+                                    path_set=['runtime.powerState'])
+    states = dict((row['obj']._moId, row.get('runtime.powerState'))
+                  for row in rows)
+    running = [vm for vm in vms if states.get(vm._moId) == 'poweredOn']
+    results = _fan_out(service_instance, running, 'SuspendVM_Task',
+                       max_concurrency)
+    for vm in vms:
+        results.setdefault(vm._moId, {'ok': True, 'error': None,
+                                      'skipped': True})
+    return results
+
+
+def _fan_out(service_instance, vms, method, max_concurrency):
+    jobs = [scheduler.Job(vm._moId,
+                          [lambda _, vm=vm: getattr(vm, method)()])
+            for vm in vms]
+    runner = scheduler.TaskScheduler(service_instance,
+                                     max_in_flight=max_concurrency)
+    return dict((job.name, {'ok': job.ok, 'error': job.error,
+                            'elapsed': job.elapsed})
+                for job in runner.run(jobs))
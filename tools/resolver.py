@@ -0,0 +1,164 @@
+"""
+Bulk VM resolution by UUID, IP address and DNS name.
+
+Batches of identifiers are answered from a local index built with one
+property retrieval over all VMs (BIOS and instance UUIDs, guest IPs from
+guest.ipAddress and guest.net, guest host name). Only identifiers the index
+does not know are sent to SearchIndex (FindByUuid, FindByIp,
+FindAllByDnsName), concurrently. Identifiers vCenter does not know either
+are remembered for `negative_ttl` seconds, so repeated pipelines do not ask
+again.
+
+Usage:
+    resolver = VmResolver(si)
+    resolver.by_uuid(['4207...', '5009...'])   # {uuid: vm or None}
+    resolver.by_ip(['10.0.0.11'])              # {ip: vm or None}
+    resolver.by_dns(['web-01.example.com'])    # {name: [vm, ...]}
+"""
+import concurrent.futures
+import threading
+import time
+
+from tools import pchelper
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+RESOLVER_PROPERTIES = [
+    'config.uuid',
+    'config.instanceUuid',
+    'guest.ipAddress',
+    'guest.net',
+    'guest.hostName',
+]
+
+
+class VmResolver(object):
+    """
+    Batch resolver with a local index, SearchIndex fallback and negative
+    caching.
+    """
+
+    def __init__(self, service_instance, max_age=300, negative_ttl=60,
+                 max_workers=8, datacenter=None):
+        """
+        - `max_age` (float) seconds before the index is rebuilt on the next
+          lookup, None keeps it until `refresh`.
+        - `negative_ttl` (float) seconds a miss is cached.
+        - `max_workers` (int) concurrent SearchIndex calls for misses.
+        - `datacenter` (vim.Datacenter) limits the fallback searches.
+        """
+        self.service_instance = service_instance
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self.datacenter = datacenter
+        self.loaded_at = None
+        self._lock = threading.RLock()
+        self._uuids = {}
+        self._ips = {}
+        self._names = {}
+        self._misses = {}
+
+    def refresh(self):
+        rows = pchelper.collect_all(self.service_instance, vim.VirtualMachine,
+                                    RESOLVER_PROPERTIES)
+        uuids, ips, names = {}, {}, {}
+        for row in rows:
+            vm = row['obj']
+            for path in ('config.uuid', 'config.instanceUuid'):
+                if row.get(path):
+                    uuids[row[path].lower()] = vm
+            addresses = set()
+            if row.get('guest.ipAddress'):
+                addresses.add(row['guest.ipAddress'])
+            for nic in row.get('guest.net') or []:
+                addresses.update(nic.ipAddress or [])
+            for address in addresses:
+                ips.setdefault(address, vm)
+            if row.get('guest.hostName'):
+                names.setdefault(row['guest.hostName'].lower(), []).append(vm)
+        with self._lock:
+            self._uuids, self._ips, self._names = uuids, ips, names
+            self._misses = {}
+            self.loaded_at = time.time()
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        if self.max_age is None:
+            return False
+        return time.time() - self.loaded_at > self.max_age
+
+    def by_uuid(self, uuids):
+        """
+        Returns {uuid: vm or None}; BIOS and instance UUIDs both match.
+        """
+        search_index = self.service_instance.content.searchIndex
+
+        def find(uuid):
+            vm = search_index.FindByUuid(self.datacenter, uuid, True, False)
+            if vm is None:
+                vm = search_index.FindByUuid(self.datacenter, uuid, True,
+                                             True)
+            return vm
+        return self._resolve('uuid', uuids, find,
+                             normalize=lambda uuid: uuid.lower())
+
+    def by_ip(self, ips):
+        """
+        Returns {ip: vm or None}.
+        """
+        search_index = self.service_instance.content.searchIndex
+        return self._resolve(
+            'ip', ips,
+            lambda ip: search_index.FindByIp(self.datacenter, ip, True))
+
+    def by_dns(self, names):
+        """
+        Returns {name: [vm, ...]}, an empty list for unknown names.
+        """
+        search_index = self.service_instance.content.searchIndex
+        result = self._resolve(
+            'dns', names,
+            lambda name: list(search_index.FindAllByDnsName(
+                self.datacenter, name, True)) or None,
+            normalize=lambda name: name.lower())
+        return dict((name, vms or []) for name, vms in result.items())
+
+    def _resolve(self, kind, keys, find, normalize=None):
+        normalize = normalize or (lambda key: key)
+        keys = list(keys)
+        if self.is_stale():
+            self.refresh()
+        now = time.time()
+        result = {}
+        misses = []
+        with self._lock:
+            table = self._table(kind)
+            for key in keys:
+                found = table.get(normalize(key))
+                if found is not None:
+                    result[key] = found
+                elif self._misses.get((kind, normalize(key)), 0) > now:
+                    result[key] = None
+                elif key not in misses:
+                    misses.append(key)
+        if misses:
+            with concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers) as pool:
+                found = list(pool.map(find, misses))
+            with self._lock:
+                table = self._table(kind)
+                for key, value in zip(misses, found):
+                    result[key] = value
+                    if value is None:
+                        self._misses[(kind, normalize(key))] = (
+                            now + self.negative_ttl)
+                    else:
+                        table[normalize(key)] = value
+        return result
+
+    def _table(self, kind):
+        return {'uuid': self._uuids, 'ip': self._ips, 'dns': self._names}[kind]
@@ -0,0 +1,187 @@
+"""
+Bounded concurrent task scheduler.
+
+Runs many multi-step jobs (e.g. CreateVM_Task followed by PowerOnVM_Task)
+against vCenter at the same time. Each step only *submits* a task, so all
+jobs are driven from a single thread; the outstanding tasks are watched
+through one `tools.tasks.TaskCollector`. Limits cap the number of jobs in
+flight overall and per key (host, datastore, ...).
+
+Usage:
+    jobs = [Job('vm-01', [lambda _: folder.CreateVM_Task(config, pool)],
+                keys={'host': 'esx-01', 'datastore': 'ds-01'})]
+    TaskScheduler(si, limits={'host': 2, 'datastore': 4},
+                  max_in_flight=16).run(jobs)
+"""
+import collections
+import logging
+import time
+
+from tools import tasks
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+
+
+class Job(object):
+    """
+    One unit of work: a list of steps run in order.
+
+    A step is a callable taking the latest task result that was not None
+    (None for the first step) and returning the next vim.Task, or None to
+    skip. That result is also the job's `result`.
+    """
+
+    def __init__(self, name, steps, keys=None):
+        self.name = name
+        self.steps = list(steps)
+        self.keys = dict(keys or {})
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.step_times = []
+        self._step = 0
+        self._step_started = None
+
+    @property
+    def ok(self):
+        return self.finished is not None and self.error is None
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'ok': self.ok,
+            'result': self.result,
+            'error': self.error,
+            'elapsed': self.elapsed,
+            'step_times': list(self.step_times),
+        }
+
+
+class TaskScheduler(object):
+    """
+    Drives jobs with bounded parallelism.
+    """
+
+    def __init__(self, service_instance, limits=None, max_in_flight=None,
+                 poll_seconds=30):
+        """
+        - `limits` (dict) key name -> max jobs in flight sharing the same
+          value for that key, e.g. {'host': 2, 'datastore': 4}.
+        - `max_in_flight` (int) overall cap for this vCenter.
+        - `poll_seconds` (int) upper bound for one WaitForUpdatesEx call.
+        """
+        self.service_instance = service_instance
+        self.limits = dict(limits or {})
+        self.max_in_flight = max_in_flight
+        self.poll_seconds = poll_seconds
+        self._in_flight = collections.Counter()
+        self._running = 0
+
+    def run(self, jobs):
+        """
+        Runs all jobs to completion and returns them. Failures are recorded
+        on the job (`job.error`) instead of being raised.
+        """
+        pending = collections.deque(jobs)
+        running = {}
+        collector = tasks.TaskCollector(self.service_instance)
+        try:
+            while pending or running:
+                self._admit(pending, running, collector)
+                if not running:
+                    # Nothing in flight yet nothing admitted: the limits
+                    # can never be met (e.g. a limit of 0).
+                    for job in pending:
+                        job.started = time.time()
+                        self._done(job, error=ValueError(
+                            "Job %s exceeds the configured limits" % job.name),
+                            release=False)
+                    pending.clear()
+                    continue
+                for update in collector.wait(self.poll_seconds):
+                    if update.state not in tasks.TERMINAL_STATES:
+                        continue
+                    job = running.pop(update.task._moId, None)
+                    if job is None:
+                        continue
+                    self._finish_step(job, update)
+                    if job.finished is None:
+                        self._next_step(job, running, collector)
+        finally:
+            collector.close()
+        return list(jobs)
+
+    def _admit(self, pending, running, collector):
+        blocked = collections.deque()
+        while pending:
+            job = pending.popleft()
+            if not self._has_capacity(job):
+                blocked.append(job)
+                continue
+            self._acquire(job)
+            job.started = time.time()
+            self._next_step(job, running, collector)
+        pending.extend(blocked)
+
+    def _next_step(self, job, running, collector):
+        while job._step < len(job.steps):
+            step = job.steps[job._step]
+            job._step_started = time.time()
+            try:
+                task = step(job.result)
+            except Exception as e:
+                logging.debug("Job %s failed to submit step %d", job.name,
+                              job._step, exc_info=True)
+                self._done(job, error=e)
+                return
+            if task is None:
+                job._step += 1
+                continue
+            collector.add(task)
+            running[task._moId] = job
+            return
+        self._done(job)
+
+    def _finish_step(self, job, update):
+        job.step_times.append(time.time() - job._step_started)
+        job._step += 1
+        if update.state == vim.TaskInfo.State.error:
+            self._done(job, error=update.error)
+        elif update.result is not None:
+            # A later step without a result (PowerOnVM_Task) keeps the
+            # entity an earlier one created.
+            job.result = update.result
+
+    def _done(self, job, error=None, release=True):
+        job.error = error
+        job.finished = time.time()
+        if release:
+            self._release(job)
+
+    def _has_capacity(self, job):
+        if (self.max_in_flight is not None and
+                self._running >= self.max_in_flight):
+            return False
+        for name, value in job.keys.items():
+            limit = self.limits.get(name)
+            if limit is not None and self._in_flight[(name, value)] >= limit:
+                return False
+        return True
+
+    def _acquire(self, job):
+        self._running += 1
+        for name, value in job.keys.items():
+            self._in_flight[(name, value)] += 1
+
+    def _release(self, job):
+        self._running -= 1
+        for name, value in job.keys.items():
+            self._in_flight[(name, value)] -= 1
@@ -19,7 +19,10 @@ Utility functions for the vSphere API
 See com.vmware.apputils.vim25.ServiceUtil in the java API.
 """
 
-from pyVmomi import vim, vmodl
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+vmodl = lazy_import('pyVmomi', 'vmodl')
 
 
 def build_full_traversal():
@@ -132,4 +135,24 @@ def build_full_traversal():
     return fullTraversal
 
 
+def build_full_traversal_filter_spec(root, obj_type, path_set=None):
+    """
+    Builds a filter spec returning `path_set` of every `obj_type` object
+    reachable from `root` (usually the root folder) through
+    build_full_traversal, for a single RetrievePropertiesEx call instead
+    of walking the inventory one childEntity read at a time.
+    """
+    PropertyCollector = vmodl.query.PropertyCollector
+
+    obj_spec = PropertyCollector.ObjectSpec(obj=root, skip=False,
+                                            selectSet=build_full_traversal())
+    property_spec = PropertyCollector.PropertySpec(type=obj_type)
+    if path_set:
+        property_spec.pathSet = list(path_set)
+    else:
+        property_spec.all = True
+    return PropertyCollector.FilterSpec(objectSet=[obj_spec],
+                                        propSet=[property_spec])
+
+
 # vim: set ts=4 sw=4 expandtab filetype=python:
@@ -0,0 +1,368 @@
+"""
+vCenter session helpers.
+
+`connect` opens one authenticated ServiceInstance. `SessionPool` keeps a
+number of them for worker threads: sessions are handed out and returned,
+idle ones are kept alive with CurrentTime, and a call that fails with
+NotAuthenticated logs in again on the same stub and is repeated, so anybody
+holding a pooled ServiceInstance (a VCenterApi built on it, a helper
+thread) keeps working after the session expired.
+
+`SessionCache` keeps session cookies on disk so short-lived scripts can
+resume an existing session instead of logging in every time.
+
+Usage:
+    si = connect_cached('vc.example.com', 'user', 'secret', SessionCache())
+
+    pool = SessionPool('vc.example.com', 'user', 'secret', size=4)
+    with pool.session() as si:
+        si.content.rootFolder.childEntity
+    pool.call(lambda si: si.content.about.fullName)
+    pool.metrics()
+"""
+import collections
+import contextlib
+import json
+import logging
+import os
+import ssl
+import tempfile
+import threading
+import time
+
+from tools import instrument
+from tools import tasks
+from tools.lazy import lazy_import
+
+SmartConnect = lazy_import('pyVim.connect', 'SmartConnect')
+SmartStubAdapter = lazy_import('pyVim.connect', 'SmartStubAdapter')
+Disconnect = lazy_import('pyVim.connect', 'Disconnect')
+vim = lazy_import('pyVmomi', 'vim')
+
+
+def ssl_context():
+    """
+    Unverified SSL context, as used by VCenterApi.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def connect(host, user, pwd, port=443, context=None, soap_stats=None):
+    """
+    Logs in and returns a ServiceInstance.
+
+    - `soap_stats` (instrument.SoapStats) record the SOAP calls of the
+      connection, the login included.
+    """
+    if soap_stats is None:
+        return SmartConnect(host=host, user=user, pwd=pwd, port=port,
+                            sslContext=context or ssl_context())
+    stub = SmartStubAdapter(host=host, port=port,
+                            sslContext=context or ssl_context())
+    si = vim.ServiceInstance('ServiceInstance', stub)
+    instrument.instrument(si, stats=soap_stats)
+    si.content.sessionManager.Login(userName=user, password=pwd)
+    return si
+
+
+class SessionCache(object):
+    """
+    Session cookies on disk, keyed by user, server and port.
+
+    The file and its directory are only accessible to the current user;
+    the cookie grants the same rights as the password.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cache',
+                                'vcenter_api', 'sessions.json')
+        self.path = path
+
+    @staticmethod
+    def key(host, user, port=443):
+        return '%s@%s:%s' % (user, host, port)
+
+    def get(self, host, user, port=443):
+        return self._load().get(self.key(host, user, port))
+
+    def put(self, host, user, port, cookie):
+        data = self._load()
+        data[self.key(host, user, port)] = cookie
+        self._save(data)
+
+    def forget(self, host, user, port=443):
+        data = self._load()
+        if data.pop(self.key(host, user, port), None) is not None:
+            self._save(data)
+
+    def _load(self):
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save(self, data):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        # Write to a private temp file and rename, so concurrent scripts
+        # never read a half written file.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.sessions')
+        try:
+            os.chmod(tmp_path, 0o600)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+def resume(host, cookie, port=443, context=None, soap_stats=None):
+    """
+    Returns a ServiceInstance using an existing session `cookie`, or None
+    if vCenter no longer knows the session. Costs the usual service
+    content retrieval plus one currentSession read.
+    """
+    stub = SmartStubAdapter(host=host, port=port,
+                            sslContext=context or ssl_context())
+    stub.cookie = cookie
+    si = vim.ServiceInstance('ServiceInstance', stub)
+    if soap_stats is not None:
+        instrument.instrument(si, stats=soap_stats)
+    try:
+        if si.content.sessionManager.currentSession is None:
+            return None
+    except vim.fault.NotAuthenticated:
+        return None
+    return si
+
+
+def connect_cached(host, user, pwd, cache, port=443, context=None,
+                   soap_stats=None):
+    """
+    Resumes the cached session for user@host when it is still alive,
+    otherwise logs in and caches the new session cookie.
+
+    Sessions obtained this way must not be logged out at exit (no
+    Disconnect), or the cached cookie dies with the script.
+    """
+    cookie = cache.get(host, user, port)
+    if cookie:
+        si = resume(host, cookie, port=port, context=context,
+                    soap_stats=soap_stats)
+        if si is not None:
+            return si
+        cache.forget(host, user, port)
+    si = connect(host, user, pwd, port=port, context=context,
+                 soap_stats=soap_stats)
+    cache.put(host, user, port, si._stub.cookie)
+    return si
+
+
+class SessionPool(object):
+    """
+    Thread-safe pool of authenticated ServiceInstances.
+    """
+
+    def __init__(self, host, user, pwd, port=443, size=4,
+                 keepalive_seconds=300, context=None):
+        """
+        - `size` (int) maximum number of sessions; they are created lazily.
+        - `keepalive_seconds` (int) interval of the CurrentTime keepalive on
+          idle sessions, None disables the keepalive thread.
+        """
+        self.host = host
+        self.user = user
+        self.pwd = pwd
+        self.port = port
+        self.size = size
+        self.keepalive_seconds = keepalive_seconds
+        self.context = context
+        # (si, time it was released) pairs, oldest first.
+        self._idle = collections.deque()
+        self._all = []
+        self._cond = threading.Condition()
+        self._login_lock = threading.Lock()
+        self._closed = False
+        self._stopped = threading.Event()
+        self._metrics = collections.Counter()
+        self._keepalive = None
+        if keepalive_seconds:
+            self._keepalive = threading.Thread(target=self._keepalive_loop,
+                                               name='vcenter-keepalive')
+            self._keepalive.daemon = True
+            self._keepalive.start()
+
+    def acquire(self, timeout=None):
+        """
+        Takes a session out of the pool, logging in a new one while the pool
+        is below `size`. Blocks up to `timeout` seconds when all sessions
+        are busy.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            waited = False
+            while True:
+                if self._closed:
+                    raise RuntimeError("SessionPool is closed")
+                if self._idle:
+                    si, _ = self._idle.popleft()
+                    self._metrics['reuses'] += 1
+                    return si
+                if len(self._all) < self.size:
+                    # Reserve the slot, log in outside the lock.
+                    self._all.append(None)
+                    break
+                if not waited:
+                    self._metrics['waits'] += 1
+                    waited = True
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError("No vCenter session available "
+                                           "within %s seconds" % timeout)
+                self._cond.wait(remaining)
+        try:
+            si = connect(self.host, self.user, self.pwd, port=self.port,
+                         context=self.context)
+        except Exception:
+            with self._cond:
+                self._all.remove(None)
+                self._cond.notify()
+            raise
+        self._reauthenticate(si)
+        with self._cond:
+            self._all[self._all.index(None)] = si
+            self._metrics['logins'] += 1
+        return si
+
+    def release(self, si):
+        """
+        Returns a session to the pool; after close() it is logged out.
+        """
+        with self._cond:
+            if not self._closed:
+                self._idle.append((si, time.time()))
+                self._cond.notify()
+                return
+            if si in self._all:
+                self._all.remove(si)
+        _disconnect(si)
+
+    @contextlib.contextmanager
+    def session(self, timeout=None):
+        si = self.acquire(timeout)
+        try:
+            yield si
+        finally:
+            self.release(si)
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs func(si, *args, **kwargs) on a pooled session.
+        """
+        with self.session() as si:
+            return func(si, *args, **kwargs)
+
+    def relogin(self, si):
+        """
+        Logs in again on the existing stub; the new session cookie replaces
+        the old one for every holder of `si`.
+        """
+        si.content.sessionManager.Login(userName=self.user,
+                                        password=self.pwd)
+        self._count('relogins')
+
+    def metrics(self):
+        with self._cond:
+            data = dict(self._metrics)
+            data.update(size=self.size,
+                        open=len([si for si in self._all if si is not None]),
+                        idle=len(self._idle))
+        for key in ('waits', 'logins', 'reuses', 'relogins', 'keepalives',
+                    'keepalive_failures'):
+            data.setdefault(key, 0)
+        return data
+
+    def close(self):
+        """
+        Logs out the idle sessions and stops the keepalive thread. Sessions
+        still checked out are logged out when they are released.
+        """
+        with self._cond:
+            self._closed = True
+            self._stopped.set()
+            sessions = [si for si, _ in self._idle]
+            self._idle.clear()
+            for si in sessions:
+                self._all.remove(si)
+            self._cond.notify_all()
+        for si in sessions:
+            _disconnect(si)
+
+    def _keepalive_loop(self):
+        while not self._stopped.wait(self.keepalive_seconds):
+            with self._cond:
+                if self._closed:
+                    return
+                now = time.time()
+                due = [entry for entry in self._idle
+                       if now - entry[1] >= self.keepalive_seconds]
+                for entry in due:
+                    self._idle.remove(entry)
+            for si, _ in due:
+                self._ping(si)
+                self.release(si)
+
+    def _ping(self, si):
+        # An expired session logs in again inside CurrentTime.
+        try:
+            si.CurrentTime()
+            self._count('keepalives')
+        except Exception:
+            logging.warning("vCenter keepalive failed", exc_info=True)
+            self._count('keepalive_failures')
+
+    def _count(self, name):
+        with self._cond:
+            self._metrics[name] += 1
+
+    def _reauthenticate(self, si):
+        # Wraps the stub of `si`: a call failing with NotAuthenticated logs
+        # in again and is repeated once. Threads that hit the same expired
+        # session log in only once, the others see the cookie has changed.
+        stub = si._stub
+        invoke = stub.InvokeMethod
+        local = threading.local()
+
+        def invoke_method(mo, info, args, *rest, **kwargs):
+            if getattr(local, 'login', False):
+                return invoke(mo, info, args, *rest, **kwargs)
+            cookie = stub.cookie
+            try:
+                return invoke(mo, info, args, *rest, **kwargs)
+            except vim.fault.NotAuthenticated:
+                with self._login_lock:
+                    if stub.cookie == cookie:
+                        local.login = True
+                        try:
+                            self.relogin(si)
+                        finally:
+                            local.login = False
+            return invoke(mo, info, args, *rest, **kwargs)
+
+        stub.InvokeMethod = invoke_method
+
+
+def _disconnect(si):
+    try:
+        tasks.close_watcher(si)
+        Disconnect(si)
+    except Exception:
+        logging.debug("Disconnect failed", exc_info=True)
@@ -0,0 +1,190 @@
+"""
+Bulk snapshot operations.
+
+Creates, reverts, removes or consolidates snapshots on many VMs at once.
+The VMs' host, configuration datastore and snapshot trees are read with
+one property retrieval, then one scheduler job per VM is run by
+`tools.scheduler.TaskScheduler`: every task is watched through the same
+PropertyCollector filter, and limits cap the tasks in flight per host and
+per datastore, so a patch wave does not flood one array with delta disk
+writes and consolidations.
+
+Operations:
+
+    'create'       CreateSnapshot_Task named `name`.
+    'revert'       revert to snapshot `name`, the current one when None.
+    'remove'       remove snapshot `name` (and its children with
+                   remove_children=True); its disks are consolidated.
+    'remove_all'   RemoveAllSnapshots_Task.
+    'consolidate'  ConsolidateVMDisks_Task, only on VMs that need it.
+
+VMs without the named snapshot, and VMs that need no consolidation, are
+skipped rather than failed.
+
+Usage:
+    summary = bulk_snapshot(si, vms, 'create', name='pre-patch',
+                            limits={'datastore': 2, 'host': 4})
+    print(summary.succeeded, summary.failed, summary.elapsed)
+"""
+import collections
+import time
+
+from tools import pchelper
+from tools import scheduler
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+vmodl = lazy_import('pyVmomi', 'vmodl')
+
+
+OPERATIONS = ('create', 'revert', 'remove', 'remove_all', 'consolidate')
+
+DEFAULT_LIMITS = {'datastore': 4, 'host': 8}
+
+SNAPSHOT_PROPERTIES = [
+    'name',
+    'runtime.host',
+    'config.files.vmPathName',
+    'snapshot',
+    'runtime.consolidationNeeded',
+]
+
+SnapshotSummary = collections.namedtuple(
+    'SnapshotSummary', ['operation', 'results', 'succeeded', 'failed',
+                        'skipped', 'elapsed'])
+
+
+def find_in_tree(info, name=None):
+    """
+    Returns the snapshot named `name` (the current snapshot when None) of
+    a vim.vm.SnapshotInfo, or None.
+    """
+    if info is None:
+        return None
+    if name is None:
+        return info.currentSnapshot
+    trees = list(info.rootSnapshotList)
+    while trees:
+        tree = trees.pop()
+        if tree.name == name:
+            return tree.snapshot
+        trees.extend(tree.childSnapshotList or [])
+    return None
+
+
+def snapshot_step(row, operation, name=None, description='', memory=False,
+                  quiesce=False, remove_children=False,
+                  suppress_power_on=False):
+    """
+    Returns the scheduler step running `operation` on the VM of `row` (a
+    SNAPSHOT_PROPERTIES row), or None when there is nothing to do.
+    """
+    vm = row['obj']
+    if operation == 'create':
+        return lambda _: vm.CreateSnapshot_Task(name=name,
+                                                description=description,
+                                                memory=memory,
+                                                quiesce=quiesce)
+    if operation == 'remove_all':
+        if row.get('snapshot') is None:
+            return None
+        return lambda _: vm.RemoveAllSnapshots_Task()
+    if operation == 'consolidate':
+        if not row.get('runtime.consolidationNeeded'):
+            return None
+        return lambda _: vm.ConsolidateVMDisks_Task()
+    snapshot = find_in_tree(row.get('snapshot'), name)
+    if snapshot is None:
+        return None
+    if operation == 'revert':
+        return lambda _: snapshot.RevertToSnapshot_Task(
+            suppressPowerOn=suppress_power_on)
+    return lambda _: snapshot.RemoveSnapshot_Task(
+        removeChildren=remove_children, consolidate=True)
+
+
+def job_keys(row):
+    """
+    Scheduler keys of a VM: its host and the datastore holding its
+    configuration (from config.files.vmPathName), where the delta disks
+    are created by default.
+    """
+    keys = {}
+    host = row.get('runtime.host')
+    if host is not None:
+        keys['host'] = host._moId
+    path = row.get('config.files.vmPathName') or ''
+    if path.startswith('[') and ']' in path:
+        keys['datastore'] = path[1:path.index(']')]
+    return keys
+
+
+def collect_rows(service_instance, vms):
+    """
+    Returns (rows, missing): SNAPSHOT_PROPERTIES rows of the VMs that still
+    exist and (vm, fault) for the ones deleted since they were selected.
+    One retrieval, plus one more per missing VM.
+    """
+    vms = list(vms)
+    missing = []
+    while vms:
+        try:
+            return (pchelper.collect_objects(service_instance, vms,
+                                             vim.VirtualMachine,
+                                             SNAPSHOT_PROPERTIES),
+                    missing)
+        except vmodl.fault.ManagedObjectNotFound as fault:
+            gone = [vm for vm in vms if vm._moId == fault.obj._moId]
+            if not gone:
+                raise
+            missing.extend((vm, fault) for vm in gone)
+            vms = [vm for vm in vms if vm._moId != fault.obj._moId]
+    return [], missing
+
+
+def bulk_snapshot(service_instance, vms, operation, name=None, limits=None,
+                  max_in_flight=None, **options):
+    """
+    Runs `operation` on every VM in `vms` and returns a SnapshotSummary.
+    Failures, including VMs deleted since they were selected, are reported
+    in the summary, not raised. `skipped` lists the names of the VMs with
+    nothing to do.
+
+    - `name` (str) snapshot to create, revert to or remove.
+    - `limits` (dict) tasks in flight per 'host' and per 'datastore',
+      DEFAULT_LIMITS when None.
+    - `max_in_flight` (int) overall cap.
+    - `options` description, memory, quiesce (create), remove_children
+      (remove), suppress_power_on (revert).
+    """
+    if operation not in OPERATIONS:
+        raise ValueError("Unknown snapshot operation %r, expected one of %s"
+                         % (operation, ', '.join(OPERATIONS)))
+    if name is None and operation in ('create', 'remove'):
+        raise ValueError("Snapshot operation %r needs a name" % operation)
+    started = time.time()
+    rows, missing = collect_rows(service_instance, vms)
+    jobs = []
+    skipped = []
+    for row in rows:
+        step = snapshot_step(row, operation, name=name, **options)
+        if step is None:
+            skipped.append(row.get('name') or row['obj']._moId)
+            continue
+        jobs.append(scheduler.Job(row.get('name') or row['obj']._moId,
+                                  [step], keys=job_keys(row)))
+    runner = scheduler.TaskScheduler(
+        service_instance,
+        limits=DEFAULT_LIMITS if limits is None else limits,
+        max_in_flight=max_in_flight)
+    results = [job.as_dict() for job in runner.run(jobs)]
+    results.extend({'name': vm._moId, 'ok': False, 'result': None,
+                    'error': fault, 'elapsed': None, 'step_times': []}
+                   for vm, fault in missing)
+    return SnapshotSummary(
+        operation=operation,
+        results=results,
+        succeeded=sum(1 for result in results if result['ok']),
+        failed=sum(1 for result in results if not result['ok']),
+        skipped=skipped,
+        elapsed=time.time() - started)
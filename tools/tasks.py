@@ -9,52 +9,446 @@ http://www.apache.org/licenses/LICENSE-2.0.html
 
 Helper module for task operations.
 """
-from pyVmomi import vim
-from pyVmomi import vmodl
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
 
+from tools.lazy import lazy_import
 
-def wait_for_tasks(service_instance, tasks):
+vim = lazy_import('pyVmomi', 'vim')
+vmodl = lazy_import('pyVmomi', 'vmodl')
+
+
+def wait_for_tasks(service_instance, tasks, timeout=None):
     """Given the service instance si and tasks, it returns after all the
    tasks are complete
+
+   The tasks are handed to the shared `TaskWatcher` of the service instance,
+   so concurrent callers share one PropertyCollector. The error of the
+   first failed task (in the given order) is raised.
    """
-    property_collector = service_instance.content.propertyCollector
-    task_list = [str(task) for task in tasks]
-    # Create filter
-    obj_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=task)
-                 for task in tasks]
-    property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
-                                                               pathSet=[],
-                                                               all=True)
-    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
-    filter_spec.objectSet = obj_specs
-    filter_spec.propSet = [property_spec]
-    pcfilter = property_collector.CreateFilter(filter_spec, True)
-    try:
-        version, state = None, None
-        # Loop looking for updates till the state moves to a completed state.
-        while len(task_list):
-            update = property_collector.WaitForUpdates(version)
-            for filter_set in update.filterSet:
-                for obj_set in filter_set.objectSet:
-                    task = obj_set.obj
-                    for change in obj_set.changeSet:
-                        if change.name == 'info':
-                            state = change.val.state
-                        elif change.name == 'info.state':
-                            state = change.val
-                        else:
-                            continue
-
-                        if not str(task) in task_list:
-                            continue
-
-                        if state == vim.TaskInfo.State.success:
-                            # Remove task from taskList
-                            task_list.remove(str(task))
-                        elif state == vim.TaskInfo.State.error:
-                            raise task.info.error
-            # Move to next version
-            version = update.version
-    finally:
-        if pcfilter:
+    watcher = get_watcher(service_instance)
+    futures = [watcher.watch(task, timeout=timeout) for task in tasks]
+    for future in futures:
+        future.result()
+
+
+TaskUpdate = collections.namedtuple('TaskUpdate',
+                                    ['task', 'state', 'progress', 'result',
+                                     'error'])
+
+ObjectUpdate = collections.namedtuple('ObjectUpdate', ['obj', 'changes'])
+
+# vim.TaskInfo.State values, compared as strings like pyVmomi enums.
+TERMINAL_STATES = ('success', 'error')
+
+TASK_PROPERTIES = ['info.state', 'info.progress', 'info.result', 'info.error']
+
+
+class TaskCollector(object):
+    """
+    Waits for any number of tasks through one dedicated PropertyCollector.
+
+    Each task gets its own small filter on the collector, a single
+    WaitForUpdatesEx call reports changes for all of them. Filters are
+    destroyed as soon as their task reaches a terminal state. Other managed
+    objects can be watched the same way with `add_object`.
+    """
+
+    def __init__(self, service_instance):
+        self.service_instance = service_instance
+        content = service_instance.content
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.version = ''
+        self._filters = {}
+        self._paths = {}
+        self._info = {}
+        self._tasks = set()
+
+    def __len__(self):
+        return len(self._filters)
+
+    def add(self, task):
+        """
+        Starts watching `task`.
+        """
+        self._add(task, TASK_PROPERTIES)
+        self._tasks.add(task._moId)
+
+    def add_object(self, obj, path_set):
+        """
+        Starts watching `path_set` of any managed object. Changes are
+        reported as ObjectUpdate.
+        """
+        self._add(obj, path_set)
+
+    def discard(self, obj):
+        """
+        Stops watching a task or object.
+        """
+        pcfilter = self._filters.pop(obj._moId, None)
+        self._paths.pop(obj._moId, None)
+        self._info.pop(obj._moId, None)
+        self._tasks.discard(obj._moId)
+        if pcfilter is not None:
             pcfilter.Destroy()
+
+    def wait(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (forever when None) for changes and
+        returns a list of TaskUpdate (or ObjectUpdate), one per watched
+        object that changed. Tasks that finished are no longer watched
+        afterwards.
+        """
+        options = vmodl.query.PropertyCollector.WaitOptions()
+        if timeout is not None:
+            options.maxWaitSeconds = int(timeout)
+        update = self.collector.WaitForUpdatesEx(self.version, options)
+        if update is None:
+            return []
+        self.version = update.version
+        updates = []
+        for filter_set in update.filterSet:
+            for obj_set in filter_set.objectSet:
+                obj = obj_set.obj
+                info = self._info.get(obj._moId)
+                if info is None:
+                    continue
+                changes = dict((change.name, change.val)
+                               for change in obj_set.changeSet)
+                info.update(changes)
+                if obj._moId not in self._tasks:
+                    updates.append(ObjectUpdate(obj=obj, changes=changes))
+                    continue
+                state = info.get('info.state')
+                updates.append(TaskUpdate(task=obj, state=state,
+                                          progress=info.get('info.progress'),
+                                          result=info.get('info.result'),
+                                          error=info.get('info.error')))
+                if state in TERMINAL_STATES:
+                    self.discard(obj)
+        return updates
+
+    def known(self, obj):
+        """
+        Returns the property values of `obj` reported so far, {} when it is
+        not watched.
+        """
+        return dict(self._info.get(obj._moId) or {})
+
+    def cancel_wait(self):
+        """
+        Makes a pending `wait` return early; safe to call from any thread.
+        """
+        self.collector.CancelWaitForUpdates()
+
+    def close(self):
+        """
+        Destroys the collector together with all remaining filters.
+        """
+        self._filters.clear()
+        self._paths.clear()
+        self._info.clear()
+        self._tasks.clear()
+        self.collector.Destroy()
+
+    def _add(self, obj, path_set):
+        # One filter per object: adding it again reuses the filter, or
+        # replaces it by one covering both path sets.
+        paths = self._paths.get(obj._moId)
+        if paths is not None:
+            if set(path_set) <= set(paths):
+                return
+            path_set = sorted(set(paths) | set(path_set))
+            self._filters.pop(obj._moId).Destroy()
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=obj)
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(
+            type=obj.__class__, pathSet=path_set)
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+            objectSet=[obj_spec], propSet=[property_spec])
+        self._filters[obj._moId] = self.collector.CreateFilter(filter_spec,
+                                                               True)
+        self._paths[obj._moId] = list(path_set)
+        self._info.setdefault(obj._moId, {})
+
+
+class _Watch(object):
+
+    def __init__(self, task, timeout, on_progress):
+        self.task = task
+        self.future = concurrent.futures.Future()
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.on_progress = on_progress
+
+
+class TaskWatcher(object):
+    """
+    Long-lived service resolving vim.Task objects into futures.
+
+    Any thread may register tasks; a single background thread waits for all
+    of them on one `TaskCollector` and resolves each future as soon as
+    vCenter reports success (result) or error (exception). Registration
+    interrupts a pending wait through CancelWaitForUpdates; `poll_seconds`
+    bounds the delay when that races with the start of a wait.
+
+    Usage:
+        watcher = TaskWatcher(si)
+        future = watcher.watch(vm.PowerOnVM_Task(), timeout=300)
+        future.result()
+    """
+
+    def __init__(self, service_instance, poll_seconds=5):
+        self.service_instance = service_instance
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._requests = []
+        self._watches = {}
+        self._observers = {}
+        self._collector = None
+        self._thread = None
+        self._waiting = False
+        self._closed = False
+
+    def watch(self, task, timeout=None, on_progress=None):
+        """
+        Registers `task` and returns a concurrent.futures.Future.
+
+        - `timeout` (float) seconds after which the future fails with
+          concurrent.futures.TimeoutError (the task itself keeps running).
+        - `on_progress` (callable) called as on_progress(task, progress)
+          from the watcher thread whenever info.progress changes; it must
+          return quickly.
+        """
+        watch = _Watch(task, timeout, on_progress)
+        self._submit(('watch', watch))
+        return watch.future
+
+    def observe(self, obj, path_set, callback):
+        """
+        Calls callback(obj, changes) from the watcher thread whenever one of
+        `path_set` changes on `obj`, until `unobserve`. An object may have
+        several observers, they share one filter.
+        """
+        self._submit(('observe', obj, path_set, callback))
+
+    def unobserve(self, obj, callback=None):
+        """
+        Removes `callback` (every observer of `obj` when None).
+        """
+        self._submit(('unobserve', obj, callback))
+
+    def close(self):
+        """
+        Stops the watcher thread. Futures still pending fail with
+        RuntimeError.
+        """
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+        self._wake()
+        if thread is not None:
+            thread.join()
+
+    def _submit(self, request):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("TaskWatcher is closed")
+            self._requests.append(request)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='task-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake()
+
+    def _wake(self):
+        with self._lock:
+            waiting = self._waiting
+            collector = self._collector
+        if waiting and collector is not None:
+            try:
+                collector.cancel_wait()
+            except Exception:
+                logging.debug("CancelWaitForUpdates failed", exc_info=True)
+
+    def _run(self):
+        error = None
+        try:
+            self._collector = TaskCollector(self.service_instance)
+            while self._step():
+                pass
+        except Exception as e:
+            logging.exception("Task watcher stopped")
+            error = e
+        finally:
+            self._shutdown(error)
+
+    def _step(self):
+        with self._lock:
+            requests, self._requests = self._requests, []
+            closed = self._closed
+        if closed:
+            return False
+        for request in requests:
+            self._apply(request)
+        with self._lock:
+            if self._requests or self._closed:
+                return True
+            self._waiting = True
+        try:
+            updates = self._collector.wait(self._wait_seconds())
+        except vmodl.fault.RequestCanceled:
+            updates = []
+        finally:
+            with self._lock:
+                self._waiting = False
+        for update in updates:
+            self._dispatch(update)
+        self._expire()
+        return True
+
+    def _apply(self, request):
+        kind = request[0]
+        if kind == 'watch':
+            watch = request[1]
+            if watch.future.set_running_or_notify_cancel():
+                self._collector.add(watch.task)
+                self._watches.setdefault(watch.task._moId, []).append(watch)
+        elif kind == 'observe':
+            obj, path_set, callback = request[1:]
+            known = self._collector.known(obj)
+            self._collector.add_object(obj, path_set)
+            self._observers.setdefault(obj._moId, []).append(callback)
+            # A reused filter sends no initial update: replay what is known.
+            current = dict((path, known[path]) for path in path_set
+                           if path in known)
+            if current:
+                self._call(callback, obj, current)
+        elif kind == 'unobserve':
+            obj, callback = request[1:]
+            callbacks = self._observers.get(obj._moId, [])
+            if callback is None:
+                del callbacks[:]
+            elif callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._observers.pop(obj._moId, None)
+                self._release(obj)
+
+    def _release(self, obj):
+        # Drops the filter of `obj` once nothing waits on it any more.
+        if obj._moId not in self._watches and obj._moId not in self._observers:
+            self._collector.discard(obj)
+
+    def _dispatch(self, update):
+        if isinstance(update, ObjectUpdate):
+            for callback in list(self._observers.get(update.obj._moId, [])):
+                self._call(callback, update.obj, update.changes)
+            return
+        watches = self._watches.get(update.task._moId)
+        if not watches:
+            return
+        for watch in watches:
+            if watch.on_progress is not None and update.progress is not None:
+                self._call(watch.on_progress, update.task, update.progress)
+        if update.state == vim.TaskInfo.State.success:
+            del self._watches[update.task._moId]
+            for watch in watches:
+                watch.future.set_result(update.result)
+        elif update.state == vim.TaskInfo.State.error:
+            del self._watches[update.task._moId]
+            error = update.error
+            if error is None:
+                error = RuntimeError("Task %s failed" % update.task._moId)
+            for watch in watches:
+                watch.future.set_exception(error)
+
+    def _expire(self):
+        now = time.time()
+        for moid, watches in list(self._watches.items()):
+            expired = [watch for watch in watches
+                       if watch.deadline is not None and watch.deadline <= now]
+            if not expired:
+                continue
+            watches[:] = [watch for watch in watches if watch not in expired]
+            if not watches:
+                del self._watches[moid]
+                self._release(expired[0].task)
+            for watch in expired:
+                watch.future.set_exception(concurrent.futures.TimeoutError(
+                    "Task %s did not finish in time" % moid))
+
+    def _wait_seconds(self):
+        deadlines = [watch.deadline for watches in self._watches.values()
+                     for watch in watches if watch.deadline is not None]
+        if not deadlines:
+            return self.poll_seconds
+        remaining = min(deadlines) - time.time()
+        return max(1, min(self.poll_seconds, int(remaining) + 1))
+
+    def _shutdown(self, error):
+        with self._lock:
+            watches = [watch for pending in self._watches.values()
+                       for watch in pending]
+            watches.extend(request[1] for request in self._requests
+                           if request[0] == 'watch')
+            self._watches.clear()
+            self._observers.clear()
+            self._requests = []
+            collector, self._collector = self._collector, None
+            # From here on this thread takes no requests: the next _submit
+            # starts a new one instead of queueing behind a dying thread.
+            if self._thread is threading.current_thread():
+                self._thread = None
+        for watch in watches:
+            if not watch.future.done():
+                watch.future.set_exception(
+                    error or RuntimeError("TaskWatcher is closed"))
+        if collector is not None:
+            try:
+                collector.close()
+            except Exception:
+                logging.debug("Destroying the collector failed",
+                              exc_info=True)
+
+    @staticmethod
+    def _call(callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception("Task watcher callback failed")
+
+
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(service_instance):
+    """
+    Returns the shared TaskWatcher of `service_instance`, creating it on
+    first use.
+
+    The watcher is kept on the connection's stub: ServiceInstance objects
+    compare equal across connections (same moId), so they cannot tell two
+    vCenters, or two pooled sessions, apart.
+    """
+    stub = service_instance._stub
+    with _watchers_lock:
+        watcher = getattr(stub, '_task_watcher', None)
+        if watcher is None or watcher._closed:
+            watcher = TaskWatcher(service_instance)
+            stub._task_watcher = watcher
+        return watcher
+
+
+def close_watcher(service_instance):
+    """
+    Closes and forgets the TaskWatcher of `service_instance`, if any; to
+    be called before the session is logged out.
+    """
+    stub = service_instance._stub
+    with _watchers_lock:
+        watcher = stub.__dict__.pop('_task_watcher', None)
+    if watcher is not None:
+        watcher.close()
@@ -2,82 +2,252 @@
 # Author: 'JiaChen'
 
 import atexit
-import ssl
-import time
-from pyVmomi import vim, vmodl
-from pyVim.connect import SmartConnect, Disconnect
+import queue
+from tools import clone
+from tools import datastore
+from tools import devices
+from tools import events
+from tools import instrument
+from tools import inventory
+from tools import mirror
+from tools import objindex
+from tools import ovf
+from tools import pchelper
+from tools import perf
+from tools import placement
+from tools import power
+from tools import resolver
+from tools import scheduler
+from tools import session
+from tools import snapshot
 from tools import tasks
+from tools.lazy import lazy_import
+
+vim = lazy_import('pyVmomi', 'vim')
+vmodl = lazy_import('pyVmomi', 'vmodl')
+Disconnect = lazy_import('pyVim.connect', 'Disconnect')
 
 
 class VCenterApi(object):
     """vcenter管理操作类"""
-    def __init__(self, vcenter_server, vcenter_username, vcenter_password, port=443):
+    def __init__(self, vcenter_server, vcenter_username, vcenter_password, port=443, service_instance=None,
+                 session_cache=None, soap_stats=None):
         """
         构造函数
         :param url: vcenter api url
         :param username: 用户名
         :param password: 密码
+        :param service_instance: 已登录的连接(如SessionPool.acquire()取得,会话过期时自动重新登录),传入时不再登录
+        :param session_cache: 会话缓存,True使用默认文件,也可传文件路径或session.SessionCache;
+                              会话仍有效时直接复用,不再登录,退出时也不注销
+        :param soap_stats: SOAP调用统计,True时记录本连接每次调用(含登录)的方法、对象类型、耗时、收发字节数和错误类型,
+                           'callers'时还按调用位置统计(每次调用遍历调用栈,用于排查热点),
+                           也可传instrument.SoapStats由多个连接共用;默认不记录
         """
         self.vcenter_server = vcenter_server
         self.vcenter_username = vcenter_username
         self.vcenter_password = vcenter_password
         self.port = port
-        self.si, self.content  = self.connect_to_vcenter()
+        if session_cache is True:
+            session_cache = session.SessionCache()
+        elif isinstance(session_cache, str):
+            session_cache = session.SessionCache(session_cache)
+        self.session_cache = session_cache
+        # SOAP调用统计,见soap_summary/soap_metrics;在登录前挂上,登录和RetrieveContent也计入
+        if soap_stats and not isinstance(soap_stats, instrument.SoapStats):
+            soap_stats = instrument.SoapStats(track_callers=soap_stats == 'callers')
+        self.soap_stats = soap_stats or None
+        if service_instance is not None:
+            if self.soap_stats is not None:
+                self.soap_stats = instrument.instrument(service_instance, stats=self.soap_stats)
+            self.si, self.content = service_instance, service_instance.RetrieveContent()
+        else:
+            self.si, self.content = self.connect_to_vcenter()
+        # 名称/moref/uuid 索引,按类型一次性批量加载
+        self.index = objindex.InventoryIndex(self.si)
+        # 后台库存镜像,start_mirror()后启用
+        self.mirror = None
+        # 性能数据采集,首次query_perf时创建
+        self._perf = None
+        # 放置引擎,首次place_vms时创建,多次调用共用同一个容量模型
+        self._placement = None
+        # 事件订阅,start_event_feed()后启用
+        self.event_feed = None
+        # 虚拟机设备模型,按moref缓存,reconfigure提交后刷新
+        self._device_models = {}
+        # 批量uuid/ip/dns解析,首次resolve_vms时创建
+        self._resolver = None
+        # 数据存储文件传输,首次上传/下载时创建
+        self._transfer = None
 
     def connect_to_vcenter(self):
         """
         远程连接vcenter api服务器并获取si, content
         :return: instace and content
+        :raises RuntimeError: 登录失败
         """
         try:
-            context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            context.verify_mode = ssl.CERT_NONE
-            # 获取连接对象
-            si = SmartConnect(host=self.vcenter_server,
-                              user=self.vcenter_username,
-                              pwd=self.vcenter_password,
-                              port=self.port,
-                              sslContext=context)
-            # 断开连接
-            atexit.register(Disconnect, si)
+            if self.session_cache is not None:
+                # 复用缓存的会话,不注册退出注销,保证下次还能复用
+                si = session.connect_cached(host=self.vcenter_server,
+                                            user=self.vcenter_username,
+                                            pwd=self.vcenter_password,
+                                            cache=self.session_cache,
+                                            port=self.port,
+                                            soap_stats=self.soap_stats)
+            else:
+                # 获取连接对象
+                si = session.connect(host=self.vcenter_server,
+                                     user=self.vcenter_username,
+                                     pwd=self.vcenter_password,
+                                     port=self.port,
+                                     soap_stats=self.soap_stats)
+                # 断开连接(atexit后注册先执行:先停任务监视线程再注销)
+                atexit.register(Disconnect, si)
+                atexit.register(tasks.close_watcher, si)
             content = si.RetrieveContent()
             return si, content
 
         except Exception as e:
-            exit('登录失败,请检查vcenter url或用户名和密码')
+            raise RuntimeError('登录失败,请检查vcenter url或用户名和密码: %s' % e) from e
 
     def list_obj(self, vimtype):
         """
-
-        :param vimtype:
-        :return:
+        列出指定类型的所有对象
+        :param vimtype: 类型列表,如[vim.HostSystem]
+        :return: 对象列表
         """
+        if self._mirror_ready(vimtype):
+            return self.mirror.objects(vimtype)
         container = self.content.viewManager.CreateContainerView(self.content.rootFolder, vimtype, True)
-        return container.view
+        try:
+            return list(container.view)
+        finally:
+            container.Destroy()
+
+    def start_mirror(self, version=None, wait=True):
+        """
+        启动后台库存镜像,首次全量同步后只接收增量变更(WaitForUpdatesEx)
+        启动后get_obj/list_obj/collect_inventory直接读本地数据
+        :param version: 上次运行的版本号,collector仍有效时从该处继续
+        :param wait: 是否等待首次同步完成
+        :return: mirror对象,mirror.version为当前版本号
+        """
+        if self.mirror is None:
+            self.mirror = mirror.InventoryMirror(self.si, index=self.index)
+        self.mirror.start(version=version)
+        if wait:
+            self.mirror.wait_ready()
+        return self.mirror
+
+    def stop_mirror(self, close=False):
+        """
+        停止后台库存镜像
+        :param close: 是否同时销毁collector;不销毁时可用返回的版本号继续
+        :return: 最后的版本号
+        """
+        if self.mirror is None:
+            return None
+        version = self.mirror.version
+        if close:
+            self.mirror.close()
+            self.mirror = None
+        else:
+            self.mirror.stop()
+        return version
+
+    def events(self, checkpoint=None, **kwargs):
+        """
+        按页读取vcenter事件,用于审计和变更记录,从旧到新逐条返回
+        用法: for record in instance.events(types=['VmCreatedEvent'], begin=datetime): ...
+        :param checkpoint: 断点文件路径或events.Checkpoint,传入时从上次读到的事件之后继续
+        :param kwargs: entity, recursion, types, begin, end, page_size, follow等,见tools/events.py
+        :return: events.EventRecord生成器
+        """
+        if isinstance(checkpoint, str):
+            checkpoint = events.Checkpoint(checkpoint)
+        return events.iter_events(self.si, checkpoint=checkpoint, **kwargs)
+
+    def start_event_feed(self, checkpoint=None, callbacks=None, **kwargs):
+        """
+        后台订阅事件,虚拟机/主机/数据存储的创建、改名、删除直接更新本地索引,不再全量重扫
+        :param checkpoint: 断点文件路径或events.Checkpoint
+        :param callbacks: 每条事件的回调函数列表
+        :param kwargs: entity, types等过滤条件,见events.iter_events
+        :return: events.EventFeed
+        """
+        if self.event_feed is None:
+            if isinstance(checkpoint, str):
+                checkpoint = events.Checkpoint(checkpoint)
+            self.event_feed = events.EventFeed(self.si, caches=[self.index], callbacks=callbacks,
+                                               checkpoint=checkpoint, **kwargs)
+        return self.event_feed.start()
+
+    def stop_event_feed(self):
+        """
+        停止后台事件订阅
+        """
+        if self.event_feed is not None:
+            self.event_feed.stop()
+            self.event_feed = None
+
+    def _mirror_ready(self, vimtype):
+        return self.mirror is not None and self.mirror.ready and self.mirror.covers(vimtype)
 
     def get_obj(self, vimtype, name):
         """
+        按名称查找对象,走本地索引,未命中时重建该类型索引一次
+        :param vimtype: 类型列表,如[vim.Network]
+        :param name: 对象名称
+        :return: 对象或None
+        """
+        return self.index.get(vimtype, name)
 
-        :param vimtype:
-        :param name:
-        :return:
+    def get_obj_by_moref(self, vimtype, moref):
         """
-        obj = None
-        container = self.content.viewManager.CreateContainerView(self.content.rootFolder, vimtype, True)
-        for c in container.view:
-            if c.name == name:
-                obj = c
-                break
-        return obj
+        按moref查找对象
+        :param vimtype: 类型列表
+        :param moref: 如'vm-101'
+        :return: 对象或None
+        """
+        return self.index.find_by_moref(vimtype, moref)
 
-    def create_vm(self, vm_name, vm_folder, resource_pool, datastore_name):
+    def get_vm_by_uuid(self, uuid):
+        """
+        按BIOS UUID或instance UUID查找虚拟机
+        :param uuid: uuid
+        :return: 虚拟机对象或None
+        """
+        return self.index.find_by_uuid(uuid)
+
+    def resolve_vms(self, uuids=(), ips=(), dns_names=()):
+        """
+        批量按uuid、ip、dns名称查找虚拟机,代替逐个调用searchIndex.FindByUuid
+        先查一次批量检索建立的本地索引,未命中的再并发调用FindByUuid/FindByIp/FindAllByDnsName,
+        vcenter也找不到的在一段时间内不再查询
+        :param uuids: BIOS UUID或instance UUID列表
+        :param ips: ip地址列表
+        :param dns_names: dns名称列表
+        :return: {'uuid': {uuid: 虚拟机或None}, 'ip': {ip: 虚拟机或None}, 'dns': {名称: [虚拟机]}}
         """
-        创建一台不完整的虚拟机
+        if self._resolver is None:
+            self._resolver = resolver.VmResolver(self.si)
+        return {'uuid': self._resolver.by_uuid(uuids) if uuids else {},
+                'ip': self._resolver.by_ip(ips) if ips else {},
+                'dns': self._resolver.by_dns(dns_names) if dns_names else {}}
+
+    def vm_config_spec(self, vm_name, datastore_name, memory_mb=1024, num_cpus=4,
+                       num_cores_per_socket=2, guest_id='centos64Guest', devices=None):
+        """
+        生成创建虚拟机的配置
         :param vm_name: 虚拟机名称
-        :param vm_folder: 虚拟机文件夹
-        :param resource_pool: esxi上资源池
         :param datastore_name: esxi上数据存储名称
-        :return:
+        :param memory_mb: 内存(MB)
+        :param num_cpus: 总核数
+        :param num_cores_per_socket: 每颗CPU核数
+        :param guest_id: 系统类型
+        :param devices: device_changes()返回的设备变更,一并放入配置
+        :return: vim.vm.ConfigSpec
         """
         # 定义vm存储目录
         datastore_path = '[' + datastore_name + '] ' + vm_name
@@ -88,15 +258,298 @@ class VCenterApi(object):
                                    vmPathName=datastore_path)
         # 配置vm boot配置
         config = vim.vm.ConfigSpec(name=vm_name,
-                                   memoryMB=1024,
-                                   numCPUs=4,   # 总核数
-                                   numCoresPerSocket=2,     # 几颗CPU
+                                   memoryMB=memory_mb,
+                                   numCPUs=num_cpus,   # 总核数
+                                   numCoresPerSocket=num_cores_per_socket,
                                    files=vmx_file,
-                                   guestId='centos64Guest',
+                                   guestId=guest_id,
                                    version='vmx-08')
+        if devices is not None:
+            devices.config_spec(config)
+        return config
+
+    def create_vm(self, vm_name, vm_folder, resource_pool, datastore_name, devices=None, **kwargs):
+        """
+        创建虚拟机
+        :param vm_name: 虚拟机名称
+        :param vm_folder: 虚拟机文件夹
+        :param resource_pool: esxi上资源池
+        :param datastore_name: esxi上数据存储名称
+        :param devices: device_changes()返回的设备变更,与创建合并为一个任务;不传则创建不完整的虚拟机
+        :param kwargs: memory_mb, num_cpus等,见vm_config_spec
+        :return: 虚拟机对象
+        """
+        config = self.vm_config_spec(vm_name, datastore_name, devices=devices, **kwargs)
         # 创建虚拟机
         task = vm_folder.CreateVM_Task(config=config, pool=resource_pool)
         tasks.wait_for_tasks(self.si, [task])
+        vm = task.info.result
+        self._index_vms([vm])
+        return vm
+
+    def deploy_ovf(self, path, vm_name, vm_folder, resource_pool, datastore_name, network_map=None,
+                   host=None, **kwargs):
+        """
+        部署OVA/OVF镜像,参数与create_vm一致
+        ImportVApp后各磁盘并发上传到lease给出的地址,OVA直接从tar包中按偏移读取,不解压到磁盘
+        上传期间定时更新lease进度保持lease有效
+        :param path: .ova文件或.ovf描述文件路径
+        :param vm_name: 虚拟机名称
+        :param vm_folder: 虚拟机文件夹
+        :param resource_pool: esxi上资源池
+        :param datastore_name: esxi上数据存储名称
+        :param network_map: {OVF中的网络名称: esxi上网络名称}
+        :param host: esxi主机对象,不传由vcenter选择
+        :param kwargs: disk_provisioning, max_workers, keepalive_seconds,见tools/ovf.py
+        :return: ovf.DeployResult, vm为虚拟机对象, disks为每块磁盘的上传字节数、耗时和速率
+        """
+        ds = self.get_obj([vim.Datastore], datastore_name)
+        if ds is None:
+            raise ValueError("datastore %s not found" % datastore_name)
+        networks = {}
+        for name, network_name in (network_map or {}).items():
+            networks[name] = self.get_obj([vim.Network], network_name)
+            if networks[name] is None:
+                raise ValueError("network %s not found" % network_name)
+        result = ovf.deploy(self.si, path, vm_name, vm_folder, resource_pool, ds, host=host,
+                            network_map=networks, **kwargs)
+        self._index_vms([result.vm])
+        return result
+
+    def clone_vm(self, template, vm_name, vm_folder, **kwargs):
+        """
+        从模板或虚拟机克隆,默认链接克隆(秒级完成,只写增量磁盘),源虚拟机开机且vcenter支持时用即时克隆
+        :param template: 模板/源虚拟机对象或名称
+        :param vm_name: 虚拟机名称
+        :param vm_folder: 虚拟机文件夹
+        :param kwargs: mode, snapshot, customization, resource_pool, datastore_name, host,
+                       nics, disks, memory_mb, num_cpus, power_on,见provision_vms
+        :return: 虚拟机对象
+        """
+        spec = dict(kwargs, template=template, vm_name=vm_name, vm_folder=vm_folder)
+        task = self._clone_task(spec)
+        tasks.wait_for_tasks(self.si, [task])
+        vm = task.info.result
+        self._index_vms([vm])
+        return vm
+
+    def _index_vms(self, vms):
+        """
+        新建的虚拟机写入索引(一次属性检索),之后按名称/uuid查找不会因未命中而重建整张表
+        索引中还没有虚拟机表时不做任何事,首次查找会全量加载
+        :param vms: 虚拟机对象列表
+        """
+        if not vms or not self.index.is_loaded(vim.VirtualMachine):
+            return
+        path_set = ['name'] + objindex.uuid_properties(vim.VirtualMachine)
+        try:
+            rows = pchelper.collect_objects(self.si, vms, vim.VirtualMachine, path_set)
+        except vmodl.fault.ManagedObjectNotFound:
+            # 期间有虚拟机已被删除,不写索引,查找未命中时照常重建
+            return
+        for row in rows:
+            self.index.update(row['obj'], row)
+
+    def place_vms(self, specs, strategy='spread'):
+        """
+        按容量为一批虚拟机选择esxi主机、资源池和数据存储,代替取第一个资源池/数据存储
+        一次批量采集主机空闲内存、CPU余量、数据存储空闲空间和虚拟机数,大的虚拟机先放
+        选中的容量立即在模型中预留,后续放置(包括并发调用)不会挤到同一台主机
+        :param specs: provision_vms的配置列表,已指定host/datastore_name的按指定的放
+        :param strategy: 'spread'均匀分布(默认), 'pack'尽量装满
+        :return: 补全了host, resource_pool, datastore_name的配置列表,placement键为预留记录
+        """
+        if self._placement is None:
+            self._placement = placement.PlacementEngine(self.si)
+        placed = self._placement.place(specs, strategy=strategy)
+        return [dict(spec, host=choice.host, resource_pool=choice.pool,
+                     datastore_name=choice.datastore_name, placement=choice)
+                for spec, choice in zip(specs, placed)]
+
+    def provision_vms(self, specs, limits=None, max_in_flight=None, strategy=None):
+        """
+        批量并发创建虚拟机,所有任务通过同一个PropertyCollector等待
+        :param specs: 虚拟机配置列表,每项为dict:
+                      vm_name, vm_folder, resource_pool, datastore_name (必填)
+                      host: esxi主机对象或名称,用于按主机限流和指定主机
+                      nics: 网络名称列表; disks: [(大小GB, 'thin'/'thick')]
+                      cdrom, floppy: 是否添加; power_on: 创建后是否开机
+                      其余键(memory_mb, num_cpus等)传给vm_config_spec
+                      带template键时改为克隆(resource_pool, datastore_name可选):
+                      template: 模板/源虚拟机对象或名称
+                      mode: 'auto'(默认,带customization或改硬件时不用即时克隆), 'linked', 'full',
+                            'instant'(customization只写入guestinfo,不运行客户机定制)
+                      snapshot: 链接克隆使用的快照名称,默认当前快照
+                      customization: {'hostname', 'ip', 'netmask', 'gateway', 'dns', 'domain',
+                                      'spec_name'(vcenter上保存的自定义规范)}
+        :param limits: 并发上限,如{'host': 2, 'datastore': 4}
+        :param max_in_flight: vcenter总并发上限
+        :param strategy: 不为None时先用place_vms自动放置,'spread'或'pack'
+        :return: 每台虚拟机的结果列表,[{'name', 'ok', 'result', 'error', 'elapsed', 'step_times'}]
+        """
+        if strategy is not None:
+            specs = self.place_vms(specs, strategy=strategy)
+        jobs = [scheduler.Job(spec['vm_name'], self._provision_steps(spec), keys=self._provision_keys(spec))
+                for spec in specs]
+        runner = scheduler.TaskScheduler(self.si, limits=limits, max_in_flight=max_in_flight)
+        runner.run(jobs)
+        # 新建的虚拟机写入索引,随后get_obj按名称立即能找到
+        self._index_vms([job.result for job in jobs if job.ok and job.result is not None])
+        # 创建成功的预留保留到下次采集,失败的归还容量
+        for spec, job in zip(specs, jobs):
+            if spec.get('placement') is None:
+                continue
+            if job.ok:
+                self._placement.commit(spec['placement'])
+            else:
+                self._placement.release(spec['placement'])
+        return [job.as_dict() for job in jobs]
+
+    def _provision_keys(self, spec):
+        host = spec.get('host')
+        keys = {}
+        if spec.get('datastore_name') is not None:
+            keys['datastore'] = spec['datastore_name']
+        if spec.get('placement') is not None:
+            # 放置引擎快照中已有主机名,不再逐台读取host.name
+            keys['host'] = spec['placement'].host_name
+        elif host is not None:
+            keys['host'] = host if isinstance(host, str) else host.name
+        return keys
+
+    def _provision_steps(self, spec):
+        """
+        将单台虚拟机配置拆成任务步骤:创建(设备一并放入CreateVM_Task),可选开机
+        克隆时只有一个步骤,开机由CloneSpec.powerOn完成
+        """
+        if 'template' in spec:
+            return [lambda _: self._clone_task(spec)]
+        options = dict(spec)
+        options.pop('placement', None)
+        vm_name = options.pop('vm_name')
+        vm_folder = options.pop('vm_folder')
+        resource_pool = options.pop('resource_pool')
+        datastore_name = options.pop('datastore_name')
+        host = options.pop('host', None)
+        if isinstance(host, str):
+            host = self.get_obj([vim.HostSystem], host)
+        nics = options.pop('nics', [])
+        disks = options.pop('disks', [])
+        cdrom = options.pop('cdrom', False)
+        floppy = options.pop('floppy', False)
+        power_on = options.pop('power_on', False)
+
+        def create(_):
+            builder = self.device_changes()
+            for network_name in nics:
+                builder.add_nic(network_name)
+            for disk_size, disk_type in disks:
+                builder.add_disk(disk_size, disk_type)
+            if cdrom:
+                builder.add_cdrom()
+            if floppy:
+                builder.add_floppy()
+            config = self.vm_config_spec(vm_name, datastore_name, devices=builder, **options)
+            return vm_folder.CreateVM_Task(config=config, pool=resource_pool, host=host)
+
+        def start(vm):
+            return vm.PowerOnVM_Task() if power_on else None
+
+        return [create, start]
+
+    def _clone_task(self, spec):
+        """
+        按单台虚拟机配置启动克隆任务
+        :param spec: provision_vms中带template的配置
+        :return: 克隆任务
+        """
+        options = dict(spec)
+        options.pop('placement', None)
+        source = options.pop('template')
+        if isinstance(source, str):
+            source = self.get_obj([vim.VirtualMachine], source)
+        vm_name = options.pop('vm_name')
+        vm_folder = options.pop('vm_folder')
+        pool = options.pop('resource_pool', None)
+        datastore = options.pop('datastore_name', None)
+        if datastore is not None:
+            datastore = self.get_obj([vim.Datastore], datastore)
+        host = options.pop('host', None)
+        if isinstance(host, str):
+            host = self.get_obj([vim.HostSystem], host)
+        mode = options.pop('mode', 'auto')
+        snapshot = options.pop('snapshot', None)
+        identity = options.pop('customization', None)
+        power_on = options.pop('power_on', False)
+        nics = options.pop('nics', [])
+        disks = options.pop('disks', [])
+        cdrom = options.pop('cdrom', False)
+        floppy = options.pop('floppy', False)
+
+        # 克隆时修改的硬件配置,设备按源虚拟机已有设备分配控制器和单元号
+        config = None
+        if options or nics or disks or cdrom or floppy:
+            config = vim.vm.ConfigSpec(memoryMB=options.pop('memory_mb', None),
+                                       numCPUs=options.pop('num_cpus', None),
+                                       numCoresPerSocket=options.pop('num_cores_per_socket', None))
+            if options:
+                raise ValueError('克隆不支持的参数: %s' % ', '.join(sorted(options)))
+            builder = devices.DeviceChangeBuilder(self.si, devices=source.config.hardware.device,
+                                                  network_lookup=lambda name: self.get_obj([vim.Network], name))
+            for network_name in nics:
+                builder.add_nic(network_name)
+            for disk_size, disk_type in disks:
+                builder.add_disk(disk_size, disk_type)
+            if cdrom and not builder.has_cdrom:
+                builder.add_cdrom()
+            if floppy:
+                builder.add_floppy()
+            builder.config_spec(config)
+
+        resolved = clone.choose_mode(self.si, source, mode)
+        if resolved == 'instant' and config is not None and mode == 'instant':
+            raise ValueError('即时克隆不能修改硬件配置')
+        if resolved == 'instant' and mode == 'auto' and (config is not None or identity is not None):
+            # 自动模式下需要改配置或定制主机名/IP时退回链接克隆,源虚拟机没有快照时完整克隆;
+            # 即时克隆只能把身份写入guestinfo,不运行客户机定制,会沿用源虚拟机的主机名和IP
+            resolved = 'linked' if clone.find_snapshot(source) is not None else 'full'
+        customization = None
+        guestinfo = None
+        if identity is not None and resolved == 'instant':
+            guestinfo = clone.identity_guestinfo(**dict((key, value) for key, value in identity.items()
+                                                        if key not in ('spec_name', 'time_zone')))
+        elif identity is not None:
+            customization = clone.customization_spec(self.si, **identity)
+        return clone.clone(self.si, source, vm_name, vm_folder, mode=resolved, snapshot=snapshot,
+                           pool=pool, datastore=datastore, host=host, customization=customization,
+                           guestinfo=guestinfo, config=config, power_on=power_on)
+
+    def device_changes(self, vm=None):
+        """
+        批量添加设备,所有变更合并为一个ReconfigVM_Task
+        用法: instance.device_changes(vm).add_scsi().add_disk(20, 'thin').add_nic('VM Network').commit()
+        vm为None时生成的变更用于create_vm(devices=...)
+        :param vm: 虚拟机对象
+        :return: devices.DeviceChangeBuilder
+        """
+        model = self.device_model(vm) if vm is not None else None
+        return devices.DeviceChangeBuilder(self.si, vm=vm, model=model,
+                                           network_lookup=lambda name: self.get_obj([vim.Network], name))
+
+    def device_model(self, vm, refresh=False):
+        """
+        虚拟机设备模型,一次属性检索取回全部设备,本地索引控制器、空闲槽位、硬盘和网卡
+        同一虚拟机的多次添加设备共用,只在reconfigure提交后重新读取
+        :param vm: 虚拟机对象
+        :param refresh: 是否强制重新读取(虚拟机在别处被修改过时)
+        :return: devices.DeviceModel
+        """
+        model = self._device_models.get(vm._moId)
+        if model is None:
+            model = self._device_models[vm._moId] = devices.DeviceModel.fetch(self.si, vm)
+        elif refresh:
+            model.refresh()
+        return model
 
     def add_nic(self, vm, network_name):
         """
@@ -104,50 +557,15 @@ class VCenterApi(object):
         :param network_name: esxi上网卡名称
         :return:
         """
-        spec = vim.vm.ConfigSpec()
-        nic_spec = vim.vm.device.VirtualDeviceSpec()
-        nic_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-        nic_spec.device = vim.vm.device.VirtualVmxnet3()
-        nic_spec.device.deviceInfo = vim.Description()
-        nic_spec.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
-        nic_spec.device.backing.useAutoDetect = False
-        nic_spec.device.backing.network = self.get_obj([vim.Network], network_name)
-        nic_spec.device.backing.deviceName = network_name
-        nic_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-        nic_spec.device.connectable.startConnected = True
-        nic_spec.device.connectable.startConnected = True
-        nic_spec.device.connectable.allowGuestControl = True
-        nic_spec.device.connectable.connected = True
-        nic_spec.device.connectable.status = 'untried'
-        nic_spec.device.wakeOnLanEnabled = True
-        nic_spec.device.addressType = 'generated'
-        spec.deviceChange = [nic_spec]
-        task = vm.ReconfigVM_Task(spec=spec)
-        tasks.wait_for_tasks(self.si, [task])
+        self.device_changes(vm).add_nic(network_name).commit()
 
     def add_scsi(self, vm):
         """
         添加scsi控制器
         :param vm: virtual machine object
-        :return: scsi configuration
-        :TBD
-        """
-        spec = vim.vm.ConfigSpec()
-        scsi_spec = vim.vm.device.VirtualDeviceSpec()
-        scsi_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-        scsi_spec.device = vim.vm.device.VirtualLsiLogicController()
-        scsi_spec.device.deviceInfo = vim.Description()
-        scsi_spec.device.slotInfo = vim.vm.device.VirtualDevice.PciBusSlotInfo()
-        scsi_spec.device.slotInfo.pciSlotNumber = 16
-        scsi_spec.device.controllerKey = 100
-        scsi_spec.device.unitNumber = 3
-        scsi_spec.device.busNumber = 0
-        scsi_spec.device.hotAddRemove = True
-        scsi_spec.device.sharedBus = 'noSharing'
-        scsi_spec.device.scsiCtlrUnitNumber = 7
-        spec.deviceChange = [scsi_spec]
-        task = vm.ReconfigVM_Task(spec=spec)
-        tasks.wait_for_tasks(self.si, [task])
+        :return:
+        """
+        self.device_changes(vm).add_scsi().commit()
 
     def add_disk(self, vm, disk_size, disk_type):
         """
@@ -157,96 +575,80 @@ class VCenterApi(object):
         :param disk_type: 磁盘类型
         :return:
         """
-        spec = vim.vm.ConfigSpec()
-        # get all disks on a VM, set unit_number to the next available
-        unit_number = 0
-        for dev in vm.config.hardware.device:
-            if hasattr(dev.backing, 'fileName'):
-                unit_number = int(dev.unitNumber) + 1
-                # unit_number 7 reserved for scsi controller
-                if unit_number == 7:
-                    unit_number += 1
-                if unit_number >= 16:
-                    return
-            if isinstance(dev, vim.vm.device.VirtualSCSIController):
-                controller = dev
-        # add disk here
-        new_disk_kb = int(disk_size) * 1024 * 1024
-        disk_spec = vim.vm.device.VirtualDeviceSpec()
-        disk_spec.fileOperation = "create"
-        disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-        disk_spec.device = vim.vm.device.VirtualDisk()
-        disk_spec.device.backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo()
-        if disk_type == 'thin':
-            disk_spec.device.backing.thinProvisioned = True
-        disk_spec.device.backing.diskMode = 'persistent'
-        disk_spec.device.unitNumber = unit_number
-        disk_spec.device.capacityInKB = new_disk_kb
-        disk_spec.device.controllerKey = controller.key
-        spec.deviceChange = [disk_spec]
-        task = vm.ReconfigVM_Task(spec=spec)
-        tasks.wait_for_tasks(self.si, [task])
+        self.device_changes(vm).add_disk(disk_size, disk_type).commit()
 
     def add_cdrom(self, vm):
         """
-        添加CDROM
+        添加CDROM,已存在CD-Rom时不重复添加
         :param vm:
         :return:
         """
-        # 查找设备控制器
-        for dev in vm.config.hardware.device:
-            if isinstance(dev, vim.vm.device.VirtualIDEController):
-                # If there are less than 2 devices attached, we can use it.
-                if len(dev.device) < 2:
-                    controller = dev
-                else:
-                    controller = None
+        builder = self.device_changes(vm)
         # 判断vm是否已经挂载CD-Rom
-        for dev in vm.config.hardware.device:
-            if isinstance(dev, vim.vm.device.VirtualCdrom):
-                cdrom = dev
-            else:
-                cdrom = None
-        # 生成CD-Rom配置
-        if cdrom is None:
-            spec = vim.vm.ConfigSpec()
-            cdrom_spec = vim.vm.device.VirtualDeviceSpec()
-            cdrom_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-            cdrom_spec.device = vim.vm.device.VirtualCdrom()
-            cdrom_spec.device.deviceInfo = vim.Description()
-            cdrom_spec.device.backing = vim.vm.device.VirtualCdrom.RemotePassthroughBackingInfo()
-            cdrom_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-            cdrom_spec.device.connectable.allowGuestControl = True
-            cdrom_spec.device.connectable.startConnected = True
-            cdrom_spec.device.controllerKey = controller.key
-            cdrom_spec.device.key = -1
-            spec.deviceChange = [cdrom_spec]
-            task = vm.ReconfigVM_Task(spec=spec)
-            tasks.wait_for_tasks(self.si, [task])
+        if not builder.has_cdrom:
+            builder.add_cdrom().commit()
+
+    def add_iso_cdrom(self, vm, datastore_name, iso_path, local_path=None):
+        """
+        挂载数据存储上的ISO镜像(IsoBackingInfo),已有CD-Rom时替换其backing,没有时新增
+        传入local_path时先把本地ISO上传到iso_path
+        :param vm: 虚拟机对象
+        :param datastore_name: 数据存储名称
+        :param iso_path: ISO在数据存储上的路径,如'iso/centos.iso'
+        :param local_path: 本地ISO文件路径
+        :return:
+        """
+        if local_path is not None:
+            self.upload_file(local_path, datastore_name, iso_path)
+        builder = self.device_changes(vm)
+        builder.insert_iso(datastore.datastore_path(datastore_name, iso_path)).commit()
 
     def add_floppy(self, vm):
-        # 查找设备控制器
-        for dev in vm.config.hardware.device:
-            if isinstance(dev, vim.vm.device.VirtualIDEController):
-                # If there are less than 2 devices attached, we can use it.
-                if len(dev.device) < 2:
-                    controller = dev
-                else:
-                    controller = None
-        spec = vim.vm.ConfigSpec()
-        floppy_spec = vim.vm.device.VirtualDeviceSpec()
-        floppy_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
-        floppy_spec.device = vim.vm.device.VirtualFloppy()
-        floppy_spec.device.deviceInfo = vim.Description()
-        floppy_spec.device.backing = vim.vm.device.VirtualFloppy.RemoteDeviceBackingInfo()
-        floppy_spec.device.connectable = vim.vm.device.VirtualDevice.ConnectInfo()
-        floppy_spec.device.connectable.allowGuestControl = True
-        floppy_spec.device.connectable.startConnected = False
-        floppy_spec.device.controllerKey = controller.key
-        floppy_spec.device.key = 8000
-        spec.deviceChange = [floppy_spec]
-        task = vm.ReconfigVM_Task(spec=spec)
-        tasks.wait_for_tasks(self.si, [task])
+        """
+        添加软驱
+        :param vm:
+        :return:
+        """
+        self.device_changes(vm).add_floppy().commit()
+
+    def upload_file(self, local_path, datastore_name, remote_path, checksum=None, verify=False):
+        """
+        上传本地文件(ISO、VMDK等)到数据存储,经/folder接口复用当前会话cookie,按块流式读取,不整个读入内存
+        :param local_path: 本地文件路径
+        :param datastore_name: 数据存储名称
+        :param remote_path: 数据存储上的路径
+        :param checksum: 本地文件预期的摘要(默认sha256),不一致时抛出datastore.ChecksumError
+        :param verify: 上传后是否重新读取远端文件校验摘要
+        :return: 上传数据的摘要
+        """
+        datacenter_name, transfer = self._datastore_transfer(datastore_name)
+        return transfer.upload(local_path, datacenter_name, datastore_name, remote_path,
+                               checksum=checksum, verify=verify)
+
+    def download_file(self, datastore_name, remote_path, local_path, checksum=None):
+        """
+        从数据存储下载文件,按字节范围多线程并发下载后校验摘要
+        :param datastore_name: 数据存储名称
+        :param remote_path: 数据存储上的路径
+        :param local_path: 本地文件路径
+        :param checksum: 预期摘要,不一致时抛出datastore.ChecksumError
+        :return: 本地文件的摘要
+        """
+        datacenter_name, transfer = self._datastore_transfer(datastore_name)
+        return transfer.download(datacenter_name, datastore_name, remote_path, local_path,
+                                 checksum=checksum)
+
+    def _datastore_transfer(self, datastore_name):
+        ds = self.get_obj([vim.Datastore], datastore_name)
+        if ds is None:
+            raise ValueError("datastore %s not found" % datastore_name)
+        datacenter = datastore.find_datacenter(ds)
+        if datacenter is None:
+            raise ValueError("datastore %s is not in any datacenter" % datastore_name)
+        if self._transfer is None:
+            self._transfer = datastore.DatastoreTransfer(self.si)
+        # 数据中心在文件夹中时dcPath需要完整的库存路径
+        return datastore.datacenter_path(datacenter), self._transfer
 
     def print_vm_info(self, vm):
         """
@@ -280,7 +682,15 @@ class VCenterApi(object):
             print("Question  : ", summary.runtime.question.text)
         print("")
 
-    def answer_vm_question(self, vm):
+    def answer_vm_question(self, vm, policy=None):
+        """
+        回答虚拟机开机时的问题
+        :param vm:
+        :param policy: 回答策略,见tools/power.py;为None时在终端交互输入
+        :return: 选项key
+        """
+        if policy is not None:
+            return power.choose_answer(vm.runtime.question, policy)
         choices = vm.runtime.question.choice.choiceInfo
         default_option = None
         choice = ""
@@ -298,6 +708,23 @@ class VCenterApi(object):
             print("...")
         return choice
 
+    def wait_task(self, task, action_name='job', timeout=None):
+        """
+        通过共享的任务监听服务等待任务完成
+        :param task: 任务对象
+        :param action_name: 任务名称,用于输出
+        :param timeout: 超时时间(秒)
+        :return: 任务结果
+        """
+        try:
+            result = tasks.get_watcher(self.si).watch(task, timeout=timeout).result()
+        except vmodl.MethodFault as e:
+            out = 'Error - %s did not complete successfully: %s' % (action_name, e)
+            raise ValueError(out)
+        out = '%s completed successfully.' % action_name
+        print(out)
+        return result
+
     def poweroff(self, vm):
         """
         关闭虚拟机
@@ -305,35 +732,34 @@ class VCenterApi(object):
         :return:
         """
         task = vm.PowerOff()
-        actionName = 'job'
-        while task.info.state not in [vim.TaskInfo.State.success or vim.TaskInfo.State.error]:
-            time.sleep(2)
-        if task.info.state == vim.TaskInfo.State.success:
-            out = '%s completed successfully.' % actionName
-            print(out)
-        elif task.info.state == vim.TaskInfo.State.error:
-            out = 'Error - %s did not complete successfully: %s' % (actionName, task.info.error)
-            raise ValueError(out)
-        return
+        self.wait_task(task)
 
     def poweron(self, vm):
+        """
+        打开虚拟机,开机过程中出现的问题通过answer_vm_question回答
+        :param vm:
+        :return:
+        """
+        watcher = tasks.get_watcher(self.si)
         task = vm.PowerOn()
-        actionName = 'job'
+        future = watcher.watch(task)
+        # 监听线程只负责通知,回答问题在当前线程进行,避免阻塞其他任务
+        events = queue.Queue()
+        future.add_done_callback(lambda f: events.put(None))
+
+        def on_question(obj, changes):
+            events.put(changes.get('runtime.question'))
+        watcher.observe(vm, ['runtime.question'], on_question)
         answers = {}
-        while task.info.state not in [vim.TaskInfo.State.success or vim.TaskInfo.State.error]:
-            if vm.runtime.question is not None:
-                question_id = vm.runtime.question.id
-                if question_id not in answers.keys():
-                    answers[question_id] = self.answer_vm_question(vm)
-                    vm.AnswerVM(question_id, answers[question_id])
-            time.sleep(2)
-        if task.info.state == vim.TaskInfo.State.success:
-            out = '%s completed successfully.' % actionName
-            print(out)
-        elif task.info.state == vim.TaskInfo.State.error:
-            out = 'Error - %s did not complete successfully: %s' % (actionName, task.info.error)
-            raise ValueError(out)
-        return
+        try:
+            while not future.done():
+                question = events.get()
+                if question is not None and question.id not in answers:
+                    answers[question.id] = self.answer_vm_question(vm)
+                    vm.AnswerVM(question.id, answers[question.id])
+        finally:
+            watcher.unobserve(vm, on_question)
+        self.wait_task(task)
 
     def powersuspend(self, vm):
         """
@@ -344,6 +770,100 @@ class VCenterApi(object):
         if vm.runtime.powerState == 'poweredOn':
             vm.Suspend()
 
+    def power_on_vms(self, vms, policy='default', timeout=None):
+        """
+        批量开机,按数据中心合并为PowerOnMultiVM_Task
+        :param vms: 虚拟机对象列表
+        :param policy: 开机问题的回答策略,默认选择默认选项,不会等待终端输入
+        :param timeout: 单个任务超时时间(秒)
+        :return: {虚拟机moref: {'ok': bool, 'error': 错误}}
+        """
+        return power.power_on_vms(self.si, vms, policy=policy, timeout=timeout)
+
+    def power_off_vms(self, vms, max_concurrency=16):
+        """
+        批量并发关机
+        :param vms: 虚拟机对象列表
+        :param max_concurrency: 同时进行的任务数上限
+        :return: {虚拟机moref: {'ok': bool, 'error': 错误, 'elapsed': 耗时}}
+        """
+        return power.power_off_vms(self.si, vms, max_concurrency=max_concurrency)
+
+    def suspend_vms(self, vms, max_concurrency=16):
+        """
+        批量并发挂起,只处理已开机的虚拟机
+        :param vms: 虚拟机对象列表
+        :param max_concurrency: 同时进行的任务数上限
+        :return: {虚拟机moref: {'ok': bool, 'error': 错误, ...}}
+        """
+        return power.suspend_vms(self.si, vms, max_concurrency=max_concurrency)
+
+    def snapshot_vms(self, vms, operation, name=None, limits=None, max_in_flight=None, **kwargs):
+        """
+        批量快照操作,按esxi主机和数据存储限制并发,所有任务通过同一个PropertyCollector等待
+        :param vms: 虚拟机对象或名称列表
+        :param operation: 'create'创建, 'revert'恢复, 'remove'删除, 'remove_all'删除全部, 'consolidate'整合磁盘
+        :param name: 快照名称,create和remove必填,revert不传时恢复到当前快照
+        :param limits: 并发上限,默认{'datastore': 4, 'host': 8}
+        :param max_in_flight: vcenter总并发上限
+        :param kwargs: description, memory, quiesce, remove_children, suppress_power_on,见tools/snapshot.py
+        :return: snapshot.SnapshotSummary,成功/失败数、跳过的虚拟机、每台的结果和总耗时
+        """
+        names = [vm for vm in vms if isinstance(vm, str)]
+        found = dict((name, self.get_obj([vim.VirtualMachine], name)) for name in names)
+        missing = [name for name in names if found[name] is None]
+        if missing:
+            raise ValueError("virtual machines not found: %s" % ', '.join(missing))
+        vms = [found[vm] if isinstance(vm, str) else vm for vm in vms]
+        return snapshot.bulk_snapshot(self.si, vms, operation, name=name, limits=limits,
+                                      max_in_flight=max_in_flight, **kwargs)
+
+    def collect_inventory(self):
+        """
+        批量采集esxi主机、数据存储、网络和虚拟机信息
+        每种类型只做一次属性检索,只取需要的属性,在本地组装
+        :return: {esxi名称: {'esxi_info': {}, 'datastore': {}, 'network': {}, 'vm': {}}}
+        """
+        if self._mirror_ready(list(inventory.inventory_properties())):
+            return inventory.build_report(hosts=self.mirror.rows(vim.HostSystem),
+                                          datastores=self.mirror.rows(vim.Datastore),
+                                          networks=self.mirror.rows(vim.Network),
+                                          vms=self.mirror.rows(vim.VirtualMachine))
+        return inventory.collect_inventory(self.si)
+
+    def soap_summary(self, top=10):
+        """
+        本次运行的SOAP调用汇总:调用次数、耗时、收发字节数,按总耗时排序的前top个方法
+        需以soap_stats=True创建实例
+        :param top: 显示的方法数
+        :return: 文本
+        """
+        if self.soap_stats is None:
+            raise ValueError("SOAP instrumentation is off, pass soap_stats=True")
+        return self.soap_stats.summary(top=top)
+
+    def soap_metrics(self, labels=None):
+        """
+        SOAP调用统计的Prometheus文本格式快照(耗时、请求/响应大小直方图,错误计数)
+        :param labels: 附加标签,如{'script': 'nightly_export'}
+        :return: 文本
+        """
+        if self.soap_stats is None:
+            raise ValueError("SOAP instrumentation is off, pass soap_stats=True")
+        return self.soap_stats.prometheus(labels=dict(labels or {}, vcenter=self.vcenter_server))
+
+    def query_perf(self, entities, counters, **kwargs):
+        """
+        批量查询esxi主机/虚拟机性能数据,一次QueryPerf请求,计数器ID每个会话只解析一次
+        :param entities: esxi主机或虚拟机对象列表
+        :param counters: 计数器名称列表,格式group.name.rollup,如['cpu.usage.average']
+        :param kwargs: interval_id, max_sample, start_time, end_time等,见tools/perf.py
+        :return: perf.PerfResult, values为numpy数组(对象 x 计数器 x 时间)
+        """
+        if self._perf is None:
+            self._perf = perf.PerfCollector(self.si)
+        return self._perf.query(entities, counters, **kwargs)
+
 if __name__ == '__main__':
     # 实例化
     instance = VCenterApi(vcenter_server='192.168.222.10',
@@ -373,9 +893,30 @@ if __name__ == '__main__':
     #                    vm_folder=vm_folder,
     #                    resource_pool=resource_pool,
     #                    datastore_name=datastore_name)
+    # 批量并发创建虚拟机(每台esxi同时最多2个任务)
+    # results = instance.provision_vms([{'vm_name': 'test_vm_%02d' % i,
+    #                                    'vm_folder': vm_folder,
+    #                                    'resource_pool': resource_pool,
+    #                                    'datastore_name': datastore_name,
+    #                                    'host': esxi_obj,
+    #                                    'nics': [network_name],
+    #                                    'disks': [(20, 'thin')],
+    #                                    'cdrom': True} for i in range(10)],
+    #                                  limits={'host': 2, 'datastore': 4},
+    #                                  max_in_flight=8)
+    # 按容量自动选择esxi主机、资源池和数据存储后批量创建
+    # results = instance.provision_vms([{'vm_name': 'test_vm_%02d' % i,
+    #                                    'vm_folder': vm_folder,
+    #                                    'memory_mb': 4096,
+    #                                    'nics': [network_name],
+    #                                    'disks': [(20, 'thin')]} for i in range(10)],
+    #                                  limits={'host': 2, 'datastore': 4},
+    #                                  strategy='spread')
     # 通过vm uuid过滤虚拟机
     search_index = instance.si.content.searchIndex
     vm = search_index.FindByUuid(None, '500d8ca6-ee47-95b6-fe3e-2407cd88362f', True, True)
+    # 批量解析uuid/ip/dns
+    # found = instance.resolve_vms(uuids=['500d8ca6-ee47-95b6-fe3e-2407cd88362f'], ips=['192.168.222.31'])
     # 创建网卡
     # instance.add_nic(vm=vm, network_name=network_name)
     # 创建SCSI控制器
@@ -388,6 +929,14 @@ if __name__ == '__main__':
     # instance.add_cdrom(vm=vm)
     # 创建软驱
     # instance.add_floppy(vm=vm)
+    # 批量添加设备,只提交一个ReconfigVM_Task
+    # instance.device_changes(vm).add_nic(network_name).add_scsi().add_disk(20, 'thin').add_cdrom().add_floppy().commit()
+    # 创建虚拟机时一并添加设备
+    # instance.create_vm(vm_name=vm_name,
+    #                    vm_folder=vm_folder,
+    #                    resource_pool=resource_pool,
+    #                    datastore_name=datastore_name,
+    #                    devices=instance.device_changes().add_nic(network_name).add_disk(20, 'thin').add_cdrom())
     # 打印虚拟机详情
     # content = instance.si.RetrieveContent()
     # container = content.rootFolder
@@ -404,57 +953,12 @@ if __name__ == '__main__':
     # instance.poweroff(vm=vm)
     # 挂起虚拟机
     # instance.powersuspend(vm=vm)
+    # 统计SOAP调用(创建实例时传soap_stats=True),找出循环中逐个调用get_obj等热点
+    # print(instance.soap_summary())
+    # open('/var/lib/node_exporter/vcenter_soap.prom', 'w').write(instance.soap_metrics({'script': 'demo'}))
 
-    esxi_host = {}
-    content = instance.si.RetrieveContent()
-    esxi_obj = instance.list_obj([vim.HostSystem])
-    for esxi in esxi_obj:
-        esxi_host[esxi.name] = {'esxi_info': {}, 'datastore': {}, 'network': {}, 'vm': {}}
-
-        esxi_host[esxi.name]['esxi_info']['厂商'] = esxi.summary.hardware.vendor
-        esxi_host[esxi.name]['esxi_info']['型号'] = esxi.summary.hardware.model
-        for i in esxi.summary.hardware.otherIdentifyingInfo:
-            if isinstance(i, vim.host.SystemIdentificationInfo):
-                esxi_host[esxi.name]['esxi_info']['SN'] = i.identifierValue
-        esxi_host[esxi.name]['esxi_info']['处理器'] = '数量：%s 核数：%s 线程数：%s 频率：%s(%s) ' % (esxi.summary.hardware.numCpuPkgs,
-                                                                                      esxi.summary.hardware.numCpuCores,
-                                                                                      esxi.summary.hardware.numCpuThreads,
-                                                                                      esxi.summary.hardware.cpuMhz,
-                                                                                      esxi.summary.hardware.cpuModel)
-        esxi_host[esxi.name]['esxi_info']['处理器使用率'] = '%.1f%%' % (esxi.summary.quickStats.overallCpuUsage /
-                                                                  (
-                                                                  esxi.summary.hardware.numCpuPkgs * esxi.summary.hardware.numCpuCores * esxi.summary.hardware.cpuMhz) * 100)
-        esxi_host[esxi.name]['esxi_info']['内存(MB)'] = esxi.summary.hardware.memorySize / 1024 / 1024
-        esxi_host[esxi.name]['esxi_info']['可用内存(MB)'] = '%.1f MB' % (
-        (esxi.summary.hardware.memorySize / 1024 / 1024) - esxi.summary.quickStats.overallMemoryUsage)
-        esxi_host[esxi.name]['esxi_info']['内存使用率'] = '%.1f%%' % (
-        (esxi.summary.quickStats.overallMemoryUsage / (esxi.summary.hardware.memorySize / 1024 / 1024)) * 100)
-        esxi_host[esxi.name]['esxi_info']['系统'] = esxi.summary.config.product.fullName
-
-        for ds in esxi.datastore:
-            esxi_host[esxi.name]['datastore'][ds.name] = {}
-            esxi_host[esxi.name]['datastore'][ds.name]['总容量(G)'] = int((ds.summary.capacity) / 1024 / 1024 / 1024)
-            esxi_host[esxi.name]['datastore'][ds.name]['空闲容量(G)'] = int((ds.summary.freeSpace) / 1024 / 1024 / 1024)
-            esxi_host[esxi.name]['datastore'][ds.name]['类型'] = (ds.summary.type)
-        for nt in esxi.network:
-            esxi_host[esxi.name]['network'][nt.name] = {}
-            esxi_host[esxi.name]['network'][nt.name]['标签ID'] = nt.name
-        for vm in esxi.vm:
-            esxi_host[esxi.name]['vm'][vm.name] = {}
-            esxi_host[esxi.name]['vm'][vm.name]['电源状态'] = vm.runtime.powerState
-            esxi_host[esxi.name]['vm'][vm.name]['CPU(内核总数)'] = vm.config.hardware.numCPU
-            esxi_host[esxi.name]['vm'][vm.name]['内存(总数MB)'] = vm.config.hardware.memoryMB
-            esxi_host[esxi.name]['vm'][vm.name]['系统信息'] = vm.config.guestFullName
-            if vm.guest.ipAddress:
-                esxi_host[esxi.name]['vm'][vm.name]['IP'] = vm.guest.ipAddress
-            else:
-                esxi_host[esxi.name]['vm'][vm.name]['IP'] = '服务器需要开机后才可以获取'
-
-            for d in vm.config.hardware.device:
-                if isinstance(d, vim.vm.device.VirtualDisk):
-                    esxi_host[esxi.name]['vm'][vm.name][d.deviceInfo.label] = str(
-                        (d.capacityInKB) / 1024 / 1024) + ' GB'
-
+    # 批量采集esxi主机/存储/网络/虚拟机信息
+    esxi_host = instance.collect_inventory()
     print(esxi_host)
 
 '''